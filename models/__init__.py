@@ -15,23 +15,35 @@
 #
 ################################################################################
 
-from .glm import GLM
-from .llama import Llama, Llama_with_H2O
-from .qwen import Qwen2
-from .phi3 import Phi3
+import importlib
+
+# model classes pull in transformers, import them lazily so that
+# models.kv_cache and models.shadowkv_ops stay usable on CPU-only hosts
+_MODEL_MODULES = {
+    'GLM': '.glm',
+    'Llama': '.llama',
+    'Llama_with_H2O': '.llama',
+    'Qwen2': '.qwen',
+    'Phi3': '.phi3',
+}
+
+def __getattr__(name):
+    if name in _MODEL_MODULES:
+        return getattr(importlib.import_module(_MODEL_MODULES[name], __name__), name)
+    raise AttributeError(f"module {__name__} has no attribute {name}")
 
 def choose_model_class(model_name, method = 'h2o'):
     if 'llama' in model_name.lower():
-        return Llama
+        return __getattr__('Llama')
     elif 'glm' in model_name.lower():
-        return GLM
+        return __getattr__('GLM')
     elif 'yi' in model_name.lower():
-        return Llama
+        return __getattr__('Llama')
     elif 'qwen' in model_name.lower():
-        return Qwen2
+        return __getattr__('Qwen2')
     elif 'phi' in model_name.lower():
-        return Phi3
+        return __getattr__('Phi3')
     elif method == "h2o":
-        return Llama_with_H2O
+        return __getattr__('Llama_with_H2O')
     else:
         raise ValueError(f"Model {model_name} not found")
\ No newline at end of file
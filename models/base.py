@@ -23,32 +23,96 @@ import time
 import gc
 from tqdm import tqdm
 
-from flash_attn import flash_attn_with_kvcache
-
-from .tensor_op import sample_token, layer_norm, minference_prefill_kernel
+from .tensor_op import sample_token, layer_norm, minference_prefill_kernel, flash_attn_with_kvcache
 from .kv_cache import KV_Cache, ShadowKVCache, ShadowKVCache_CPU
+from .prefix_cache import PrefixCache
+from .cuda_graph import GraphDecoder
+from .speculative import SpeculativeDecoder
+from .prefill_planner import PrefillPlanner
 
 class LLM:
 
+    prefix_cache = None
+    prefill_window = None
+    cont_step_len = 64
+    memory_cleanup = True
+    graph_decoder = None
+    prefill_planner = None
+
     def __str__(self) -> str:
         gpu_mem = f"{round(torch.cuda.memory_allocated(self.device) / 1024**3, 2)} GB / {round(torch.cuda.get_device_properties(self.device).total_memory / 1024**3, 2)} GB"
         return f"LLM: {self.model_name}, attn_mode: {self.attn_mode}, max_length: {self.max_length}, batch_size: {self.batch_size}, device: {self.device}, dtype: {self.dtype}, GPU mem: {gpu_mem}"
 
-    def init_kv_cache(self, sparse_budget: int, rank: int, chunk_size: int, config):
+    def init_kv_cache(self, sparse_budget: int, rank: int, chunk_size: int, config, **kv_cache_kwargs):
         if self.attn_mode == 'full':
             self.kv_cache = KV_Cache(config, max_length=self.max_length, device=self.device, dtype=self.dtype, batch_size=self.batch_size)
         elif self.attn_mode.lower() == 'shadowkv':
             self.kv_cache = ShadowKVCache(config, max_length=self.max_length, device=self.device, dtype=self.dtype, batch_size=self.batch_size, sparse_budget=sparse_budget, rank=rank, chunk_size=chunk_size)
         elif self.attn_mode.lower() == 'shadowkv_cpu':
-            self.kv_cache = ShadowKVCache_CPU(config, max_length=self.max_length, device=self.device, dtype=self.dtype, batch_size=self.batch_size, sparse_budget=sparse_budget, rank=rank, chunk_size=chunk_size)
+            self.kv_cache = ShadowKVCache_CPU(config, max_length=self.max_length, device=self.device, dtype=self.dtype, batch_size=self.batch_size, sparse_budget=sparse_budget, rank=rank, chunk_size=chunk_size, **kv_cache_kwargs)
         else:
             raise ValueError(f"Invalid attention mode {self.attn_mode}")
 
     def print_kv_stats(self):
         self.kv_cache.print_stats()
+
+    def set_memory_cleanup(self, enabled: bool = True):
+        # gc.collect / empty_cache / synchronize after generate and in H2D, they give memory back between long
+        # requests but add a few ms to every request, which shows in the latency of short generations
+        self.memory_cleanup = enabled
+        self.kv_cache.memory_cleanup = enabled
+
+    def release_memory(self):
+        if not self.memory_cleanup:
+            return
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+            torch.cuda.synchronize()
     
+    def enable_cuda_graph(self, enabled: bool = True):
+        # replay decode steps from a CUDA graph, see models/cuda_graph.py, steps it cannot express run eagerly
+        if self.graph_decoder is not None:
+            self.graph_decoder.release()
+            self.graph_decoder = None
+        if enabled:
+            if not isinstance(self.kv_cache, ShadowKVCache_CPU):
+                raise ValueError(f"CUDA graph decoding is only supported with attn_mode shadowkv_cpu, got {self.attn_mode}")
+            self.graph_decoder = GraphDecoder(self)
+
+    def set_prefill_planner(self, max_sub_batch: int = 8, memory_fraction: float = 0.9):
+        # batch_prefill sub-batches are sized from free GPU memory, see models/prefill_planner.py
+        self.prefill_planner = PrefillPlanner(self, max_sub_batch=max_sub_batch, memory_fraction=memory_fraction)
+
+    def enable_layer_prefetch(self, enabled: bool = True):
+        # start the value transfer of layer L+1 during the attention and MLP of layer L, see prefetch_next_layer()
+        if enabled and not isinstance(self.kv_cache, ShadowKVCache_CPU):
+            raise ValueError(f"Layer prefetch is only supported with attn_mode shadowkv_cpu, got {self.attn_mode}")
+        self.kv_cache.layer_prefetch = enabled
+
+    def prefetch_next_layer(self, layer_idx: int, hidden_states: torch.Tensor, position_ids: torch.LongTensor):
+        # the residual stream changes little from one layer to the next: the query of layer L+1 computed from the
+        # input of layer L picks most of the chunks layer L+1 will select, the misses are copied by its retrieval
+        query_states, key_states, _ = self.pre_attention_compute(
+            hidden_states,
+            self.layers[layer_idx + 1],
+            self.num_heads,
+            self.num_key_value_heads,
+            self.head_dim
+        )
+        query_states, _ = self.apply_rotary_pos_emb(query_states, key_states, position_ids)
+        self.kv_cache.prefetch_layer(layer_idx + 1, query_states, rope_func=self.apply_rotary_pos_emb_single, cos_sin_cache=self.cos_sin_cache)
+
+    def decode_step(self, input_ids: torch.LongTensor):
+        if self.graph_decoder is not None:
+            return self.graph_decoder(input_ids)
+        return self.inference(input_ids=input_ids, position_ids=self.get_ctx(input_ids))
+
     def get_ctx(self, input_ids: torch.LongTensor):
         input_len = input_ids.size(1)
+        if isinstance(self.kv_cache, ShadowKVCache_CPU) and self.kv_cache.prefilled_batch == self.kv_cache.batch_size and input_ids.size(0) == self.kv_cache.batch_size:
+            # every slot continues from its own length, slots of a ragged batch differ
+            return self.kv_cache.get_seq_lens().unsqueeze(1) + torch.arange(input_len, device=self.device, dtype=torch.long)
         past_len = self.kv_cache.get_kv_len()
         position_ids = torch.arange(past_len, past_len + input_len, device=self.device, dtype=torch.long).unsqueeze(0).repeat(input_ids.size(0), 1)
         return position_ids
@@ -72,17 +136,79 @@ class LLM:
         return logits
 
     @torch.inference_mode()
-    def prefill(self, input_ids: torch.LongTensor):
+    def prefill(self, input_ids: torch.LongTensor, prefix_len: int = None):
+        if self.prefix_cache is not None:
+            return self.prefill_with_prefix_cache(input_ids, prefix_len)
+
         self.kv_cache.clear()
         logits = self.inference(input_ids=input_ids, position_ids=self.get_ctx(input_ids))
 
         assert self.kv_cache.get_kv_len() == input_ids.shape[-1], f"KV length mismatch, got {self.kv_cache.get_kv_len()}, expected {input_ids.shape[-1]}"
         return logits
 
+    def enable_prefix_cache(self, capacity_gb: float = 64, block_size: int = 256):
+        self.prefix_cache = PrefixCache(capacity_bytes=int(capacity_gb * 1024**3), block_size=block_size)
+
+    def max_cont_len(self, prefix_len: int):
+        # tokens prefill_cont can append after a prefilled prefix of prefix_len tokens. Without compact_every, ShadowKV
+        # appends into the local window next to the prompt tail, see append_cont
+        if isinstance(self.kv_cache, ShadowKVCache_CPU) and self.kv_cache.compact_every is None:
+            return self.kv_cache.tail_capacity() - self.kv_cache.prefill_local_len(prefix_len)
+        return self.max_length - prefix_len
+
+    @torch.inference_mode()
+    def prefill_with_prefix_cache(self, input_ids: torch.LongTensor, prefix_len: int = None):
+        """prefill that reuses the cached context of the longest known prefix and only runs the suffix"""
+        seq_len = input_ids.shape[-1]
+        entry = self.prefix_cache.lookup(input_ids, max_suffix_len=self.max_cont_len)
+
+        if entry is not None:
+            self.kv_cache.restore(entry.state)
+            if entry.length == seq_len:
+                logits = entry.logits.to(self.device)
+            else:
+                self.kv_cache.H2D()
+                logits = self.prefill_cont(input_ids[:, entry.length:])[:, -1:]
+        else:
+            # cache the shared part (e.g. the document) on its own so that other queries can reuse it
+            min_prefix_len = 1 if isinstance(self.kv_cache, KV_Cache) else 4*1024 + 1
+            if prefix_len is None or not (min_prefix_len <= prefix_len < seq_len) or seq_len - prefix_len > self.max_cont_len(prefix_len):
+                prefix_len = seq_len
+            self.kv_cache.clear()
+            prefix_ids = input_ids[:, :prefix_len]
+            logits = self.inference(input_ids=prefix_ids, position_ids=self.get_ctx(prefix_ids))[:, -1:]
+            self.prefix_cache.insert(prefix_ids, self.kv_cache.snapshot(), logits)
+            if prefix_len < seq_len:
+                self.kv_cache.H2D()
+                logits = self.prefill_cont(input_ids[:, prefix_len:])[:, -1:]
+
+        assert self.kv_cache.get_kv_len() == seq_len, f"KV length mismatch, got {self.kv_cache.get_kv_len()}, expected {seq_len}"
+        return logits
+
     @torch.inference_mode()
     def prefill_cont(self, input_ids: torch.LongTensor):
+        if isinstance(self.kv_cache, ShadowKVCache_CPU):
+            return self.append_cont(input_ids)
         logits = self.inference(input_ids=input_ids, position_ids=self.get_ctx(input_ids))
         return logits
+
+    @torch.inference_mode()
+    def append_cont(self, input_ids: torch.LongTensor):
+        # a follow-up turn goes through the decode path in multi-token steps of at most cont_step_len tokens, each
+        # step retrieves chunks for all its tokens at once. The local window bounds a step, with compact_every it
+        # is folded between steps so that turns longer than the window fit
+        cache = self.kv_cache
+        if cache.compact_every is None and input_ids.size(1) > cache.append_room():
+            raise ValueError(f"Cannot append {input_ids.size(1)} tokens, the local window has room for {cache.append_room()}, enable compact_every to fold it")
+        start = 0
+        while start < input_ids.size(1):
+            step_len = min(self.cont_step_len, cache.append_room(), input_ids.size(1) - start)
+            if step_len <= 0:
+                raise ValueError(f"The local window is full after {start} of {input_ids.size(1)} appended tokens, enable compact_every to fold it")
+            step_ids = input_ids[:, start:start + step_len]
+            logits = self.inference(input_ids=step_ids, position_ids=self.get_ctx(step_ids))
+            start += step_len
+        return logits[:, -1:]
     
     def encode(self, text: str, template=None, truncation=False):
         if template == 'chat':
@@ -105,8 +231,11 @@ class LLM:
             hidden_states: torch.FloatTensor, 
             position_ids: torch.LongTensor):
 
-        residual = hidden_states
         bsz, q_len, _ = hidden_states.size()
+        if self.prefill_window is not None and q_len > 4*1024 and isinstance(self.kv_cache, ShadowKVCache_CPU):
+            return self.streaming_prefill_layer(buffer, layer_idx, hidden_states, position_ids)
+
+        residual = hidden_states
         query_states, key_states, value_states = self.pre_attention_compute(
             hidden_states,
             buffer,
@@ -138,6 +267,11 @@ class LLM:
                     hidden_states = flash_attn_with_kvcache(q=query_states.transpose(1, 2), k_cache=key_states.transpose(1, 2), v_cache=value_states.transpose(1, 2), causal=True)
 
             else: # decode
+                token_position_ids = position_ids
+                # keep the low-rank factors of new tokens, RoPE may be applied in place below
+                if isinstance(self.kv_cache, ShadowKVCache_CPU) and self.kv_cache.compact_every is not None:
+                    self.kv_cache.project_keys(key_states, layer_idx)
+
                 # rope query and key
                 query_states, key_states = self.apply_rotary_pos_emb(query_states, key_states, position_ids)
 
@@ -147,21 +281,29 @@ class LLM:
                 # get retrieval idx
                 position_ids = self.kv_cache.get_retrieval_position_ids(layer_idx=layer_idx, query_states=query_states)
 
-                # multi-stream
-                curr_stream = torch.cuda.current_stream()
+                # multi-stream (sequential when running without CUDA)
                 get_value_stream = self.kv_cache.copy_stream
-
-                with torch.cuda.stream(get_value_stream):
-                    get_value_stream.wait_stream(curr_stream)
+                if get_value_stream is not None:
+                    curr_stream = torch.cuda.current_stream()
+                    with torch.cuda.stream(get_value_stream):
+                        get_value_stream.wait_stream(curr_stream)
+                        value_states = self.kv_cache.get_value_cache(layer_idx, position_ids)
+                else:
                     value_states = self.kv_cache.get_value_cache(layer_idx, position_ids)
 
                 # gather key cache from GPU and RoPE it (should be hide by CPU offloading time)
                 key_states = self.kv_cache.get_key_cache(layer_idx=layer_idx, position_ids=position_ids, rope_func=self.apply_rotary_pos_emb_single, cos_sin_cache=self.cos_sin_cache)
 
-                curr_stream.wait_stream(get_value_stream)
+                if get_value_stream is not None:
+                    curr_stream.wait_stream(get_value_stream)
 
-                # flash attention
-                hidden_states = flash_attn_with_kvcache(q=query_states.transpose(1, 2), k_cache=key_states.transpose(1, 2), v_cache=value_states.transpose(1, 2), causal=True)
+                # overlap the value transfer of the next layer with this layer's attention and MLP
+                if isinstance(self.kv_cache, ShadowKVCache_CPU) and self.kv_cache.layer_prefetch and layer_idx + 1 < self.num_layers:
+                    self.prefetch_next_layer(layer_idx, residual, token_position_ids)
+
+                # flash attention, ShadowKV_CPU slots are valid up to their own length
+                cache_seqlens = self.kv_cache.get_cache_seqlens(layer_idx) if isinstance(self.kv_cache, ShadowKVCache_CPU) else None
+                hidden_states = flash_attn_with_kvcache(q=query_states.transpose(1, 2), k_cache=key_states.transpose(1, 2), v_cache=value_states.transpose(1, 2), cache_seqlens=cache_seqlens, causal=True)
 
         else:
             raise ValueError(f"Invalid attention mode {self.attn_mode}")
@@ -185,11 +327,62 @@ class LLM:
         
         return hidden_states
 
+    def enable_streaming_prefill(self, window: int = 32*1024):
+        if not isinstance(self.kv_cache, ShadowKVCache_CPU):
+            raise ValueError(f"Streaming prefill is only supported with attn_mode shadowkv_cpu, got {self.attn_mode}")
+        if window % self.kv_cache.chunk_size != 0:
+            raise ValueError(f"Prefill window {window} must be a multiple of chunk_size {self.kv_cache.chunk_size}")
+        self.prefill_window = window
+
+    @torch.inference_mode()
+    def streaming_prefill_layer(self,
+            buffer,
+            layer_idx :int,
+            hidden_states: torch.FloatTensor,
+            position_ids: torch.LongTensor):
+        """ShadowKV prefill of one layer in windows of self.prefill_window tokens.
+
+        Only the keys and values of the current layer are kept at full length; queries, the float
+        key matrix for the SVD, landmark statistics and MLP activations are window sized.
+        hidden_states is updated in place.
+        """
+        bsz, q_len, _ = hidden_states.size()
+        window = self.prefill_window
+        key_cache = torch.empty(bsz, q_len, self.num_key_value_heads, self.head_dim, device=hidden_states.device, dtype=hidden_states.dtype)
+        value_cache = torch.empty_like(key_cache)
+        self.kv_cache.begin_stream_prefill(layer_idx, bsz, q_len, hidden_states.device)
+
+        # pass 1: pre-RoPE keys, Gram matrix and value offloading
+        for start in range(0, q_len, window):
+            end = min(start + window, q_len)
+            _, key_states, value_states = self.pre_attention_compute(hidden_states[:, start:end], buffer, self.num_heads, self.num_key_value_heads, self.head_dim)
+            key_states = key_states.transpose(1, 2) if key_states.dim() == 4 else key_states.view(bsz, end - start, self.num_key_value_heads, self.head_dim)
+            key_cache[:, start:end].copy_(key_states)
+            value_cache[:, start:end].copy_(value_states.transpose(1, 2))
+            self.kv_cache.stream_prefill_keys(layer_idx, key_cache[:, start:end].view(bsz, end - start, -1), value_states, start)
+
+        self.kv_cache.stream_prefill_svd(layer_idx, key_cache.view(bsz, q_len, -1))
+
+        # pass 2: RoPE keys in place, landmarks and attention, window by window
+        for start in range(0, q_len, window):
+            end = min(start + window, q_len)
+            query_states, key_states, _ = self.pre_attention_compute(hidden_states[:, start:end], buffer, self.num_heads, self.num_key_value_heads, self.head_dim)
+            query_states, key_states = self.apply_rotary_pos_emb(query_states, key_states, position_ids[:, start:end])
+            key_cache[:, start:end].copy_(key_states.transpose(1, 2))
+            self.kv_cache.stream_prefill_landmarks(key_states, start)
+
+            attn_output = flash_attn_with_kvcache(q=query_states.transpose(1, 2), k_cache=key_cache[:, :end], v_cache=value_cache[:, :end], causal=True)
+            hidden_states[:, start:end] = self.post_attention_compute(attn_output.reshape(bsz, end - start, self.hidden_size), hidden_states[:, start:end], buffer)
+
+        self.kv_cache.prefill_kv_cache(value_cache.transpose(1, 2), layer_idx, key_cache.transpose(1, 2), query_states[:, :, -1:], streamed=True)
+        self.kv_cache.end_stream_prefill()
+        return hidden_states
+
     def decode(self, input_ids: torch.Tensor, skip_special_tokens: bool = False):
         return self.tokenizer.batch_decode(input_ids, skip_special_tokens=skip_special_tokens)
 
     @torch.inference_mode()
-    def generate(self, input_ids: torch.Tensor, gen_len: int = 256, temperature: float = 0.0, top_p: float = 0.9, top_k :int = 50, verbose: bool = False, benchmark: bool = False, cont: bool = False):
+    def generate(self, input_ids: torch.Tensor, gen_len: int = 256, temperature: float = 0.0, top_p: float = 0.9, top_k :int = 50, verbose: bool = False, benchmark: bool = False, cont: bool = False, prefix_len: int = None):
         """accuracy eval usage, not for throughput eval"""
         assert type(input_ids) == torch.Tensor, f"input_ids must be a torch.Tensor, got {type(input_ids)}"
 
@@ -197,7 +390,7 @@ class LLM:
         if cont == False:
             if input_ids.size(1) > self.max_length:
                 raise ValueError(f"Input length must be less than {self.max_length}, but got {input_ids.size(1)}")
-            logits = self.prefill(input_ids)
+            logits = self.prefill(input_ids, prefix_len=prefix_len)
         else:
             if input_ids.size(1) + self.kv_cache.get_kv_len() >= self.max_length:
                 raise ValueError(f"Input length must be less than {self.max_length}, but got {input_ids.size(1)}")
@@ -215,7 +408,7 @@ class LLM:
             start = time.time()
         
         while n < gen_len:
-            logits = self.inference(input_ids=next_token, position_ids=self.get_ctx(next_token))
+            logits = self.decode_step(next_token)
             next_token = sample_token(logits[:, -1, :], temperature=temperature, top_p=top_p, top_k=top_k)
             
             n += 1
@@ -254,16 +447,16 @@ class LLM:
             print(f"\nPrefill {input_ids.size(1)} tokens | Generate {n} tokens in {round(end - start, 2)}s, {round(n / (end - start), 2)} tokens/s | cached {self.kv_cache.get_kv_len()}\n")
 
         # feed new token to the model
-        self.inference(input_ids=next_token, position_ids=self.get_ctx(next_token))
+        self.decode_step(next_token)
 
-        gc.collect()
-        torch.cuda.empty_cache()
-        torch.cuda.synchronize()
+        self.release_memory()
 
         return [self.tokenizer.decode(generated_ids, skip_special_tokens=True)]
     
     @torch.inference_mode()
     def batch_prefill(self, input_ids: torch.Tensor, benchmark: bool = False):
+        if isinstance(input_ids, (list, tuple)):
+            return self.ragged_batch_prefill(input_ids)
         self.kv_cache.clear()
         batch_size = input_ids.size(0)
         
@@ -274,18 +467,82 @@ class LLM:
         
         logits = torch.zeros(batch_size, 1, self.vocab_size, device=self.device, dtype=torch.float32)
 
-        if input_ids.shape[-1] > 120*1024 and input_ids.shape[-1] < 200*1024:
-            T = 8
-        else:
-            T = 4
-        # for bsz in range(0, batch_size, T):
-        for bsz in tqdm(range(0, batch_size, T), desc=f"Prefilling (batch size={batch_size})"):
+        # sub-batches of whole prompts, each as large as the free GPU memory allows
+        if self.prefill_planner is None:
+            self.set_prefill_planner()
+        planner = self.prefill_planner
+        planner.reset()
+        seq_len = input_ids.shape[-1]
+        progress = tqdm(total=batch_size, desc=f"Prefilling (batch size={batch_size})")
+        bsz = 0
+        while bsz < batch_size:
+            T = planner.sub_batch_size(batch_size - bsz, seq_len)
+            planner.begin()
             req_input_ids = input_ids[bsz:bsz+T]
             logits[bsz:bsz+T].copy_(self.inference(input_ids=req_input_ids, position_ids=self.get_ctx(req_input_ids)))
+            planner.end(bsz, T, seq_len)
+            progress.update(T)
+            bsz += T
+        progress.close()
+        if benchmark:
+            planner.print_stats()
         assert self.kv_cache.get_kv_len() == input_ids.shape[-1], f"KV length mismatch, got {self.kv_cache.get_kv_len()}, expected {input_ids.shape[-1]}"
 
         return logits
 
+    @torch.inference_mode()
+    def ragged_batch_prefill(self, input_ids: list):
+        """prefill a list of [1, seq] prompts of different lengths into the slots of a shadowkv_cpu batch"""
+        if not isinstance(self.kv_cache, ShadowKVCache_CPU):
+            raise ValueError(f"Ragged batches are only supported with attn_mode shadowkv_cpu, got {self.attn_mode}")
+        assert len(input_ids) == self.batch_size, f"batch_size mismatch, got {len(input_ids)}, expected {self.batch_size}"
+        for req_input_ids in input_ids:
+            if req_input_ids.size(1) > self.max_length:
+                raise ValueError(f"Input length must be less than {self.max_length}, but got {req_input_ids.size(1)}")
+
+        self.kv_cache.clear()
+        logits = torch.zeros(self.batch_size, 1, self.vocab_size, device=self.device, dtype=torch.float32)
+        # consecutive prompts of the same length share a forward
+        start = 0
+        while start < self.batch_size:
+            end = start + 1
+            while end < self.batch_size and end - start < 4 and input_ids[end].size(1) == input_ids[start].size(1):
+                end += 1
+            req_input_ids = torch.cat(input_ids[start:end], dim=0)
+            logits[start:end].copy_(self.inference(input_ids=req_input_ids, position_ids=self.get_ctx(req_input_ids)))
+            start = end
+        assert self.kv_cache.seq_lens == [ids.size(1) for ids in input_ids], f"KV length mismatch, got {self.kv_cache.seq_lens}"
+
+        return logits
+
+    def check_slot_prompt(self, input_ids: torch.LongTensor):
+        # a [1, seq] prompt that prefill_slot, or the first batch of a ContinuousBatcher, can prefill on its own
+        if not isinstance(self.kv_cache, ShadowKVCache_CPU):
+            raise ValueError(f"Slot prefill is only supported with attn_mode shadowkv_cpu, got {self.attn_mode}")
+        if input_ids.size(1) > self.max_length:
+            raise ValueError(f"Input length must be less than {self.max_length}, but got {input_ids.size(1)}")
+        if input_ids.size(1) <= 4*1024:
+            # shorter inputs take the decode branch of layer_compute
+            raise ValueError(f"ShadowKV prefill needs more than {4*1024} tokens, but got {input_ids.size(1)}")
+
+    @torch.inference_mode()
+    def prefill_slot(self, slot: int, input_ids: torch.LongTensor):
+        """prefill a [1, seq] prompt into a free slot of a decoding shadowkv_cpu batch, see models/scheduler.py"""
+        self.check_slot_prompt(input_ids)
+
+        self.kv_cache.prefill_slot(slot)
+        position_ids = torch.arange(input_ids.size(1), device=self.device, dtype=torch.long).unsqueeze(0)
+        logits = self.inference(input_ids=input_ids, position_ids=position_ids)
+        assert self.kv_cache.seq_lens[slot] == input_ids.size(1), f"KV length mismatch, got {self.kv_cache.seq_lens[slot]}, expected {input_ids.size(1)}"
+        return logits
+
+    def speculative_generate(self, input_ids: torch.Tensor, gen_len: int = 256, num_draft_tokens: int = 4, draft_budget: int = 256, draft=None, temperature: float = 0.0, top_p: float = -1, top_k :int = 50, benchmark: bool = False):
+        """batch_generate with speculative decoding, drafts from a draft_budget view of the cache or a draft model, see models/speculative.py"""
+        decoder = SpeculativeDecoder(self, draft=draft, draft_budget=draft_budget, num_draft_tokens=num_draft_tokens)
+        outputs = decoder.generate(input_ids, gen_len=gen_len, temperature=temperature, top_p=top_p, top_k=top_k, benchmark=benchmark)
+        if benchmark == True:
+            return outputs, decoder
+        return outputs
 
     @torch.inference_mode()
     def warmup(self):
@@ -300,14 +557,17 @@ class LLM:
 
     @torch.inference_mode()
     def batch_generate(self, input_ids: torch.Tensor, gen_len: int = 256, temperature: float = 0.0, top_p: float = -1, top_k :int = 50, verbose: bool = False, benchmark: bool = False, cont: bool = False):
-        """throughput eval usage"""
-        assert type(input_ids) == torch.Tensor, f"input_ids must be a torch.Tensor, got {type(input_ids)}"
+        """throughput eval usage, input_ids can be a list of [1, seq] prompts of different lengths (shadowkv_cpu)"""
+        ragged = isinstance(input_ids, (list, tuple))
+        assert ragged or type(input_ids) == torch.Tensor, f"input_ids must be a torch.Tensor, got {type(input_ids)}"
 
         # prefill
-        if cont == False:
+        if ragged:
+            logits = self.batch_prefill(input_ids)
+        elif cont == False:
             if input_ids.size(1) > self.max_length:
                 raise ValueError(f"Input length must be less than {self.max_length}, but got {input_ids.size(1)}")
-            logits = self.batch_prefill(input_ids)
+            logits = self.batch_prefill(input_ids, benchmark=benchmark)
         else:
             logits = self.prefill_cont(input_ids)
         
@@ -324,7 +584,7 @@ class LLM:
             start = time.time()
         
         while n < gen_len:
-            logits = self.inference(input_ids=next_token, position_ids=self.get_ctx(next_token))
+            logits = self.decode_step(next_token)
             next_token = sample_token(logits[:, -1, :], temperature=temperature, top_p=top_p, top_k=top_k)
             
             n += 1
@@ -332,14 +592,13 @@ class LLM:
 
         if benchmark == True:
             end = time.time()
-            print(f"\nPrefill {input_ids.size(1)} tokens | Generate {n} tokens in {round(end - start, 2)}s | Throughput: {round(self.batch_size * n / (end - start), 2)} tokens/s, Latency: {round((end - start)*1000 / n, 2)} ms/step | cached {self.kv_cache.get_kv_len()}\n")
+            prefill_len = max(ids.size(1) for ids in input_ids) if ragged else input_ids.size(1)
+            print(f"\nPrefill {prefill_len} tokens | Generate {n} tokens in {round(end - start, 2)}s | Throughput: {round(self.batch_size * n / (end - start), 2)} tokens/s, Latency: {round((end - start)*1000 / n, 2)} ms/step | cached {self.kv_cache.get_kv_len()}\n")
 
         # feed new token to the model
-        self.inference(input_ids=next_token, position_ids=self.get_ctx(next_token))
+        self.decode_step(next_token)
 
-        gc.collect()
-        torch.cuda.empty_cache()
-        torch.cuda.synchronize()
+        self.release_memory()
 
         generated_ids = torch.LongTensor(generated_ids).t().tolist()
 
@@ -0,0 +1,163 @@
+################################################################################
+#
+# Copyright 2024 ByteDance Ltd. and/or its affiliates. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+
+# Profile-driven sparse budget and rank allocation for ShadowKVCache_CPU
+#
+# A BudgetProfiler attached to the cache (cache.profiler) records, for every layer and kv head,
+# the landmark softmax of each retrieval: its normalized entropy and the attention mass captured
+# by the chunks a given map size would select. allocate_budget() then spends a fixed total of
+# sparse tokens greedily where it recovers the most missed mass, and picks per-layer ranks from
+# the key spectrum. All heads of a layer share one budget since the gather kernels and the
+# attention over the buffer need a uniform map size within a layer.
+
+import json
+import math
+import torch
+
+MAP_SIZES = (128, 256, 512, 1024)
+
+
+class BudgetProfiler:
+    def __init__(self, num_layers :int, num_heads :int, chunk_size :int = 8, map_sizes :tuple = MAP_SIZES) -> None:
+        self.num_layers = num_layers
+        self.num_heads = num_heads
+        self.chunk_size = chunk_size
+        self.map_sizes = tuple(map_sizes)
+
+        self.entropy = torch.zeros(num_layers, num_heads, dtype=torch.float64)
+        self.captured = torch.zeros(num_layers, num_heads, len(self.map_sizes), dtype=torch.float64)
+        self.counts = torch.zeros(num_layers, dtype=torch.float64)
+        self.energy = [None] * num_layers # [rank], cumulative key spectrum energy
+
+    def observe(self, layer_idx, probs):
+        # probs: landmark softmax [bsz, kv_heads, groups, chunks]
+        probs = probs.float()
+        n = probs.shape[-1]
+        entropy = -(probs * probs.clamp(min=1e-20).log()).sum(dim=-1) / math.log(max(n, 2)) # [bsz, kv_heads, groups]
+
+        # chunks are selected by their max score over the query group, see get_retrieval_position_ids
+        order = probs.max(dim=-2).values.argsort(dim=-1, descending=True) # [bsz, kv_heads, chunks]
+        cum_mass = probs.gather(dim=-1, index=order.unsqueeze(-2).expand_as(probs)).cumsum(dim=-1) # [bsz, kv_heads, groups, chunks]
+        captured = torch.stack([cum_mass[..., min(m, n) - 1] for m in self.map_sizes], dim=-1).mean(dim=-2) # [bsz, kv_heads, map_sizes]
+
+        self.entropy[layer_idx] += entropy.mean(dim=-1).sum(dim=0).double().cpu()
+        self.captured[layer_idx] += captured.sum(dim=0).double().cpu()
+        self.counts[layer_idx] += probs.shape[0]
+
+    def observe_spectrum(self, layer_idx, s):
+        # s: singular values of the pre-RoPE keys [bsz, rank]
+        energy = s.double().square().cumsum(dim=-1)
+        energy = (energy / energy[:, -1:].clamp(min=1e-20)).mean(dim=0).cpu()
+        self.energy[layer_idx] = energy if self.energy[layer_idx] is None else torch.minimum(self.energy[layer_idx], energy)
+
+    def head_entropy(self):
+        # [layers, kv_heads]
+        return self.entropy / self.counts.clamp(min=1).unsqueeze(-1)
+
+    def missed_mass(self):
+        # [layers, map_sizes], mean over heads of the attention mass outside the selected chunks
+        return 1.0 - (self.captured / self.counts.clamp(min=1).view(-1, 1, 1)).mean(dim=1)
+
+    def print_stats(self):
+        entropy = self.head_entropy()
+        missed = self.missed_mass()
+        for layer_idx in range(self.num_layers):
+            print(f"Layer {layer_idx:>2} | entropy {entropy[layer_idx].mean():.4f} (head min {entropy[layer_idx].min():.4f} max {entropy[layer_idx].max():.4f}) | missed mass " + " ".join(f"{m}:{missed[layer_idx, i]:.4f}" for i, m in enumerate(self.map_sizes)))
+
+
+def allocate_budget(profiler :BudgetProfiler, sparse_budget :int, energy :float = 0.99, rank :int = 160, rank_step :int = 32):
+    """Budget map with the same total sparse budget as a uniform `sparse_budget`.
+
+    Every layer starts at the smallest map size, then the upgrade with the largest drop in
+    missed attention mass per added token is applied until the total is spent. The rank of a
+    layer is the smallest multiple of `rank_step` (at most `rank`) that keeps `energy` of the
+    key spectrum observed during calibration.
+    """
+    cs = profiler.chunk_size
+    budgets = [m * cs for m in profiler.map_sizes]
+    total = sparse_budget * profiler.num_layers
+    if budgets[0] * profiler.num_layers > total:
+        raise ValueError(f"sparse_budget {sparse_budget} is below the smallest map size {profiler.map_sizes[0]} * chunk_size {cs}")
+    if profiler.counts.min() == 0:
+        raise ValueError("The profiler has not observed every layer, run a calibration first")
+
+    missed = profiler.missed_mass()
+    choice = [0] * profiler.num_layers
+    used = budgets[0] * profiler.num_layers
+    while True:
+        best, best_gain = None, 0.0
+        for layer_idx, c in enumerate(choice):
+            if c + 1 == len(budgets) or used + budgets[c + 1] - budgets[c] > total:
+                continue
+            gain = (missed[layer_idx, c] - missed[layer_idx, c + 1]).item() / (budgets[c + 1] - budgets[c])
+            if best is None or gain > best_gain:
+                best, best_gain = layer_idx, gain
+        if best is None:
+            break
+        used += budgets[choice[best] + 1] - budgets[choice[best]]
+        choice[best] += 1
+
+    ranks = []
+    for layer_idx in range(profiler.num_layers):
+        spectrum = profiler.energy[layer_idx]
+        if spectrum is None:
+            ranks.append(rank)
+            continue
+        needed = int((spectrum < energy).sum().item()) + 1
+        ranks.append(min(rank, max(rank_step, (needed + rank_step - 1) // rank_step * rank_step)))
+
+    return {
+        'chunk_size': cs,
+        'sparse_budget': [budgets[c] for c in choice],
+        'rank': ranks,
+        'entropy': profiler.head_entropy().mean(dim=-1).tolist(),
+        'missed_mass': [missed[layer_idx, c].item() for layer_idx, c in enumerate(choice)],
+    }
+
+
+def check_budget_map(budget_map, num_layers, chunk_size):
+    for key in ('sparse_budget', 'rank'):
+        if len(budget_map[key]) != num_layers:
+            raise ValueError(f"Budget map has {len(budget_map[key])} {key} entries, expected {num_layers}")
+    if budget_map.get('chunk_size', chunk_size) != chunk_size:
+        raise ValueError(f"Budget map was built for chunk_size {budget_map['chunk_size']}, got {chunk_size}")
+    for layer_idx, budget in enumerate(budget_map['sparse_budget']):
+        if budget % chunk_size != 0:
+            raise ValueError(f"Layer {layer_idx} sparse_budget {budget} is not a multiple of chunk_size {chunk_size}")
+
+
+def save_budget_map(path, budget_map):
+    with open(path, 'w') as f:
+        json.dump(budget_map, f, indent=2)
+
+
+def load_budget_map(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def calibrate(llm, prompts, gen_len :int = 32, map_sizes :tuple = MAP_SIZES):
+    """Run `llm.generate` on calibration prompts with a profiler attached to its ShadowKV cache."""
+    cache = llm.kv_cache
+    profiler = BudgetProfiler(cache.num_layers, cache.num_key_value_heads, cache.chunk_size, map_sizes)
+    cache.profiler = profiler
+    try:
+        for input_ids in prompts:
+            llm.generate(input_ids, gen_len=gen_len)
+    finally:
+        cache.profiler = None
+    return profiler
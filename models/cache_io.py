@@ -0,0 +1,167 @@
+################################################################################
+#
+# Copyright 2024 ByteDance Ltd. and/or its affiliates. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+
+# On-disk format of a prefilled ShadowKV context
+#
+#   magic (8 bytes) | version (uint32) | header length (uint64) | JSON header | padding
+#   layer 0 blob | layer 1 blob | ...
+#
+# Every tensor of a cache snapshot has the layer as its leading dim, or is a list with one
+# tensor per layer whose shapes may differ (per-layer budgets, see models/budget.py). The blob
+# of a layer is the concatenation of the layer slices of all tensors, each padded to
+# TENSOR_ALIGN bytes; blobs start on ALIGN boundaries
+# so uncompressed files can be memory-mapped and viewed without a copy.
+
+import os
+import json
+import torch
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+MAGIC = b'SHADOWKV'
+VERSION = 3
+ALIGN = 4096
+TENSOR_ALIGN = 64
+PREAMBLE = len(MAGIC) + 4 + 8
+
+_DTYPES = {
+    'bfloat16': torch.bfloat16,
+    'float16': torch.float16,
+    'float32': torch.float32,
+    'int32': torch.int32,
+    'int64': torch.int64,
+    'uint8': torch.uint8,
+    'int8': torch.int8,
+    'float8_e4m3fn': torch.float8_e4m3fn,
+}
+
+
+def _align(n, align=ALIGN):
+    return (n + align - 1) // align * align
+
+
+def _dtype_name(dtype):
+    return str(dtype).replace('torch.', '')
+
+
+def save_snapshot(path, state, meta, compression=None, level=3):
+    if compression not in (None, 'zstd'):
+        raise ValueError(f"Invalid compression {compression}")
+    if compression == 'zstd' and zstd is None:
+        raise ImportError("zstd compression requires the zstandard package")
+
+    def is_tensor(v):
+        return isinstance(v, torch.Tensor) or (isinstance(v, list) and len(v) > 0 and isinstance(v[0], torch.Tensor))
+
+    scalars = {k: v for k, v in state.items() if not is_tensor(v)}
+    # per-layer lists of contiguous slices
+    tensors = {k: [t.contiguous() for t in v] for k, v in state.items() if is_tensor(v)}
+    num_layers = meta['num_layers']
+    for name, t in tensors.items():
+        assert len(t) == num_layers, f"{name} has {len(t)} layers, expected {num_layers}"
+
+    blobs = []
+    layers = []
+    for layer_idx in range(num_layers):
+        blob = b''
+        for t in tensors.values():
+            raw = t[layer_idx].view(torch.uint8).numpy().tobytes()
+            blob += raw + bytes(_align(len(raw), TENSOR_ALIGN) - len(raw))
+        raw_nbytes = len(blob)
+        if compression == 'zstd':
+            blob = zstd.ZstdCompressor(level=level).compress(blob)
+        blobs.append(blob)
+        layers.append({'nbytes': len(blob), 'raw_nbytes': raw_nbytes})
+
+    header = {
+        'version': VERSION,
+        'compression': compression,
+        'meta': meta,
+        'scalars': scalars,
+        'tensors': [{'name': k, 'shapes': [list(x.shape) for x in t], 'dtype': _dtype_name(t[0].dtype)} for k, t in tensors.items()],
+        'layers': layers,
+    }
+    # offsets depend on the header length, so size the header with placeholders first
+    for layer in layers:
+        layer['offset'] = 0
+    offset = _align(PREAMBLE + len(json.dumps(header).encode()) + 32 * num_layers)
+    for layer in layers:
+        layer['offset'] = offset
+        offset = _align(offset + layer['nbytes'])
+    header_bytes = json.dumps(header).encode()
+    assert PREAMBLE + len(header_bytes) <= layers[0]['offset'], "header does not fit in the reserved space"
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(VERSION.to_bytes(4, 'little'))
+        f.write(len(header_bytes).to_bytes(8, 'little'))
+        f.write(header_bytes)
+        for layer, blob in zip(layers, blobs):
+            f.seek(layer['offset'])
+            f.write(blob)
+        f.truncate(offset)
+    os.replace(tmp_path, path)
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        preamble = f.read(PREAMBLE)
+        if len(preamble) != PREAMBLE or preamble[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a ShadowKV context file")
+        version = int.from_bytes(preamble[len(MAGIC):len(MAGIC) + 4], 'little')
+        if version != VERSION:
+            raise ValueError(f"Unsupported ShadowKV context version {version}, expected {VERSION}")
+        header_len = int.from_bytes(preamble[len(MAGIC) + 4:], 'little')
+        return json.loads(f.read(header_len).decode())
+
+
+def load_snapshot(path):
+    """Return (meta, state). Uncompressed layer slices are views of a private mmap of the file."""
+    header = read_header(path)
+    compression = header['compression']
+    if compression == 'zstd' and zstd is None:
+        raise ImportError("zstd compression requires the zstandard package")
+
+    if compression is None:
+        data = torch.from_file(path, shared=False, size=os.path.getsize(path), dtype=torch.uint8)
+        blobs = [data[layer['offset']:layer['offset'] + layer['nbytes']] for layer in header['layers']]
+    else:
+        blobs = []
+        with open(path, 'rb') as f:
+            for layer in header['layers']:
+                f.seek(layer['offset'])
+                raw = zstd.ZstdDecompressor().decompress(f.read(layer['nbytes']), max_output_size=layer['raw_nbytes'])
+                blobs.append(torch.frombuffer(bytearray(raw), dtype=torch.uint8))
+
+    # tensors are returned as lists of per-layer slices, restore() copies them layer by layer
+    state = dict(header['scalars'])
+    for t in header['tensors']:
+        state[t['name']] = []
+    for layer_idx, blob in enumerate(blobs):
+        start = 0
+        for t in header['tensors']:
+            dtype = _DTYPES[t['dtype']]
+            shape = t['shapes'][layer_idx]
+            nbytes = torch.Size(shape).numel() * torch.empty(0, dtype=dtype).element_size()
+            state[t['name']].append(blob[start:start + nbytes].view(dtype).view(shape))
+            start += _align(nbytes, TENSOR_ALIGN)
+
+    return header['meta'], state
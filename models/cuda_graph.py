@@ -0,0 +1,170 @@
+################################################################################
+#
+# Copyright 2024 ByteDance Ltd. and/or its affiliates. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+
+# CUDA graph capture of the shadowkv_cpu decode step
+#
+# A decode step launches a few hundred small kernels per layer, at small batch sizes the launch overhead
+# is a large part of the step. GraphDecoder records one full forward (q_len 1, whole batch) into a CUDA
+# graph and replays it: next_token and the position ids are copied into static input buffers, every
+# ShadowKV buffer the step reads (landmarks, U / SV, the GPU key and value buffers, offsets, per-slot
+# lengths) is persistent and updated in place. While capturing, the cache returns the key and value
+# buffers at full capacity (attention is bounded by cache_seqlens) and defers its host-side lengths to
+# advance_lens(), which runs after every replay.
+#
+# Whenever the cache reallocates one of these tensors (H2D, clear, a longer prompt in a slot, landmark
+# growth) it bumps layout_epoch and the next step is captured again. Steps the graph cannot express run
+# eagerly: the torch ops backend (nonzero syncs), value stores, compaction, top-p retrieval, telemetry
+# and profiling, prefill-sized inputs, and a local window about to outgrow the buffer.
+
+import time
+
+import torch
+
+from .kv_cache import ShadowKVCache_CPU
+from .shadowkv_ops import get_backend
+
+
+class GraphDecoder:
+    def __init__(self, llm) -> None:
+        self.llm = llm
+        self.kv_cache = llm.kv_cache
+        self.graph = None
+        self.epoch = None
+        self.pool = torch.cuda.graph_pool_handle() if torch.cuda.is_available() else None
+        self.static_input_ids = None
+        self.static_position_ids = None
+        self.static_logits = None
+
+        self.captures = 0
+        self.replays = 0
+        self.eager_steps = 0
+        self.fallback_reason = None
+        if isinstance(self.kv_cache, ShadowKVCache_CPU):
+            self.kv_cache.static_shapes = True
+
+    def release(self):
+        self.graph = None
+        self.static_logits = None
+        if isinstance(self.kv_cache, ShadowKVCache_CPU):
+            self.kv_cache.static_shapes = False
+
+    def unsupported(self, input_ids):
+        # reason to run this step eagerly, None if it can be replayed
+        cache = self.kv_cache
+        if not torch.cuda.is_available():
+            return "no CUDA device"
+        if not isinstance(cache, ShadowKVCache_CPU):
+            return f"attn_mode {self.llm.attn_mode}"
+        if get_backend() != 'cuda':
+            return "torch ops backend"
+        if input_ids.shape != (cache.batch_size, 1) or cache.prefilled_batch != cache.batch_size:
+            return f"input of shape {tuple(input_ids.shape)}"
+        if cache.value_store is not None:
+            return "value store"
+        if cache.compact_every is not None:
+            return "compaction"
+        if cache.retrieval_top_p is not None:
+            return "top-p retrieval"
+        if cache.stats is not None or cache.profiler is not None:
+            return "telemetry"
+        if cache.tail_max + 1 > cache.tail_capacity():
+            return "local window full"
+        return None
+
+    def eager(self, input_ids, reason):
+        self.eager_steps += 1
+        self.fallback_reason = reason
+        return self.llm.inference(input_ids=input_ids, position_ids=self.llm.get_ctx(input_ids))
+
+    @torch.inference_mode()
+    def __call__(self, input_ids):
+        reason = self.unsupported(input_ids)
+        if reason is not None:
+            return self.eager(input_ids, reason)
+
+        if self.graph is None or self.epoch != self.kv_cache.layout_epoch:
+            return self.capture(input_ids)
+
+        self.static_input_ids.copy_(input_ids)
+        self.static_position_ids.copy_(self.llm.get_ctx(input_ids))
+        self.graph.replay()
+        self.kv_cache.advance_lens(1)
+        self.replays += 1
+        return self.static_logits
+
+    def capture(self, input_ids):
+        # the warmup is a real eager step on a side stream (lazy cuBLAS / kernel init stays out of the graph),
+        # recording then runs nothing and leaves the cache as it is
+        self.graph = None
+        self.static_logits = None
+        position_ids = self.llm.get_ctx(input_ids)
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            logits = self.llm.inference(input_ids=input_ids, position_ids=position_ids)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self.static_input_ids = input_ids.clone()
+        self.static_position_ids = self.llm.get_ctx(input_ids).clone()
+        graph = torch.cuda.CUDAGraph()
+        self.kv_cache.capturing = True
+        try:
+            with torch.cuda.graph(graph, pool=self.pool):
+                self.static_logits = self.llm.inference(input_ids=self.static_input_ids, position_ids=self.static_position_ids)
+        finally:
+            self.kv_cache.capturing = False
+        self.graph = graph
+        self.epoch = self.kv_cache.layout_epoch
+        self.captures += 1
+        return logits
+
+    def print_stats(self):
+        print(f"GraphDecoder | captures {self.captures} | replays {self.replays} | eager steps {self.eager_steps}" + (f" | last fallback: {self.fallback_reason}" if self.fallback_reason is not None else ""))
+
+
+def time_decode(step, next_token, steps):
+    torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(steps):
+        logits = step(next_token)
+        next_token = logits[:, -1, :].argmax(dim=-1, keepdim=True)
+    torch.cuda.synchronize()
+    return (time.time() - start) * 1000 / steps, next_token
+
+
+@torch.inference_mode()
+def benchmark_decode(llm, input_ids, steps :int = 32):
+    """ms/step of eager and graph-replayed greedy decoding after a batch prefill of input_ids"""
+    cache = llm.kv_cache
+    logits = llm.batch_prefill(input_ids)
+    cache.H2D()
+    if cache.tail_max + 2 * steps + 1 > cache.tail_capacity():
+        raise ValueError(f"{2 * steps} decode steps do not fit in the local window, {cache.tail_capacity() - cache.tail_max} tokens left")
+    next_token = logits[:, -1, :].argmax(dim=-1, keepdim=True)
+
+    # the first steps of each mode are not timed (kernel init, graph capture)
+    next_token = llm.inference(input_ids=next_token, position_ids=llm.get_ctx(next_token))[:, -1, :].argmax(dim=-1, keepdim=True)
+    eager_ms, next_token = time_decode(lambda ids: llm.inference(input_ids=ids, position_ids=llm.get_ctx(ids)), next_token, steps - 1)
+
+    decoder = GraphDecoder(llm)
+    next_token = decoder(next_token)[:, -1, :].argmax(dim=-1, keepdim=True)
+    graph_ms, next_token = time_decode(decoder, next_token, steps - 1)
+    decoder.print_stats()
+    decoder.release()
+
+    print(f"Decode | batch {cache.batch_size} | eager {eager_ms:.2f} ms/step | CUDA graph {graph_ms:.2f} ms/step | speedup {eager_ms / graph_ms:.2f}x")
+    return eager_ms, graph_ms
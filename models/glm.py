@@ -26,9 +26,7 @@ from transformers.models.llama.modeling_llama import LlamaDecoderLayer
 
 transformers.logging.set_verbosity_error()
 
-import vllm
-
-from .tensor_op import layer_norm
+from .tensor_op import layer_norm, rotary_embedding, silu_and_mul
 from .prompt_template import Templates, Chat_Templates
 from .base import LLM
 
@@ -96,7 +94,8 @@ class GLM(LLM):
         sparse_budget: int = 2048,
         rank=160,
         chunk_size=8,
-        minference=False) -> None:
+        minference=False,
+        **kv_cache_kwargs) -> None:
         
         self.batch_size = batch_size
         self.device = device
@@ -125,7 +124,7 @@ class GLM(LLM):
 
         self.vocab_size = self.config.vocab_size
 
-        self.init_kv_cache(sparse_budget, rank, chunk_size, GLMConfig(self.config))
+        self.init_kv_cache(sparse_budget, rank, chunk_size, GLMConfig(self.config), **kv_cache_kwargs)
 
     def _set_cos_sin_cache(self, hf_model):
         return hf_model.transformer.rotary_pos_emb(self.max_length + 1024).to(self.device).transpose(-1, -2).contiguous().view(-1, 64)
@@ -188,7 +187,7 @@ class GLM(LLM):
         d = hidden_states.shape[-1] // 2
         output_shape = (hidden_states.shape[:-1] + (d, ))
         out = torch.empty(output_shape, dtype=hidden_states.dtype, device=hidden_states.device)
-        vllm._custom_ops.silu_and_mul(out, hidden_states)
+        silu_and_mul(out, hidden_states)
         
         hidden_states = F.linear(out, buffer.down_proj)
         hidden_states = residual + hidden_states
@@ -196,7 +195,7 @@ class GLM(LLM):
 
     @torch.inference_mode()
     def apply_rotary_pos_emb(self, q: torch.Tensor, k: torch.Tensor, position_ids: torch.Tensor) -> torch.Tensor:
-        vllm._custom_ops.rotary_embedding(position_ids, q, k, 128, self.cos_sin_cache, False)
+        rotary_embedding(position_ids, q, k, 128, self.cos_sin_cache, False)
         bsz = q.shape[0]
         q = q.view(bsz, -1, self.num_heads, self.head_dim).transpose(1, 2)
         k = k.view(bsz, -1, self.num_key_value_heads, self.head_dim).transpose(1, 2)
@@ -0,0 +1,118 @@
+################################################################################
+#
+# Copyright 2024 ByteDance Ltd. and/or its affiliates. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+
+# Asynchronous device to host writes into pageable tensors
+#
+# A copy from the GPU into pageable host memory blocks the host until the stream has caught up. The prefill
+# artifacts of ShadowKVCache_CPU (U, SV and the landmarks of every layer) live in pageable tensors, so each
+# layer used to wait for its own compute before the next one was launched. StagedHostWriter collects the
+# copies of one layer (stage), then commits them as a group: the sources are packed into the next of
+# num_buffers pinned staging buffers on a dedicated stream, after the current stream has produced them,
+# and an event is recorded. The host copies the staging buffer into the destinations only when the buffer
+# comes around again or at flush(), so the transfer of layer L overlaps the compute of layer L+1.
+# Without CUDA, or for destinations on the device, stage copies right away.
+
+import time
+
+import torch
+
+ALIGN = 256
+
+
+class StagedHostWriter:
+    def __init__(self, num_buffers :int = 2) -> None:
+        if num_buffers < 1:
+            raise ValueError(f"num_buffers must be at least 1, got {num_buffers}")
+        self.stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+        self.buffers = [None] * num_buffers # pinned uint8, grown on demand
+        self.events = [None] * num_buffers
+        self.pending = [[] for _ in range(num_buffers)] # (destination, staged view) to copy on the host
+        self.idx = 0
+        self.group = [] # (destination, source) staged since the last commit
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.commits = 0
+        self.bytes = 0
+        self.wait_time = 0.0
+
+    def stage(self, dst, src):
+        # dst.copy_(src), deferred when dst is on the host and src on the GPU
+        if self.stream is None or not src.is_cuda or dst.is_cuda:
+            dst.copy_(src)
+            return
+        self.group.append((dst, src))
+
+    def commit(self):
+        # issue the staged copies as one transfer into the next staging buffer
+        if len(self.group) == 0:
+            return
+        group, self.group = self.group, []
+        slot = self.idx
+        self.idx = (slot + 1) % len(self.buffers)
+        self.drain(slot)
+
+        sizes = [(src.numel() * src.element_size() + ALIGN - 1) // ALIGN * ALIGN for _, src in group]
+        if self.buffers[slot] is None or self.buffers[slot].numel() < sum(sizes):
+            self.buffers[slot] = None
+            self.buffers[slot] = torch.empty(sum(sizes), dtype=torch.uint8, device='cpu', pin_memory=True)
+
+        self.stream.wait_stream(torch.cuda.current_stream())
+        offset = 0
+        with torch.cuda.stream(self.stream):
+            for (dst, src), size in zip(group, sizes):
+                nbytes = src.numel() * src.element_size()
+                staged = self.buffers[slot][offset:offset + nbytes].view(src.dtype).view(src.shape)
+                staged.copy_(src, non_blocking=True)
+                src.record_stream(self.stream)
+                self.pending[slot].append((dst, staged))
+                offset += size
+            event = torch.cuda.Event()
+            event.record()
+        self.events[slot] = event
+        self.commits += 1
+        self.bytes += offset
+
+    def drain(self, slot):
+        # wait for the transfer that last used the buffer and hand its data to the destinations
+        if self.events[slot] is None:
+            return
+        start = time.time()
+        self.events[slot].synchronize()
+        self.wait_time += time.time() - start
+        self.events[slot] = None
+        for dst, staged in self.pending[slot]:
+            dst.copy_(staged)
+        self.pending[slot] = []
+
+    def flush(self):
+        # everything staged so far is in its destination, call before the host reads or reallocates one
+        self.commit()
+        for i in range(len(self.buffers)):
+            self.drain((self.idx + i) % len(self.buffers))
+
+    def discard(self):
+        # the destinations were dropped: forget the pending host copies, the transfers still finish before reuse
+        self.group = []
+        self.pending = [[] for _ in self.buffers]
+
+    def release(self):
+        self.flush()
+        self.buffers = [None] * len(self.buffers)
+
+    def print_stats(self):
+        print(f"StagedHostWriter | {len(self.buffers)} buffers | {self.commits} transfers | {self.bytes / 1024**3:.3f} GB | host waited {self.wait_time:.3f}s")
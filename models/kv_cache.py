@@ -18,12 +18,25 @@
 import torch
 import math
 import gc
+import copy
 from torch import nn
-from models.tensor_op import batch_gather_gemm_rotary_pos_emb_cuda
-from kernels import shadowkv
+from models.tensor_op import batch_gather_gemm_rotary_pos_emb_cuda, batch_gather_gemm_dequant_rotary_pos_emb
+from models.shadowkv_ops import shadowkv
+from models.value_store import MmapValueStore, QuantizedValueStore
+from models.host_staging import StagedHostWriter
+from models.cache_io import save_snapshot, load_snapshot
+from models.landmarks import chunk_landmarks, split_outliers, build_landmarks
+from models.prefill_planner import prefill_bytes_per_token, config_intermediate_size
+from models.svd import low_rank_svd, gram_svd, svd_accuracy_report
+from models.memory_plan import layer_budgets, outlier_chunks, shadowkv_artifact_bytes
+from models.telemetry import CacheStats
+from models.quant import ROW_QUANT_METHODS, quantize_rows, dequantize_rows
 
 class KV_Cache:
     """Full Attention"""
+    # gc and CUDA cache release in H2D(), see LLM.set_memory_cleanup
+    memory_cleanup = True
+
     def __init__(self, 
         config :object,
         batch_size :int = 1,
@@ -93,9 +106,11 @@ class KV_Cache:
         print(f"KVCache | max_length {self.max_length} | dtype {self.dtype} | cached {self.kv_offset}")
 
     def H2D(self):
-        gc.collect()
-        torch.cuda.empty_cache()
-        torch.cuda.synchronize()
+        if self.memory_cleanup:
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+                torch.cuda.synchronize()
         self.k_cache = self.k_cache.to(self.device)
         self.v_cache = self.v_cache.to(self.device)
 
@@ -103,6 +118,20 @@ class KV_Cache:
         self.kv_offset = 0
         self.prefilled_batch = 0
 
+    def snapshot(self):
+        # host copy of the cached context, see models/prefix_cache.py
+        return {
+            'kv_offset': self.kv_offset,
+            'k_cache': self.k_cache[:, :, :, :self.kv_offset].to('cpu', copy=True),
+            'v_cache': self.v_cache[:, :, :, :self.kv_offset].to('cpu', copy=True),
+        }
+
+    def restore(self, state):
+        self.clear()
+        self.kv_offset = state['kv_offset']
+        self.k_cache[:, :, :, :self.kv_offset].copy_(state['k_cache'])
+        self.v_cache[:, :, :, :self.kv_offset].copy_(state['v_cache'])
+
     def get_kv_len(self):
         return self.kv_offset
 
@@ -187,7 +216,7 @@ class ShadowKVCache:
         self.U = None
         self.SV = None
 
-        self.copy_stream = torch.cuda.Stream()
+        self.copy_stream = torch.cuda.Stream() if torch.cuda.is_available() else None
 
     def print_stats(self):
         print(f"ShadowKV | sparse budget {self.sparse_budget} | chunk size {self.chunk_size} |rank {self.rank} | cached {self.kv_offset} | local_chunk {self.local_chunk} | outlier_chunk {self.outlier_chunk}")
@@ -245,13 +274,10 @@ class ShadowKVCache:
         self.v_cache_buffer[layer_idx][:, :, :self.prefill_local].copy_(new_v_cache[:, :, -self.prefill_local:])
 
         key_states_roped_ctx = key_states_roped[:,:,:self.chunks*self.chunk_size].view(self.batch_size, self.num_key_value_heads, self.chunks, self.chunk_size, self.head_dim)
-        landmark_candidates = key_states_roped_ctx.mean(dim=-2) # [bsz, kv_heads, chunks, head_dim]
-        
-        # compute the cos similarity between it and the original key cache
-        cos_sim = torch.nn.functional.cosine_similarity(landmark_candidates.unsqueeze(3).expand(-1, -1, -1, self.chunk_size, -1), key_states_roped_ctx, dim=-1) # [bsz, kv_heads, chunks, chunk_size]
+        landmark_candidates, chunk_min_sim = chunk_landmarks(key_states_roped_ctx) # [bsz, kv_heads, chunks, head_dim], [bsz, kv_heads, chunks]
         
-        # get the outlier_chunk idx for each head # [bsz, kv_heads, outlier_chunk]
-        outlier_chunk_idx = cos_sim.min(dim=-1).values.topk(self.outlier_chunk, largest=False).indices
+        # get the outlier_chunk idx for each head [bsz, kv_heads, outlier_chunk] and the rest [bsz, kv_heads, chunks - outlier_chunk]
+        outlier_chunk_idx, rest_idx = split_outliers(chunk_min_sim, self.outlier_chunk)
     
         # [bsz, kv_heads, chunks, chunk_size, head_dim] --gather[bsz, kv_heads, outlier_chunk]-->[bsz, kv_heads, outlier_chunk, chunk_size, head_dim]
         outlier_chunk_k_cache = key_states_roped_ctx.gather(dim=2, index=outlier_chunk_idx.unsqueeze(-1).unsqueeze(-1).expand(-1, -1, -1, self.chunk_size, self.head_dim)).view(self.batch_size, self.num_key_value_heads, self.outlier_chunk*self.chunk_size, self.head_dim)
@@ -265,15 +291,8 @@ class ShadowKVCache:
         self.k_cache_buffer[layer_idx][:, :, self.prefill_local:self.sparse_start].copy_(outlier_chunk_k_cache)
         self.v_cache_buffer[layer_idx][:, :, self.prefill_local:self.sparse_start].copy_(outlier_chunk_v_cache)
 
-        # filter landmark_candidates using outlier_chunk and register the rest to k_landmark
-        # [bsz, kv_heads, chunks, head_dim] --> [bsz, kv_heads, chunks - outlier_chunk, head_dim]
-        # get rest_idx: [bsz, kv_heads, chunks] --filter--> [bsz, kv_heads, chunks - outlier_chunk]
-        all_idx = torch.arange(self.chunks, device=key_states_roped.device).unsqueeze(0).unsqueeze(0).expand(self.batch_size, self.num_key_value_heads, -1) # [bsz, kv_heads, chunks]
-        mask = torch.ones_like(all_idx, dtype=torch.bool)
-        mask.scatter_(dim=-1, index=outlier_chunk_idx, value=False)
-        rest_idx = all_idx.masked_select(mask).view(self.batch_size, self.num_key_value_heads, -1)
-
         # register rest_idxed landmarks to k_landmark
+        # [bsz, kv_heads, chunks, head_dim] --> [bsz, kv_heads, chunks - outlier_chunk, head_dim]
         self.register_k_landmark(landmark_candidates.gather(dim=2, index=rest_idx.unsqueeze(-1).expand(-1, -1, -1, self.head_dim)).view(self.batch_size, self.num_key_value_heads, -1, self.head_dim), rest_idx, layer_idx)
 
         if layer_idx == self.num_layers - 1:
@@ -348,9 +367,8 @@ class ShadowKVCache:
             self.gen_offset += incoming
 
     def clear(self):
-        self.k_cache_buffer.zero_()
-        self.v_cache_buffer.zero_()
-        self.selected_chunk_idx.zero_()
+        # O(1), nothing is zeroed: decoding only reads the buffers up to sparse_end + gen_offset and prefill
+        # rewrites all of it (local window, outliers, sparse region) before the first read
         self.k_landmark = None
         self.k_landmark_idx = None
         self.U = None
@@ -360,6 +378,42 @@ class ShadowKVCache:
         self.prefill = 0
         self.gen_offset = 0
         self.prefill_local = 0
+
+    def snapshot(self):
+        cached = self.sparse_end + self.gen_offset
+        return {
+            'kv_offset': self.kv_offset,
+            'prefill': self.prefill,
+            'gen_offset': self.gen_offset,
+            'chunks': self.chunks,
+            'select_sets': self.select_sets,
+            'prefill_local': self.prefill_local,
+            'sparse_start': self.sparse_start,
+            'sparse_end': self.sparse_end,
+            'U': self.U.to('cpu', copy=True),
+            'SV': self.SV.to('cpu', copy=True),
+            'k_landmark': self.k_landmark.to('cpu', copy=True),
+            'k_landmark_idx': self.k_landmark_idx.to('cpu', copy=True),
+            'selected_chunk_idx': self.selected_chunk_idx.to('cpu', copy=True),
+            'v_cache_cpu': self.v_cache_cpu[:, :, :, :self.prefill].to('cpu', copy=True),
+            'k_cache_buffer': self.k_cache_buffer[:, :, :, :cached].to('cpu', copy=True),
+            'v_cache_buffer': self.v_cache_buffer[:, :, :, :cached].to('cpu', copy=True),
+        }
+
+    def restore(self, state):
+        self.clear()
+        for name in ['kv_offset', 'prefill', 'gen_offset', 'chunks', 'select_sets', 'prefill_local', 'sparse_start', 'sparse_end']:
+            setattr(self, name, state[name])
+        self.U = state['U'].to(self.device, copy=True)
+        self.SV = state['SV'].to(self.device, copy=True)
+        self.k_landmark = state['k_landmark'].to(self.device, copy=True)
+        self.k_landmark_idx = state['k_landmark_idx'].to(self.device, copy=True)
+        self.selected_chunk_idx.copy_(state['selected_chunk_idx'])
+
+        cached = state['k_cache_buffer'].shape[-2]
+        self.v_cache_cpu[:, :, :, :self.prefill].copy_(state['v_cache_cpu'])
+        self.k_cache_buffer[:, :, :, :cached].copy_(state['k_cache_buffer'])
+        self.v_cache_buffer[:, :, :, :cached].copy_(state['v_cache_buffer'])
     
     def H2D(self):
         pass
@@ -368,8 +422,25 @@ class ShadowKVCache:
         return self.kv_offset
 
 
+ARTIFACT_PLACEMENTS = ('auto', 'cpu', 'gpu')
+
+
+def grow_rows(x, n):
+    # [bsz, rows, ...] --> [bsz, n, ...] zero filled, also for float8 tensors
+    out = torch.zeros(x.shape[0], n, *x.shape[2:], device=x.device, dtype=x.dtype)
+    out[:, :x.shape[1]].copy_(x)
+    return out
+
+
+def sv_pinv(sv):
+    # least-squares projection onto the key basis: [bsz, 8, 128, 160] --> [bsz, 160, 1024] --> [bsz, 1024, 160]
+    return torch.linalg.pinv(sv.float().permute(0, 3, 1, 2).reshape(sv.shape[0], sv.shape[-1], -1))
+
+
 class ShadowKVCache_CPU:
     """ShadowKV, can be used for Llama-3-8B, Llama-3.1-8B, GLM-4-9B, Yi-200K"""
+    memory_cleanup = True
+
     def __init__(self, 
         config :object,
         batch_size :int = 1,
@@ -379,6 +450,17 @@ class ShadowKVCache_CPU:
         sparse_budget: int = 2048,
         chunk_size=8,
         rank=160,
+        offload_dir: str = None,
+        num_staging: int = 2,
+        svd_method: str = 'exact',
+        svd_report: bool = False,
+        compact_every: int = None,
+        budget_map = None,
+        retrieval_top_p: float = None,
+        collect_stats: bool = False,
+        value_quant: str = None,
+        u_quant: str = None,
+        artifact_placement: str = 'auto',
         ) -> None:
         
         self.config = config
@@ -391,55 +473,123 @@ class ShadowKVCache_CPU:
         self.num_attention_heads = config.num_attention_heads
         self.num_key_value_heads = config.num_key_value_heads
 
-        self.sparse_budget = int(sparse_budget)
         self.chunk_size = chunk_size
-        self.rank = rank
         self.local_chunk = 4
-        self.outlier_chunk = int((self.sparse_budget // 1024) * 24)
+        self.num_layers = config.num_hidden_layers
 
-        self.v_cache_cpu = torch.zeros(
+        # per-layer sparse budget and rank, uniform unless a budget map from models/budget.py is given
+        self.sparse_budgets, self.ranks = layer_budgets(self.num_layers, sparse_budget, rank, budget_map, self.chunk_size)
+        self.outlier_chunks = [outlier_chunks(b) for b in self.sparse_budgets]
+        self.layer_select_sets = [b // self.chunk_size for b in self.sparse_budgets]
+        # largest per-layer values, the shared scratch buffers are sized by them
+        self.sparse_budget = max(self.sparse_budgets)
+        self.rank = max(self.ranks)
+        self.outlier_chunk = max(self.outlier_chunks)
+        self.profiler = None
+
+        # top-p chunk selection, see select_top_p()
+        if retrieval_top_p is not None and not 0 < retrieval_top_p <= 1:
+            raise ValueError(f"retrieval_top_p must be in (0, 1], got {retrieval_top_p}")
+        self.retrieval_top_p = retrieval_top_p
+        self.selected_sum = 0
+        self.selected_capacity = 0
+
+        # cross-layer value prefetch, see prefetch_layer()
+        self.layer_prefetch = False
+        self.prefetched = [False] * self.num_layers
+        self.prefetch_lookups = 0
+        self.prefetch_misses = 0
+
+        # opt-in hit telemetry of the offload path, see models/telemetry.py
+        self.stats = CacheStats(self.num_layers, device=self.device) if collect_stats else None
+
+        # truncated SVD engine, see models/svd.py
+        self.svd_method = svd_method
+        self.svd_report = svd_report
+        self.svd_errors = []
+
+        # rolling compaction of generated tokens into the offloaded chunks, see compact()
+        if compact_every is not None and (compact_every % self.chunk_size != 0 or not 0 < compact_every <= 64):
+            raise ValueError(f"compact_every must be a multiple of chunk_size {self.chunk_size} and at most 64, got {compact_every}")
+        self.compact_every = compact_every
+        self.SV_pinv = None
+
+        # low-precision U on the GPU, quantized per row in H2D(), see models/quant.py
+        if u_quant is not None and u_quant not in ROW_QUANT_METHODS:
+            raise ValueError(f"Invalid u_quant {u_quant}, choose from {ROW_QUANT_METHODS}")
+        self.u_quant = u_quant
+        self.U_scale = None
+        self.u_quant_errors = []
+
+        # where prefill writes U, SV, landmarks and the retrieval scratch, see plan_placement()
+        if artifact_placement not in ARTIFACT_PLACEMENTS:
+            raise ValueError(f"Invalid artifact_placement {artifact_placement}, choose from {ARTIFACT_PLACEMENTS}")
+        self.artifact_placement = artifact_placement
+        self.artifact_device = 'cpu'
+
+        v_cache_cpu_shape = (
             config.num_hidden_layers,
             batch_size,
             config.num_key_value_heads,
             self.max_length // self.chunk_size,
             self.config.hidden_size // self.config.num_attention_heads * self.chunk_size,
-            device='cpu',
-            dtype=self.dtype,
-            pin_memory=True
         )
-
-        self.k_cache_buffer = torch.zeros(
-            config.num_hidden_layers,
+        self.value_quant = value_quant
+        if value_quant is not None:
+            # group-quantized rows, one (scale, offset) per token of a chunk, in RAM or on disk
+            self.value_store = QuantizedValueStore(v_cache_cpu_shape, self.dtype, value_quant, self.head_dim, self.sparse_budget // self.chunk_size, offload_dir=offload_dir, num_staging=num_staging, device=self.device)
+            self.v_cache_cpu = self.value_store.values
+        elif offload_dir is not None:
+            # disk-backed values, misses are staged through a small pinned ring
+            self.value_store = MmapValueStore(v_cache_cpu_shape, self.dtype, offload_dir, self.sparse_budget // self.chunk_size, num_staging=num_staging, device=self.device)
+            self.v_cache_cpu = self.value_store.values
+        else:
+            self.value_store = None
+            self.v_cache_cpu = torch.zeros(
+                *v_cache_cpu_shape,
+                device='cpu',
+                dtype=self.dtype,
+                pin_memory=torch.cuda.is_available()
+            )
+
+        # per layer [bsz, kv_heads, outlier | sparse_budget | prefill_local + generated, head_dim]
+        self.k_cache_buffer = [torch.zeros(
             batch_size,
             config.num_key_value_heads,
-            self.sparse_budget + 128 + (self.outlier_chunk+self.local_chunk)*self.chunk_size,
+            self.sparse_budgets[layer_idx] + 128 + (self.outlier_chunks[layer_idx]+self.local_chunk)*self.chunk_size,
             self.config.hidden_size // self.config.num_attention_heads,
             device=self.device,
             dtype=self.dtype
-        )
+        ) for layer_idx in range(self.num_layers)]
 
-        self.v_cache_buffer = torch.zeros(
-            config.num_hidden_layers,
+        self.v_cache_buffer = [torch.zeros(
             batch_size,
             config.num_key_value_heads,
-            self.sparse_budget + 128 + (self.outlier_chunk+self.local_chunk)*self.chunk_size,
+            self.sparse_budgets[layer_idx] + 128 + (self.outlier_chunks[layer_idx]+self.local_chunk)*self.chunk_size,
             self.config.hidden_size // self.config.num_attention_heads,
             device=self.device,
             dtype=self.dtype
-        )
+        ) for layer_idx in range(self.num_layers)]
 
-        self.num_layers = config.num_hidden_layers
-        self.kv_offset = 0
-        self.prefill = 0
-        self.gen_offset = 0
+        # per-slot lengths, see reset_lens()
+        self.batch_idx = torch.arange(batch_size, device=self.device).unsqueeze(-1)
+        self.kv_lens = torch.zeros(batch_size, device=self.device, dtype=torch.int64)
+        self.tail_lens = torch.zeros(batch_size, device=self.device, dtype=torch.int64)
+        self.active_mask = torch.ones(batch_size, device=self.device, dtype=torch.int64)
+        self.reset_lens()
 
         self.k_landmark = None
         self.k_landmark_idx = None
+        self.landmark_mask = [None] * self.num_layers
         self.U = None
         self.SV = None
+        self.gemm_o = None
+        self.max_landmarks = 0
+        self.max_q_len = 1
 
         self.select_sets = self.sparse_budget // self.chunk_size
-        assert self.select_sets * self.chunk_size == self.sparse_budget, f"({self.select_sets}) * {self.chunk_size} != {self.sparse_budget}"
+        for budget in self.sparse_budgets:
+            assert (budget // self.chunk_size) * self.chunk_size == budget, f"({budget // self.chunk_size}) * {self.chunk_size} != {budget}"
 
         self.temp = torch.zeros(
             self.batch_size, 
@@ -450,229 +600,742 @@ class ShadowKVCache_CPU:
             dtype=self.dtype
         ).contiguous()
 
-        # batch prefill record
+        # batch prefill record, slot_prefill is the slot written by a prefill_slot() forward
         self.prefilled_batch = 0
+        self.slot_prefill = None
+
+        # CUDA graph decode, see models/cuda_graph.py: layout_epoch changes whenever a tensor read by the decode
+        # step is reallocated, static_shapes returns full-capacity buffers, capturing defers the host-side lengths
+        self.layout_epoch = 0
+        self.static_shapes = False
+        self.capturing = False
 
         # v offload kernels
         self.block_num = int(self.batch_size * self.num_key_value_heads)
-        self.offsets = torch.zeros(self.block_num*(sparse_budget // chunk_size), device=self.device, dtype=torch.int32).contiguous()
+        self.offsets = torch.zeros(self.block_num*self.select_sets, device=self.device, dtype=torch.int32).contiguous()
         self.cnts = torch.zeros(self.block_num, device=self.device, dtype=torch.int32).contiguous()
         self.signals = torch.zeros(self.block_num, device=self.device, dtype=torch.int32).contiguous()
-        self.position_ids = torch.zeros(self.num_layers, self.batch_size, self.num_key_value_heads, self.select_sets, device=self.device, dtype=torch.int64).fill_(-1).contiguous()
+        self.position_ids = [torch.zeros(self.batch_size, self.num_key_value_heads, select_sets, device=self.device, dtype=torch.int64).fill_(-1).contiguous() for select_sets in self.layer_select_sets]
+        # select_top_p bitmap of the kept chunks, all zero between two calls
+        self.kept_map = torch.zeros(self.batch_size, self.num_key_value_heads, self.max_length // self.chunk_size, device=self.device, dtype=torch.int8) if retrieval_top_p is not None else None
+
+        # per-layer regions of the buffers, set by prefill_kv_cache
+        self.sparse_start = [0] * self.num_layers
+        self.sparse_end = [0] * self.num_layers
+        self.kernel_offset = [0] * self.num_layers
+        self.kernel_stride = [0] * self.num_layers
 
         # k compute kernels
         self.output = torch.zeros(
             self.batch_size, 
             self.num_key_value_heads, 
-            sparse_budget, 
+            self.sparse_budget, 
             self.head_dim, 
             device='cpu', 
             dtype=self.dtype
         ).contiguous()
 
         # multi-stream
-        self.copy_stream = torch.cuda.Stream()
+        self.copy_stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+        # prefill value writes still running on copy_stream, see write_values()
+        self.pending_host_copies = False
+        # U, SV and landmarks of each prefilled layer go to the host through pinned staging buffers
+        self.host_writer = StagedHostWriter(num_buffers=2)
+
+    @property
+    def kv_offset(self):
+        # longest cached sequence, every slot has this length unless the batch is ragged
+        return max(self.seq_lens) if self.prefilled_batch == self.batch_size else 0
+
+    def reset_lens(self):
+        # Slots of a ragged batch hold prompts of different lengths. The buffer of a slot is laid out as
+        # [outlier | sparse_budget | prefill_local + generated], so only the length of the tail differs between slots.
+        self.seq_lens = [0] * self.batch_size # cached tokens
+        self.prefill_lens = [0] * self.batch_size # prompt tokens
+        self.ctx_chunks = [0] * self.batch_size # offloaded chunks, a layer has ctx_chunks - outlier_chunks landmarks
+        self.local_lens = [0] * self.batch_size # prompt tokens in the local window
+        self.gen_lens = [0] * self.batch_size # generated tokens in the local window
+        self.active = [True] * self.batch_size # retired slots keep their length during decode, see reset_slot()
+        self.sync_lens()
+
+    def sync_lens(self):
+        # device copies used for positions, buffer writes and attention lengths
+        tails = [l + g for l, g in zip(self.local_lens, self.gen_lens)]
+        self.kv_lens.copy_(torch.tensor(self.seq_lens))
+        self.tail_lens.copy_(torch.tensor(tails))
+        self.active_mask.copy_(torch.tensor(self.active))
+        self.tail_max = max(tails)
+
+    def get_seq_lens(self):
+        # [bsz] cached tokens of each slot, the position of its next token
+        return self.kv_lens
+
+    def tail_capacity(self):
+        # tokens the local window (prefill local + generated) of a slot can hold in every layer, known before prefill
+        return min(v.shape[-2] - outlier * self.chunk_size - budget for v, outlier, budget in zip(self.v_cache_buffer, self.outlier_chunks, self.sparse_budgets))
+
+    def prefill_local_len(self, seq_len :int):
+        # tokens of a seq_len prompt that prefill keeps in the local window, as prefill_kv_cache splits it
+        chunks = seq_len // self.chunk_size - self.local_chunk
+        return seq_len - (chunks - chunks % 8) * self.chunk_size
+
+    def append_room(self):
+        # tokens every slot can still append before its local window is full
+        return self.tail_capacity() - self.tail_max
+
+    def get_cache_seqlens(self, layer_idx):
+        # [bsz] valid length of each slot in the buffers returned by get_key_cache / get_value_cache
+        tail = self.tail_lens if layer_idx == self.num_layers - 1 else self.tail_lens + self.incoming_q_len
+        return (tail + self.sparse_end[layer_idx]).to(torch.int32)
 
     def print_stats(self):
-        print(f"ShadowKV_CPU | sparse budget {self.sparse_budget} | chunk size {self.chunk_size} |rank {self.rank} | cached {self.kv_offset} | local_chunk {self.local_chunk} | outlier_chunk {self.outlier_chunk}")
+        print(f"ShadowKV_CPU | sparse budget {self.sparse_budget} | chunk size {self.chunk_size} |rank {self.rank} | cached {self.kv_offset} | local_chunk {self.local_chunk} | outlier_chunk {self.outlier_chunk} | prefill artifacts on {self.artifact_device}")
+        if len(set(self.seq_lens)) > 1:
+            print(f"Ragged batch | cached min {min(self.seq_lens)} max {max(self.seq_lens)} | offloaded chunks min {min(self.ctx_chunks)} max {max(self.ctx_chunks)}")
+        if len(set(self.sparse_budgets)) > 1 or len(set(self.ranks)) > 1:
+            print(f"Budget map | sparse budget {self.sparse_budgets} | rank {self.ranks} | total budget {sum(self.sparse_budgets)}")
+        if self.retrieval_top_p is not None and self.selected_capacity > 0:
+            print(f"Top-p retrieval | p {self.retrieval_top_p} | kept {float(self.selected_sum) / self.selected_capacity:.4f} of the buffer chunks")
+        if self.prefetch_lookups > 0:
+            print(f"Layer prefetch | {float(self.prefetch_misses) / self.prefetch_lookups:.4f} of the selected chunks missed by the prediction")
+        if self.stats is not None:
+            self.stats.print_stats()
+        if self.value_store is not None:
+            self.value_store.print_stats()
+        if self.host_writer.commits > 0:
+            self.host_writer.print_stats()
+        if len(self.svd_errors) > 0:
+            rel_error = sum(r[self.svd_method]['rel_error'] for r in self.svd_errors) / len(self.svd_errors)
+            ratio = sum(r[self.svd_method]['error_ratio'] for r in self.svd_errors) / len(self.svd_errors)
+            print(f"SVD {self.svd_method} | layers {len(self.svd_errors)} | mean rel error {rel_error:.6f} | vs exact {ratio:.4f}x")
+        if len(self.u_quant_errors) > 0:
+            print(f"U {self.u_quant} | key reconstruction rel error mean {sum(self.u_quant_errors) / len(self.u_quant_errors):.6f} max {max(self.u_quant_errors):.6f}")
+
+    def write_values(self, layer_idx, batch_start, chunk_start, values):
+        # values: [bsz, kv_heads, chunks, chunk_size*head_dim] into the host store
+        if self.value_quant is not None:
+            self.value_store.write(layer_idx, batch_start, chunk_start, values)
+            return
+        dst = self.v_cache_cpu[layer_idx][batch_start:batch_start + values.shape[0], :, chunk_start:chunk_start + values.shape[2]]
+        if self.copy_stream is not None and self.value_store is None and values.is_cuda:
+            # pinned store: the copy runs on copy_stream while the next layers (and prompts) are computed,
+            # the allocator keeps values alive until it is done, see wait_host_copies()
+            self.copy_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(self.copy_stream):
+                dst.copy_(values, non_blocking=True)
+            values.record_stream(self.copy_stream)
+            self.pending_host_copies = True
+        else:
+            dst.copy_(values, non_blocking=True)
+
+    def wait_host_copies(self, host=False):
+        # order the prefill value writes before anything reading the host store: the decode kernels on the
+        # current stream, or with host=True the CPU itself (snapshots)
+        if not self.pending_host_copies:
+            return
+        torch.cuda.current_stream().wait_stream(self.copy_stream)
+        if host:
+            self.copy_stream.synchronize()
+            self.pending_host_copies = False
+
+    def layer_buffers(self, layer_idx):
+        # views of the shared scratch sized for this layer's select_sets: offsets, temp, output
+        select_sets = self.layer_select_sets[layer_idx]
+        n = self.block_num * select_sets
+        offsets = self.offsets[:n]
+        temp = self.temp.view(-1)[:n * self.chunk_size * self.head_dim].view(self.batch_size, self.num_key_value_heads, select_sets, self.chunk_size * self.head_dim)
+        output = self.output.view(-1)[:n * self.chunk_size * self.head_dim].view(self.batch_size, self.num_key_value_heads, select_sets * self.chunk_size, self.head_dim)
+        return offsets, temp, output
 
     ##### Encoding #####
+    def init_svd_buffers(self, prefill_len):
+        # init U, SV, with compaction U also holds the rows of generated tokens
+        self.plan_placement(prefill_len)
+        u_len = self.u_len(prefill_len)
+        self.U = [torch.zeros(self.batch_size, u_len, rank, device=self.artifact_device, dtype=self.dtype) for rank in self.ranks]
+        self.SV = [torch.zeros(self.batch_size, self.num_key_value_heads, self.head_dim, rank, device=self.artifact_device, dtype=self.dtype) for rank in self.ranks]
+
+    def u_len(self, prefill_len):
+        return max(prefill_len, self.max_length) if self.compact_every is not None else prefill_len
+
+    def artifact_footprint(self, prefill_len):
+        # bytes of U, SV, the landmarks and the retrieval scratch on the GPU once decoding starts, see models/memory_plan.py
+        return shadowkv_artifact_bytes(self.config, self.batch_size, prefill_len, self.max_length, self.sparse_budgets, self.ranks, self.chunk_size,
+            self.dtype, max_q_len=self.max_q_len, max_landmarks=self.max_landmarks, compact_every=self.compact_every, u_quant=self.u_quant)
+
+    def plan_placement(self, prefill_len):
+        # write the artifacts straight to the GPU when they fit next to the prefill of one prompt, H2D() then
+        # has nothing left to move, otherwise build them on the host and move them in H2D()
+        if self.artifact_placement == 'cpu' or not torch.cuda.is_available() or not str(self.device).startswith('cuda'):
+            self.artifact_device = 'cpu'
+        elif self.artifact_placement == 'gpu':
+            self.artifact_device = self.device
+        else:
+            needed = sum(self.artifact_footprint(prefill_len).values())
+            needed += prefill_len * prefill_bytes_per_token(self.config.hidden_size, self.num_key_value_heads * self.head_dim, config_intermediate_size(self.config), self.rank, self.svd_method, torch.finfo(self.dtype).bits // 8)
+            free, _ = torch.cuda.mem_get_info(self.device)
+            free += torch.cuda.memory_reserved(self.device) - torch.cuda.memory_allocated(self.device)
+            self.artifact_device = self.device if needed <= 0.9 * free else 'cpu'
+        if self.artifact_device != 'cpu':
+            self.temp = self.temp.to(self.device)
+            self.output = self.output.to(self.device)
+
     def get_svd(self, new_k_cache, layer_idx):
         # [bsz, 8, prefill, 128] OR [bsz, prefill, 1024]
         if new_k_cache.shape[1] <= 32:
             # [bsz, 8, prefill, 128] --> [bsz, prefill, 1024]
-            k_cache = new_k_cache.transpose(1, 2).reshape(self.batch_size, -1, self.num_key_value_heads*self.head_dim)
+            k_cache = new_k_cache.transpose(1, 2).reshape(new_k_cache.shape[0], -1, self.num_key_value_heads*self.head_dim)
         else:
             # [bsz, prefill, 1024]
             k_cache = new_k_cache
         
         if layer_idx == 0 and self.prefilled_batch == 0:
-            # init U, SV
-            self.U = torch.zeros(self.num_layers, self.batch_size, k_cache.shape[1], self.rank, device='cpu', dtype=self.dtype)
-            self.SV = torch.zeros(self.num_layers, self.batch_size, self.num_key_value_heads, self.head_dim, self.rank, device='cpu', dtype=self.dtype)
+            self.init_svd_buffers(k_cache.shape[1])
         
-        torch.cuda.synchronize()
-        gc.collect()
-        torch.cuda.empty_cache()
-        torch.cuda.synchronize()
-        
-        u, s, v = torch.svd(k_cache.float())
-        v = v.transpose(1,2)
+        if torch.cuda.is_available() and self.svd_method == 'exact':
+            # full svd of the float key matrix is the prefill memory peak
+            torch.cuda.synchronize()
+            gc.collect()
+            torch.cuda.empty_cache()
+            torch.cuda.synchronize()
+
+        rank = self.ranks[layer_idx]
+        if self.svd_report:
+            self.svd_errors.append(svd_accuracy_report(k_cache, rank, methods=('exact', self.svd_method) if self.svd_method != 'exact' else ('exact',), verbose=False))
         
-        bsz = k_cache.shape[0]
+        # [bsz, 128k, 1024] --> [bsz, 128k, 160] [bsz, 160] [bsz, 160, 1024]
+        u, s, v = low_rank_svd(k_cache, rank, method=self.svd_method)
+        self.store_svd(u, s, v, layer_idx)
+        del u, s, v
+
+    def store_svd(self, u, s, v, layer_idx):
+        bsz = u.shape[0]
+        if self.profiler is not None:
+            self.profiler.observe_spectrum(layer_idx, s)
+        rows = slice(self.prefill_row, self.prefill_row + bsz)
+        if u.shape[1] > self.U[layer_idx].shape[1]:
+            # a longer prompt than the slots filled so far
+            self.host_writer.flush()
+            self.layout_epoch += 1
+            self.U[layer_idx] = grow_rows(self.U[layer_idx], u.shape[1])
+            if self.U_scale is not None:
+                self.U_scale[layer_idx] = grow_rows(self.U_scale[layer_idx], u.shape[1])
         # [bsz, 128k, 1024] --> [bsz, 128k, 160] [bsz, 160, 1024] (bsz, 8, 160, 128)
-        self.U[layer_idx][self.prefilled_batch:self.prefilled_batch + bsz].copy_(u[:, :, :self.rank].to(self.dtype)) # [bsz, 128k, 160]
+        if self.U_scale is not None:
+            # a slot inserted after H2D() quantized U, see prefill_slot()
+            u_q, u_scale = quantize_rows(u.to(self.U[layer_idx].device, self.dtype), self.u_quant)
+            self.U[layer_idx][rows, :u.shape[1]].copy_(u_q)
+            self.U_scale[layer_idx][rows, :u.shape[1]].copy_(u_scale)
+        else:
+            self.host_writer.stage(self.U[layer_idx][rows, :u.shape[1]], u.to(self.dtype)) # [bsz, 128k, 160]
         
-        temp_sv = torch.matmul(torch.diag_embed(s[:, :self.rank]), v[:, :self.rank]).to(self.dtype).view(bsz, -1, self.num_key_value_heads, self.head_dim).transpose(1, 2) # [bsz, 8, 160, 128]
+        temp_sv = torch.matmul(torch.diag_embed(s), v).to(self.dtype).view(bsz, -1, self.num_key_value_heads, self.head_dim).transpose(1, 2) # [bsz, 8, 160, 128]
 
         # used for kernel
         temp_sv = temp_sv.transpose(-1, -2) # [bsz, 8, 128, 160]
         
-        self.SV[layer_idx][self.prefilled_batch:self.prefilled_batch + bsz].copy_(temp_sv) # [bsz, 8, 128, 160]
-
-        del u, s, v
+        self.host_writer.stage(self.SV[layer_idx][rows], temp_sv) # [bsz, 8, 128, 160]
+        if self.SV_pinv is not None:
+            self.SV_pinv[layer_idx][rows] = sv_pinv(self.SV[layer_idx][rows])
 
     def register_k_landmark(self, k_landmark, k_landmark_idx, layer_idx):
         num_landmarks = k_landmark.shape[-2]
         bsz = k_landmark.shape[0]
         if layer_idx == 0 and self.prefilled_batch == 0:
-            # init k_landmark, k_landmark_idx
-            self.k_landmark = torch.zeros(self.num_layers, self.batch_size, self.num_key_value_heads, num_landmarks, self.head_dim, device='cpu', dtype=self.dtype)
-            self.k_landmark_idx = torch.zeros(self.num_layers, self.batch_size, self.num_key_value_heads, num_landmarks, device='cpu', dtype=torch.long)
-
-            # for fused gemm kernel
-            self.gemm_o = torch.zeros(self.batch_size, self.num_key_value_heads, self.num_key_value_groups, num_landmarks, device='cpu', dtype=torch.bfloat16).contiguous()
-            self.softmax_o = torch.zeros(self.batch_size, self.num_key_value_heads, self.num_key_value_groups, num_landmarks, device='cpu', dtype=torch.bfloat16).contiguous()
-            self.norm = torch.zeros(self.batch_size*self.num_key_value_heads, self.num_key_value_groups, (num_landmarks + 256 - 1) // 256, device='cpu', dtype=torch.float).contiguous()
-            self.sum = torch.zeros(self.batch_size*self.num_key_value_heads, self.num_key_value_groups, (num_landmarks + 256 - 1) // 256, device='cpu', dtype=torch.float).contiguous()
+            # init k_landmark, k_landmark_idx, the number of landmarks depends on the prompt length and the outlier chunks of a layer
+            self.k_landmark = [None] * self.num_layers
+            self.k_landmark_idx = [None] * self.num_layers
+            self.max_landmarks = 0
+        self.reserve_landmarks(layer_idx, num_landmarks)
         
-        self.k_landmark[layer_idx][self.prefilled_batch:self.prefilled_batch + bsz].copy_(k_landmark)
-        self.k_landmark_idx[layer_idx][self.prefilled_batch:self.prefilled_batch + bsz].copy_(k_landmark_idx)
+        # the host copies of the layer (U, SV and landmarks) run while the next layers are computed
+        self.host_writer.stage(self.k_landmark[layer_idx][self.prefill_row:self.prefill_row + bsz, :, :num_landmarks], k_landmark)
+        self.host_writer.stage(self.k_landmark_idx[layer_idx][self.prefill_row:self.prefill_row + bsz, :, :num_landmarks], k_landmark_idx)
+        self.host_writer.commit()
+
+    def reserve_landmarks(self, layer_idx, num_landmarks):
+        # grow the landmark capacity of a layer, slots with fewer landmarks are padded and masked in retrieval
+        if self.k_landmark[layer_idx] is None or self.k_landmark[layer_idx].shape[-2] < num_landmarks:
+            self.layout_epoch += 1
+        if self.k_landmark[layer_idx] is None:
+            self.k_landmark[layer_idx] = torch.zeros(self.batch_size, self.num_key_value_heads, num_landmarks, self.head_dim, device=self.artifact_device, dtype=self.dtype)
+            self.k_landmark_idx[layer_idx] = torch.zeros(self.batch_size, self.num_key_value_heads, num_landmarks, device=self.artifact_device, dtype=torch.long)
+        elif self.k_landmark[layer_idx].shape[-2] < num_landmarks:
+            self.host_writer.flush()
+            pad = num_landmarks - self.k_landmark[layer_idx].shape[-2]
+            self.k_landmark[layer_idx] = torch.nn.functional.pad(self.k_landmark[layer_idx], (0, 0, 0, pad))
+            self.k_landmark_idx[layer_idx] = torch.nn.functional.pad(self.k_landmark_idx[layer_idx], (0, pad))
+        if num_landmarks > self.max_landmarks:
+            self.init_gemm_softmax_buffers(num_landmarks, device=self.artifact_device if self.gemm_o is None else self.gemm_o.device)
+
+    def update_landmark_mask(self):
+        # [bsz, 1, capacity] valid landmarks of each slot, None for the layers where every slot fills the capacity
+        for layer_idx in range(self.num_layers):
+            capacity = self.k_landmark[layer_idx].shape[-2]
+            num_landmarks = [chunks - self.outlier_chunks[layer_idx] for chunks in self.ctx_chunks]
+            if min(num_landmarks) == capacity:
+                if self.landmark_mask[layer_idx] is not None:
+                    self.layout_epoch += 1
+                self.landmark_mask[layer_idx] = None
+            else:
+                num_landmarks = torch.tensor(num_landmarks, device=self.k_landmark[layer_idx].device).unsqueeze(-1)
+                mask = (torch.arange(capacity, device=num_landmarks.device) < num_landmarks).unsqueeze(1)
+                if self.landmark_mask[layer_idx] is not None and self.landmark_mask[layer_idx].shape == mask.shape and self.landmark_mask[layer_idx].device == mask.device:
+                    # in place, a captured decode step keeps reading the same tensor
+                    self.landmark_mask[layer_idx].copy_(mask)
+                else:
+                    self.layout_epoch += 1
+                    self.landmark_mask[layer_idx] = mask
+
+    def init_gemm_softmax_buffers(self, num_landmarks, device='cpu'):
+        # for fused gemm kernel, sized for the layer with the most landmarks, see softmax_buffers()
+        self.layout_epoch += 1
+        self.max_landmarks = num_landmarks
+        # a row per query head and incoming token, max_q_len grows with the longest multi-token step so far
+        rows = self.num_key_value_groups * self.max_q_len
+        self.gemm_o = torch.zeros(self.batch_size, self.num_key_value_heads, rows, num_landmarks, device=device, dtype=torch.bfloat16).contiguous()
+        self.softmax_o = torch.zeros(self.batch_size, self.num_key_value_heads, rows, num_landmarks, device=device, dtype=torch.bfloat16).contiguous()
+        self.norm = torch.zeros(self.batch_size*self.num_key_value_heads, rows, (num_landmarks + 256 - 1) // 256, device=device, dtype=torch.float).contiguous()
+        self.sum = torch.zeros(self.batch_size*self.num_key_value_heads, rows, (num_landmarks + 256 - 1) // 256, device=device, dtype=torch.float).contiguous()
+
+    def softmax_buffers(self, num_landmarks, q_len=1):
+        # views of the gemm softmax scratch for a layer with num_landmarks landmarks and q_len incoming tokens
+        if q_len > self.max_q_len:
+            self.max_q_len = q_len
+            self.init_gemm_softmax_buffers(self.max_landmarks, device=self.gemm_o.device)
+        group_rows = self.num_key_value_groups * q_len
+        rows = self.batch_size * self.num_key_value_heads * group_rows
+        blocks = (num_landmarks + 256 - 1) // 256
+        gemm_o = self.gemm_o.view(-1)[:rows * num_landmarks].view(self.batch_size, self.num_key_value_heads, group_rows, num_landmarks)
+        softmax_o = self.softmax_o.view(-1)[:rows * num_landmarks].view(self.batch_size, self.num_key_value_heads, group_rows, num_landmarks)
+        norm = self.norm.view(-1)[:rows * blocks].view(self.batch_size*self.num_key_value_heads, group_rows, blocks)
+        sum = self.sum.view(-1)[:rows * blocks].view(self.batch_size*self.num_key_value_heads, group_rows, blocks)
+        return gemm_o, norm, sum, softmax_o
 
     def prefill_kv_cache(self,
             new_v_cache :torch.Tensor,
             layer_idx :int,
             key_states_roped: torch.Tensor,
-            last_query_states=None
+            last_query_states=None,
+            streamed=False
             ):
+        # streamed=True: values are already offloaded and landmarks computed window by window, see stream_prefill_*
+        # fills the slots [prefill_row, prefill_row + bsz), later calls may bring prompts of other lengths
         
         bsz, _, incoming, _ = new_v_cache.shape # [bsz, num_kv_heads, incoming, head_dim]
-        self.prefill = incoming
+        rows = slice(self.prefill_row, self.prefill_row + bsz)
         max_ctx_chunks = incoming // self.chunk_size
-        self.max_ctx_chunks_len = max_ctx_chunks * self.chunk_size
-        self.v_cache_cpu[layer_idx][self.prefilled_batch:self.prefilled_batch + bsz, :, :max_ctx_chunks].copy_(new_v_cache[:, :, :self.max_ctx_chunks_len].reshape(bsz, self.num_key_value_heads, max_ctx_chunks, self.chunk_size*self.head_dim), non_blocking=True) # [bsz, num_kv_heads, max_ctx_chunks, chunk_size*head_dim]
+        if not streamed:
+            self.write_values(layer_idx, self.prefill_row, 0, new_v_cache[:, :, :max_ctx_chunks*self.chunk_size].reshape(bsz, self.num_key_value_heads, max_ctx_chunks, self.chunk_size*self.head_dim)) # [bsz, num_kv_heads, max_ctx_chunks, chunk_size*head_dim]
 
-        # [x0, x1, ...., self.chunks*chunk_size, local_chunk, rest]
-        self.chunks = incoming // self.chunk_size - self.local_chunk 
-        # ensure self.chunks is even
-        self.chunks = self.chunks - self.chunks % 8
-        
-        # store Post-RoPE k cache <prefill_local> to the cache
-        self.prefill_local = incoming - self.chunks * self.chunk_size # local chunks + align to chunk_size
-        self.k_cache_buffer[layer_idx][self.prefilled_batch:self.prefilled_batch + bsz, :, :self.prefill_local].copy_(key_states_roped[:, :, -self.prefill_local:])
-        self.v_cache_buffer[layer_idx][self.prefilled_batch:self.prefilled_batch + bsz, :, :self.prefill_local].copy_(new_v_cache[:, :, -self.prefill_local:])
-
-        key_states_roped_ctx = key_states_roped[:,:,:self.chunks*self.chunk_size].view(bsz, self.num_key_value_heads, self.chunks, self.chunk_size, self.head_dim)
-        landmark_candidates = key_states_roped_ctx.mean(dim=-2) # [bsz, kv_heads, chunks, head_dim]
-        
-        # compute the cos similarity between it and the original key cache
-        cos_sim = torch.nn.functional.cosine_similarity(landmark_candidates.unsqueeze(3).expand(-1, -1, -1, self.chunk_size, -1), key_states_roped_ctx, dim=-1) # [bsz, kv_heads, chunks, chunk_size]
+        # [x0, x1, ...., chunks*chunk_size, local_chunk, rest]
+        chunks = incoming // self.chunk_size - self.local_chunk 
+        # ensure chunks is even
+        chunks = chunks - chunks % 8
         
-        # get the outlier_chunk idx for each head # [bsz, kv_heads, outlier_chunk]
-        outlier_chunk_idx = cos_sim.min(dim=-1).values.topk(self.outlier_chunk, largest=False).indices
+        # Post-RoPE k cache <prefill_local> goes to the local window after the sparse region
+        prefill_local = incoming - chunks * self.chunk_size # local chunks + align to chunk_size
+
+        # landmarks and outliers of each head, the rest_idx landmarks are registered and scored by the last query
+        # outlier_chunk_idx [bsz, kv_heads, outlier_chunk], landmarks [bsz, kv_heads, chunks - outlier_chunk, head_dim]
+        outlier_chunk = self.outlier_chunks[layer_idx]
+        select_sets = self.layer_select_sets[layer_idx]
+        if streamed:
+            built = build_landmarks(None, outlier_chunk, last_query_states, select_sets, landmark_candidates=self.stream_landmarks[:, :, :chunks], chunk_min_sim=self.stream_min_sim[:, :, :chunks])
+        else:
+            key_states_roped_ctx = key_states_roped[:,:,:chunks*self.chunk_size].view(bsz, self.num_key_value_heads, chunks, self.chunk_size, self.head_dim)
+            built = build_landmarks(key_states_roped_ctx, outlier_chunk, last_query_states, select_sets)
+        outlier_chunk_idx, landmarks, rest_idx, chunk_attn, selected_chunks = built
     
-        # [bsz, kv_heads, chunks, chunk_size, head_dim] --gather[bsz, kv_heads, outlier_chunk]-->[bsz, kv_heads, outlier_chunk, chunk_size, head_dim]
-        outlier_chunk_k_cache = key_states_roped_ctx.gather(dim=2, index=outlier_chunk_idx.unsqueeze(-1).unsqueeze(-1).expand(-1, -1, -1, self.chunk_size, self.head_dim)).view(bsz, self.num_key_value_heads, self.outlier_chunk*self.chunk_size, self.head_dim)
-        
-        outlier_chunk_v_cache = new_v_cache[:,:,:self.chunks*self.chunk_size].view(bsz, self.num_key_value_heads, self.chunks, self.chunk_size, self.head_dim).gather(dim=2, index=outlier_chunk_idx.unsqueeze(-1).unsqueeze(-1).expand(-1, -1, -1, self.chunk_size, self.head_dim)).view(bsz, self.num_key_value_heads, self.outlier_chunk*self.chunk_size, self.head_dim)
-
-        self.sparse_start = self.prefill_local + self.outlier_chunk*self.chunk_size
-        self.sparse_end = self.prefill_local + self.outlier_chunk*self.chunk_size + self.sparse_budget
-
-        self.kernel_offset = self.sparse_start * self.head_dim
-        self.kernel_stride = self.v_cache_buffer[layer_idx].shape[-2] * self.head_dim
+        # [bsz, kv_heads, prefill, head_dim] --gather[bsz, kv_heads, outlier_chunk*chunk_size]-->[bsz, kv_heads, outlier_chunk*chunk_size, head_dim]
+        outlier_position_ids = (outlier_chunk_idx.unsqueeze(-1) * self.chunk_size + torch.arange(self.chunk_size, device=outlier_chunk_idx.device)).view(bsz, self.num_key_value_heads, -1).unsqueeze(-1).expand(-1, -1, -1, self.head_dim)
+        outlier_chunk_k_cache = key_states_roped.gather(dim=-2, index=outlier_position_ids)
+        outlier_chunk_v_cache = new_v_cache.gather(dim=-2, index=outlier_position_ids)
+
+        # [outlier | sparse_budget | prefill_local + generated], the same regions for every slot
+        sparse_start = outlier_chunk*self.chunk_size
+        sparse_end = sparse_start + self.sparse_budgets[layer_idx]
+        self.sparse_start[layer_idx] = sparse_start
+        self.sparse_end[layer_idx] = sparse_end
+
+        self.kernel_offset[layer_idx] = sparse_start * self.head_dim
+        self.kernel_stride[layer_idx] = self.v_cache_buffer[layer_idx].shape[-2] * self.head_dim
         
-        # store outlier_chunk to the cache
-        self.k_cache_buffer[layer_idx][self.prefilled_batch:self.prefilled_batch + bsz, :, self.prefill_local:self.sparse_start].copy_(outlier_chunk_k_cache)
-        self.v_cache_buffer[layer_idx][self.prefilled_batch:self.prefilled_batch + bsz, :, self.prefill_local:self.sparse_start].copy_(outlier_chunk_v_cache)
-
-        # filter landmark_candidates using outlier_chunk and register the rest to k_landmark
-        # [bsz, kv_heads, chunks, head_dim] --> [bsz, kv_heads, chunks - outlier_chunk, head_dim]
-        # get rest_idx: [bsz, kv_heads, chunks] --filter--> [bsz, kv_heads, chunks - outlier_chunk]
-        all_idx = torch.arange(self.chunks, device=key_states_roped.device).unsqueeze(0).unsqueeze(0).expand(bsz, self.num_key_value_heads, -1) # [bsz, kv_heads, chunks]
-        mask = torch.ones_like(all_idx, dtype=torch.bool)
-        mask.scatter_(dim=-1, index=outlier_chunk_idx, value=False)
-        rest_idx = all_idx.masked_select(mask).view(bsz, self.num_key_value_heads, -1)
-
-        # register rest_idxed landmarks to k_landmark
-        self.register_k_landmark(landmark_candidates.gather(dim=2, index=rest_idx.unsqueeze(-1).expand(-1, -1, -1, self.head_dim)).view(bsz, self.num_key_value_heads, -1, self.head_dim), rest_idx, layer_idx)
-
-        # fill cache for the first time
-        chunk_attn = torch.einsum('bhgd,bhcd->bhgc', last_query_states.view(-1, self.num_key_value_heads, self.num_key_value_groups, self.head_dim), self.k_landmark[layer_idx][self.prefilled_batch:self.prefilled_batch + bsz].to(last_query_states.device)) / math.sqrt(128) # [bsz, 8, 4, chunks]
-        chunk_attn = nn.functional.softmax(chunk_attn, dim=-1, dtype=torch.float32).to(self.dtype)
-        chunk_attn, _ = torch.max(chunk_attn, dim=-2) # [bsz, 8, chunks]
-        merged_results = torch.topk(chunk_attn, k=self.select_sets, dim=-1).indices # [bsz, 8, select_sets(256)]
-        selected_chunks = self.k_landmark_idx[layer_idx][self.prefilled_batch:self.prefilled_batch + bsz].to(last_query_states.device).gather(dim=-1, index=merged_results) # [bsz, 8, select_sets]
-        self.position_ids[layer_idx][self.prefilled_batch:self.prefilled_batch + bsz].copy_(selected_chunks)
-        assert self.position_ids[layer_idx][self.prefilled_batch:self.prefilled_batch + bsz].max() < self.chunks, f"position_ids exceed the max_length {self.position_ids[layer_idx].max()}"
-        assert self.position_ids[layer_idx][self.prefilled_batch:self.prefilled_batch + bsz].min() >= 0, f"position_ids exceed the min_length {self.position_ids[layer_idx].min()}"
+        # store outlier_chunk and the local window to the cache
+        self.k_cache_buffer[layer_idx][rows, :, :sparse_start].copy_(outlier_chunk_k_cache)
+        self.v_cache_buffer[layer_idx][rows, :, :sparse_start].copy_(outlier_chunk_v_cache)
+        self.k_cache_buffer[layer_idx][rows, :, sparse_end:sparse_end + prefill_local].copy_(key_states_roped[:, :, -prefill_local:])
+        self.v_cache_buffer[layer_idx][rows, :, sparse_end:sparse_end + prefill_local].copy_(new_v_cache[:, :, -prefill_local:])
+
+        # register the rest_idx landmarks to k_landmark
+        self.register_k_landmark(landmarks, rest_idx, layer_idx)
+
+        # fill cache for the first time, selected_chunks [bsz, 8, select_sets]
+        if self.profiler is not None:
+            self.profiler.observe(layer_idx, chunk_attn)
+        self.position_ids[layer_idx][rows].copy_(selected_chunks)
+        assert self.position_ids[layer_idx][rows].max() < chunks, f"position_ids exceed the max_length {self.position_ids[layer_idx].max()}"
+        assert self.position_ids[layer_idx][rows].min() >= 0, f"position_ids exceed the min_length {self.position_ids[layer_idx].min()}"
         position_ids = (selected_chunks.unsqueeze(-1) * self.chunk_size + torch.arange(self.chunk_size, device=chunk_attn.device).unsqueeze(0).unsqueeze(0).unsqueeze(0)).view(bsz, self.num_key_value_heads, -1)
         value_ = new_v_cache.gather(dim=-2, index=position_ids.unsqueeze(-1).expand(-1, -1, -1, self.head_dim))
-        self.v_cache_buffer[layer_idx][self.prefilled_batch:self.prefilled_batch + bsz, :, self.sparse_start:self.sparse_end].copy_(value_, non_blocking=True)
+        self.v_cache_buffer[layer_idx][rows, :, sparse_start:sparse_end].copy_(value_, non_blocking=True)
         key_ = key_states_roped.gather(dim=-2, index=position_ids.unsqueeze(-1).expand(-1, -1, -1, self.head_dim))
-        self.k_cache_buffer[layer_idx][self.prefilled_batch:self.prefilled_batch + bsz, :, self.sparse_start:self.sparse_end].copy_(key_, non_blocking=True)
+        self.k_cache_buffer[layer_idx][rows, :, sparse_start:sparse_end].copy_(key_, non_blocking=True)
 
         if layer_idx == self.num_layers - 1:
             assert self.sparse_budget < incoming
-            # self.kv_offset += incoming
+            for slot in range(rows.start, rows.stop):
+                self.seq_lens[slot] = incoming
+                self.prefill_lens[slot] = incoming
+                self.ctx_chunks[slot] = chunks
+                self.local_lens[slot] = prefill_local
+                self.gen_lens[slot] = 0
+            if self.slot_prefill is not None:
+                # a slot of a running batch, the cache is already on the device
+                self.wait_host_copies()
+                self.active[self.slot_prefill] = True
+                self.slot_prefill = None
+                self.sync_lens()
+                self.update_landmark_mask()
+                return
             self.prefilled_batch += bsz
 
             if self.prefilled_batch == self.batch_size:
-                self.kv_offset += incoming
+                self.wait_host_copies()
+                self.sync_lens()
 
-                assert torch.any(self.position_ids == -1) == False, f"The cache for offloading is not built correctly, {self.position_ids}"
+                assert not any(torch.any(p == -1) for p in self.position_ids), f"The cache for offloading is not built correctly, {self.position_ids}"
+
+    ##### Streaming prefill #####
+    # The prompt of a layer is processed in chunk-aligned windows in two passes (see LLM.streaming_prefill_layer):
+    # pass 1 accumulates the key Gram matrix and offloads values, the SVD is taken from the Gram matrix,
+    # pass 2 builds landmarks from the RoPEd keys of each window, and prefill_kv_cache(streamed=True) finishes.
+    def begin_stream_prefill(self, layer_idx, bsz, incoming, device):
+        if layer_idx == 0 and self.prefilled_batch == 0:
+            self.init_svd_buffers(incoming)
+        d = self.num_key_value_heads * self.head_dim
+        self.gram = torch.zeros(bsz, d, d, device=device, dtype=torch.float32)
+        self.stream_landmarks = torch.zeros(bsz, self.num_key_value_heads, incoming // self.chunk_size, self.head_dim, device=device, dtype=self.dtype)
+        self.stream_min_sim = torch.zeros(bsz, self.num_key_value_heads, incoming // self.chunk_size, device=device, dtype=self.dtype)
+
+    def stream_prefill_keys(self, layer_idx, key_states, value_states, start):
+        # key_states: pre-RoPE [bsz, window, kv_heads*head_dim], value_states: [bsz, kv_heads, window, head_dim]
+        assert start % self.chunk_size == 0, f"window start {start} is not aligned to chunk_size {self.chunk_size}"
+        bsz, window, _ = key_states.shape
+        k = key_states.float()
+        self.gram.baddbmm_(k.transpose(1, 2), k)
+
+        # only full chunks are offloaded, the tail is kept in the local window
+        window_chunks = window // self.chunk_size
+        chunk_start = start // self.chunk_size
+        self.write_values(layer_idx, self.prefill_row, chunk_start, value_states[:, :, :window_chunks*self.chunk_size].reshape(bsz, self.num_key_value_heads, window_chunks, self.chunk_size*self.head_dim))
+
+    def stream_prefill_svd(self, layer_idx, key_states):
+        # key_states: pre-RoPE [bsz, prefill, kv_heads*head_dim]
+        u, s, v = gram_svd(key_states, self.ranks[layer_idx], gram=self.gram)
+        self.store_svd(u, s, v, layer_idx)
+        self.gram = None
+        del u, s, v
+
+    def stream_prefill_landmarks(self, key_states_roped, start):
+        # key_states_roped: [bsz, kv_heads, window, head_dim]
+        bsz, _, window, _ = key_states_roped.shape
+        window_chunks = window // self.chunk_size
+        chunk_start = start // self.chunk_size
+        key_states_roped_ctx = key_states_roped[:, :, :window_chunks*self.chunk_size].reshape(bsz, self.num_key_value_heads, window_chunks, self.chunk_size, self.head_dim)
+        landmark_candidates, chunk_min_sim = chunk_landmarks(key_states_roped_ctx)
+        self.stream_landmarks[:, :, chunk_start:chunk_start + window_chunks].copy_(landmark_candidates)
+        self.stream_min_sim[:, :, chunk_start:chunk_start + window_chunks].copy_(chunk_min_sim)
+
+    def end_stream_prefill(self):
+        self.stream_landmarks = None
+        self.stream_min_sim = None
+
+    ##### Slots #####
+    # A running batch recycles its slots: reset_slot() retires a sequence and prefill_slot() routes the next
+    # prefill forward, a single [1, seq] prompt, into the freed slot. Only the rows of that slot are written:
+    # U (quantized when u_quant is set) and SV (and SV_pinv with compact_every), landmarks, position_ids,
+    # its chunks of the host value store and the outlier, sparse and local regions of its buffer row.
+    # Nothing is zeroed, stale data past the lengths of a slot is never read.
+    @property
+    def prefill_row(self):
+        # first slot written by the running prefill
+        return self.prefilled_batch if self.slot_prefill is None else self.slot_prefill
+
+    def prefill_slot(self, slot):
+        if self.prefilled_batch != self.batch_size:
+            raise ValueError(f"prefill_slot needs a running batch, got {self.prefilled_batch}/{self.batch_size} prefilled slots")
+        if self.active[slot]:
+            raise ValueError(f"Slot {slot} is in use, call reset_slot({slot}) first")
+        self.slot_prefill = slot
+
+    def reset_slot(self, slot):
+        # The slot stops growing and is parked on a state that keeps the batched decode valid: landmarks 0..n-1
+        # at zero and all selected chunks cached, so its retrieval never copies from the host, and an empty tail.
+        if self.prefilled_batch != self.batch_size:
+            raise ValueError(f"reset_slot needs a running batch, got {self.prefilled_batch}/{self.batch_size} prefilled slots")
+        park_chunks = max(s + o for s, o in zip(self.layer_select_sets, self.outlier_chunks))
+        for layer_idx in range(self.num_layers):
+            num_landmarks = park_chunks - self.outlier_chunks[layer_idx]
+            select_sets = self.layer_select_sets[layer_idx]
+            self.reserve_landmarks(layer_idx, num_landmarks)
+            self.k_landmark[layer_idx][slot, :, :num_landmarks].zero_()
+            self.k_landmark_idx[layer_idx][slot, :, :num_landmarks].copy_(torch.arange(num_landmarks))
+            self.position_ids[layer_idx][slot].copy_(torch.arange(select_sets))
+        self.seq_lens[slot] = 0
+        self.prefill_lens[slot] = 0
+        self.ctx_chunks[slot] = park_chunks
+        self.local_lens[slot] = 0
+        self.gen_lens[slot] = 0
+        self.active[slot] = False
+        self.sync_lens()
+        self.update_landmark_mask()
+
+    def finish_prefill(self):
+        # start decoding a partially prefilled batch, the slots left are parked until prefill_slot() fills them
+        free = list(range(self.prefilled_batch, self.batch_size))
+        self.prefilled_batch = self.batch_size
+        self.wait_host_copies()
+        for slot in free:
+            self.reset_slot(slot)
+        return free
+
+    ##### Speculative decoding #####
+    # models/speculative.py drafts tokens with a smaller sparse budget and verifies them with one multi-token step,
+    # the tokens a slot rejects are dropped again with rollback()
+    def rollback(self, tokens):
+        # drop the last tokens[slot] generated tokens of every slot, their buffer rows are overwritten by later steps
+        if isinstance(tokens, int):
+            tokens = [tokens] * self.batch_size
+        for slot, n in enumerate(tokens):
+            if n > self.gen_lens[slot]:
+                raise ValueError(f"Cannot roll back {n} tokens of slot {slot}, it generated {self.gen_lens[slot]}")
+        self.seq_lens = [l - n for l, n in zip(self.seq_lens, tokens)]
+        self.gen_lens = [l - n for l, n in zip(self.gen_lens, tokens)]
+        self.sync_lens()
+
+    def finish_slot(self, slot):
+        # stop advancing a slot that has generated enough, unlike reset_slot() its cache stays as it is
+        self.active[slot] = False
+        self.sync_lens()
+
+    def draft_view(self, sparse_budget):
+        # a decoding view of this cache with sparse_budget tokens per layer: U, SV, landmarks and the host values are
+        # shared, the view has its own (smaller) GPU buffers, position_ids and lengths, seeded with the outliers, the
+        # first chunks of the current selection and the local window
+        if sparse_budget % self.chunk_size != 0 or not 0 < sparse_budget <= min(self.sparse_budgets):
+            raise ValueError(f"Draft sparse_budget must be a multiple of chunk_size {self.chunk_size} and at most {min(self.sparse_budgets)}, got {sparse_budget}")
+        if self.compact_every is not None:
+            raise ValueError("Draft views do not support compact_every")
+        view = copy.copy(self)
+        view.sparse_budgets = [int(sparse_budget)] * self.num_layers
+        view.layer_select_sets = [sparse_budget // self.chunk_size] * self.num_layers
+        view.sparse_budget = int(sparse_budget)
+        view.select_sets = sparse_budget // self.chunk_size
+        view.sparse_end = [start + sparse_budget for start in self.sparse_start]
+        view.k_cache_buffer, view.v_cache_buffer, view.position_ids, view.kernel_stride = [], [], [], []
+        for layer_idx in range(self.num_layers):
+            start, end = self.sparse_start[layer_idx], self.sparse_end[layer_idx]
+            tail = self.v_cache_buffer[layer_idx].shape[-2] - end
+            for buffer, view_buffer in ((self.k_cache_buffer[layer_idx], view.k_cache_buffer), (self.v_cache_buffer[layer_idx], view.v_cache_buffer)):
+                view_buffer.append(torch.cat([buffer[:, :, :start + sparse_budget], buffer[:, :, end:]], dim=-2))
+            view.position_ids.append(self.position_ids[layer_idx][:, :, :view.select_sets].contiguous())
+            view.kernel_stride.append(view.v_cache_buffer[layer_idx].shape[-2] * self.head_dim)
+            assert view.v_cache_buffer[layer_idx].shape[-2] - view.sparse_end[layer_idx] == tail
+
+        for name in ['seq_lens', 'prefill_lens', 'ctx_chunks', 'local_lens', 'gen_lens', 'active', 'prefetched']:
+            setattr(view, name, list(getattr(self, name)))
+        view.kv_lens, view.tail_lens, view.active_mask = self.kv_lens.clone(), self.tail_lens.clone(), self.active_mask.clone()
+        view.stats = None
+        view.profiler = None
+        view.static_shapes = False
+        return view
 
     ##### Decoding #####
     def get_retrieval_position_ids(self, layer_idx, query_states):
-        # self.k_landmark[layer_idx][:, :, :self.chunks] is [bsz, 8, chunks, head_dim]
-        # chunk_attn: [bsz, 32, window_size, chunks]
-        self.incoming_q_len = query_states.shape[-2] # 1
+        select_sets = self.layer_select_sets[layer_idx]
+        offsets, _, _ = self.layer_buffers(layer_idx)
+        selected_chunks = self.select_chunks(layer_idx, query_states)
+
+        if self.prefetched[layer_idx]:
+            # the buffers and the shared scratch are still in use by the prefetch on copy_stream
+            if self.copy_stream is not None:
+                torch.cuda.current_stream().wait_stream(self.copy_stream)
+            self.prefetched[layer_idx] = False
+            prefetch = True
+        else:
+            prefetch = False
+        shadowkv.reorder_keys_and_compute_offsets(self.position_ids[layer_idx], selected_chunks, offsets, self.cnts, self.batch_size, self.num_key_value_heads, select_sets)
+        if prefetch and not self.capturing:
+            # chunks the prediction missed, copied below like any other miss (eager steps only)
+            self.prefetch_lookups += self.cnts.numel() * select_sets
+            self.prefetch_misses += self.cnts.numel() * select_sets - self.cnts.sum() # stays on device
+        if self.stats is not None:
+            self.stats.record(layer_idx, self.cnts, select_sets, self.chunk_size * self.head_dim * self.v_cache_buffer[layer_idx].element_size(), self.v_cache_cpu.shape[-1] * self.v_cache_cpu.element_size())
+
+        return self.position_ids[layer_idx]
+
+    def prefetch_layer(self, layer_idx, query_states, rope_func, cos_sin_cache):
+        # move the chunks predicted from query_states (see LLM.prefetch_next_layer) into the buffers of layer_idx on
+        # copy_stream, ahead of its retrieval: the actual selection then finds them as hits and only copies what the
+        # prediction missed, the buffers stay consistent with position_ids either way
+        select_sets = self.layer_select_sets[layer_idx]
+        offsets, _, _ = self.layer_buffers(layer_idx)
+        selected_chunks = self.select_chunks(layer_idx, query_states, predict=True)
+        shadowkv.reorder_keys_and_compute_offsets(self.position_ids[layer_idx], selected_chunks, offsets, self.cnts, self.batch_size, self.num_key_value_heads, select_sets)
+        if self.copy_stream is not None:
+            self.copy_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(self.copy_stream):
+                self.get_value_cache(layer_idx, self.position_ids[layer_idx])
+                self.get_key_cache(layer_idx, self.position_ids[layer_idx], rope_func, cos_sin_cache)
+        else:
+            self.get_value_cache(layer_idx, self.position_ids[layer_idx])
+            self.get_key_cache(layer_idx, self.position_ids[layer_idx], rope_func, cos_sin_cache)
+        self.prefetched[layer_idx] = True
+
+    def select_chunks(self, layer_idx, query_states, predict=False):
+        self.incoming_q_len = query_states.shape[-2] # 1, more for speculative verification and appended turns
+        select_sets = self.layer_select_sets[layer_idx]
+        chunk_attn = self.chunk_scores(layer_idx, query_states, predict)
+
+        # [bsz, 8, seq] --> [bsz, 8, select_sets(256)]
+        scores, merged_results = torch.topk(chunk_attn, k=select_sets, dim=-1)
+        # use merged_results to gather the position_ids: [bsz, 8, select_sets] --> [bsz, 8, select_sets]
+        selected_chunks = self.k_landmark_idx[layer_idx].gather(dim=-1, index=merged_results) # [bsz, 8, select_sets]
+        if self.retrieval_top_p is not None and not predict:
+            selected_chunks = self.select_top_p(layer_idx, chunk_attn, scores, selected_chunks)
+        return selected_chunks
+
+    def chunk_scores(self, layer_idx, query_states, predict=False):
+        # self.k_landmark[layer_idx] is [bsz, 8, landmarks, head_dim], padded for the shorter slots of a ragged batch
+        # query_states: [bsz, 32, q_len, head_dim] --> chunk_attn: [bsz, 8, chunks]
+        # the rows of a kv head are its (group, token) pairs, one fused gemm softmax for every incoming token
+        q_len = query_states.shape[-2]
+        num_landmarks = self.k_landmark[layer_idx].shape[-2]
+        gemm_o, norm, sum, softmax_o = self.softmax_buffers(num_landmarks, q_len)
 
         # gemm_softmax
         shadowkv.batch_gemm_softmax(
             query_states.contiguous(),
             self.k_landmark[layer_idx].contiguous(),
-            self.gemm_o,
-            self.norm,
-            self.sum,
-            self.softmax_o,
+            gemm_o,
+            norm,
+            sum,
+            softmax_o,
             self.batch_size * self.num_key_value_heads,
-            self.num_key_value_groups * self.incoming_q_len,
-            self.k_landmark[layer_idx].shape[-2],
+            self.num_key_value_groups * q_len,
+            num_landmarks,
             self.head_dim,
             1 / math.sqrt(128),
             0
         )
-        if self.num_key_value_groups > 1:
-            chunk_attn, _ = torch.max(self.softmax_o.view(self.batch_size, self.num_key_value_heads, self.num_key_value_groups, -1), dim=-2) # [bsz, 8, chunks]
-
-        # [bsz, 8, seq] --> [bsz, 8, select_sets(256)]
-        merged_results = torch.topk(chunk_attn.view(self.batch_size, self.num_key_value_heads, -1), k=self.select_sets, dim=-1).indices
-        # use merged_results to gather the position_ids: [bsz, 8, select_sets] --> [bsz, 8, select_sets]
-        selected_chunks = self.k_landmark_idx[layer_idx].gather(dim=-1, index=merged_results) # [bsz, 8, select_sets]
-        shadowkv.reorder_keys_and_compute_offsets(self.position_ids[layer_idx], selected_chunks, self.offsets, self.cnts, self.batch_size, self.num_key_value_heads, self.select_sets)
-
-        return self.position_ids[layer_idx]
+        if self.profiler is not None and not predict:
+            self.profiler.observe(layer_idx, softmax_o.view(self.batch_size, self.num_key_value_heads, self.num_key_value_groups * q_len, -1))
+        probs = softmax_o.view(self.batch_size, self.num_key_value_heads, self.num_key_value_groups * q_len, -1)
+        if self.landmark_mask[layer_idx] is not None:
+            # padded landmarks of the shorter slots take part in the fused softmax: renormalize every query over its
+            # valid landmarks and push the padding below any probability so that it is never selected
+            mask = self.landmark_mask[layer_idx].unsqueeze(2)
+            probs = probs.float()
+            probs = (probs / probs.masked_fill(~mask, 0).sum(dim=-1, keepdim=True)).masked_fill(~mask, -1).to(softmax_o.dtype)
+        if q_len > 1:
+            # as ShadowKVCache: the attention mass of the incoming tokens is summed, then the max over the query group
+            probs = probs.view(self.batch_size, self.num_key_value_heads, self.num_key_value_groups, q_len, -1).sum(dim=-2)
+        chunk_attn, _ = torch.max(probs, dim=-2) # [bsz, 8, chunks]
+        return chunk_attn
+
+    def select_top_p(self, layer_idx, chunk_attn, scores, selected_chunks):
+        # keep the smallest prefix of the top-k chunks of each head reaching retrieval_top_p of the landmark mass,
+        # the remaining slots are refilled with chunks already in the buffer so reorder_keys_and_compute_offsets
+        # counts them as hits in cnts: only the kept chunks that missed are copied and recomputed
+        select_sets = selected_chunks.shape[-1]
+        slot = torch.arange(select_sets, device=scores.device)
+        mass = (scores.float() / chunk_attn.float().clamp(min=0).sum(dim=-1, keepdim=True)).cumsum(dim=-1) # [bsz, 8, select_sets]
+        keep_cnts = ((mass < self.retrieval_top_p).sum(dim=-1, keepdim=True) + 1).clamp(max=select_sets) # [bsz, 8, 1]
+        keep = slot < keep_cnts # [bsz, 8, select_sets]
+
+        # cached chunks that are not kept come first, the persistent [bsz, 8, max chunks] bitmap marks the kept ones
+        # and only those entries are cleared again, instead of zero-filling a new bitmap per layer and step
+        cached = self.position_ids[layer_idx]
+        kept = torch.where(keep, selected_chunks, selected_chunks[:, :, :1])
+        self.kept_map.scatter_(dim=-1, index=kept, value=1)
+        order = self.kept_map.gather(dim=-1, index=cached).argsort(dim=-1, stable=True)
+        self.kept_map.scatter_(dim=-1, index=kept, value=0)
+        fillers = cached.gather(dim=-1, index=order).gather(dim=-1, index=(slot - keep_cnts).clamp(min=0))
+
+        self.selected_sum += keep_cnts.sum() # stays on device, no sync per step
+        self.selected_capacity += keep_cnts.numel() * select_sets
+        return torch.where(keep, selected_chunks, fillers)
 
     def get_value_cache(self, layer_idx, position_ids):
-
-        shadowkv.gather_copy_with_offsets(self.v_cache_cpu[layer_idx], self.v_cache_buffer[layer_idx], self.temp, self.offsets, self.cnts, self.signals, self.batch_size, self.num_key_value_heads, int(self.max_ctx_chunks_len*self.head_dim), int(self.sparse_budget*self.head_dim), self.kernel_offset, self.kernel_stride, self.select_sets)
-
-        gen_offset = self.gen_offset if layer_idx == self.num_layers - 1 else self.gen_offset + self.incoming_q_len
-
-        return self.v_cache_buffer[layer_idx][:, :, :self.sparse_end + gen_offset]
+        select_sets = self.layer_select_sets[layer_idx]
+        offsets, temp, _ = self.layer_buffers(layer_idx)
+
+        if self.value_quant is not None:
+            # hits are moved inside the buffer like keys, misses are dequantized from packed host rows
+            shadowkv.gather_copy_d2d_with_offsets(self.v_cache_buffer[layer_idx], offsets, self.cnts, self.batch_size, self.num_key_value_heads, int(self.sparse_budgets[layer_idx]*self.head_dim), self.kernel_offset[layer_idx], self.kernel_stride[layer_idx], select_sets)
+            region = self.v_cache_buffer[layer_idx][:, :, self.sparse_start[layer_idx]:self.sparse_end[layer_idx]].view(self.block_num, select_sets, -1)
+            self.value_store.gather(layer_idx, offsets, self.cnts, select_sets, region)
+        else:
+            if self.value_store is not None:
+                # only the missed chunks are read from disk, into a pinned staging slot
+                host_v, offsets, cpu_v_length, slot = self.value_store.stage(layer_idx, offsets, self.cnts, select_sets)
+            else:
+                # per (batch, head) stride of the host store is the full max_length row, not the prefill length
+                host_v = self.v_cache_cpu[layer_idx]
+                cpu_v_length = int(self.v_cache_cpu.shape[-2] * self.v_cache_cpu.shape[-1])
+            shadowkv.gather_copy_with_offsets(host_v, self.v_cache_buffer[layer_idx], temp, offsets, self.cnts, self.signals, self.batch_size, self.num_key_value_heads, cpu_v_length, int(self.sparse_budgets[layer_idx]*self.head_dim), self.kernel_offset[layer_idx], self.kernel_stride[layer_idx], select_sets)
+            if self.value_store is not None:
+                self.value_store.release(slot)
+
+        # slots are valid up to get_cache_seqlens()
+        if self.static_shapes:
+            return self.v_cache_buffer[layer_idx]
+        tail = self.tail_max if layer_idx == self.num_layers - 1 else self.tail_max + self.incoming_q_len
+
+        return self.v_cache_buffer[layer_idx][:, :, :self.sparse_end[layer_idx] + tail]
 
     def get_key_cache(self, layer_idx, position_ids, rope_func, cos_sin_cache):
+        offsets, _, output = self.layer_buffers(layer_idx)
 
         # gather key cache and rope them
         u = self.U[layer_idx] # [bsz, 128k, rank]
         sv = self.SV[layer_idx] # [bsz, 8, 128, rank]
 
-        shadowkv.gather_copy_d2d_with_offsets(self.k_cache_buffer[layer_idx], self.offsets, self.cnts, self.batch_size, self.num_key_value_heads, int(self.sparse_budget*self.head_dim), self.kernel_offset, self.kernel_stride, self.select_sets)
-        batch_gather_gemm_rotary_pos_emb_cuda(u, sv, cos_sin_cache, position_ids, self.output, self.chunk_size, self.k_cache_buffer[layer_idx], self.sparse_start, self.sparse_end, self.cnts)
+        shadowkv.gather_copy_d2d_with_offsets(self.k_cache_buffer[layer_idx], offsets, self.cnts, self.batch_size, self.num_key_value_heads, int(self.sparse_budgets[layer_idx]*self.head_dim), self.kernel_offset[layer_idx], self.kernel_stride[layer_idx], self.layer_select_sets[layer_idx])
+        if self.U_scale is not None:
+            # a captured step cannot read the miss count on the host, it recomputes every chunk
+            max_misses = self.layer_select_sets[layer_idx] if self.capturing else None
+            batch_gather_gemm_dequant_rotary_pos_emb(u, self.U_scale[layer_idx], sv, cos_sin_cache, position_ids, output, self.chunk_size, self.k_cache_buffer[layer_idx], self.sparse_start[layer_idx], self.sparse_end[layer_idx], self.cnts, max_misses)
+        else:
+            batch_gather_gemm_rotary_pos_emb_cuda(u, sv, cos_sin_cache, position_ids, output, self.chunk_size, self.k_cache_buffer[layer_idx], self.sparse_start[layer_idx], self.sparse_end[layer_idx], self.cnts)
 
-        gen_offset = self.gen_offset if layer_idx == self.num_layers - 1 else self.gen_offset + self.incoming_q_len
+        if self.static_shapes:
+            return self.k_cache_buffer[layer_idx]
+        tail = self.tail_max if layer_idx == self.num_layers - 1 else self.tail_max + self.incoming_q_len
 
-        return self.k_cache_buffer[layer_idx][:, :, :self.sparse_end + gen_offset]
+        return self.k_cache_buffer[layer_idx][:, :, :self.sparse_end[layer_idx] + tail]
 
     def H2D(self):
-        gc.collect()
-        torch.cuda.empty_cache()
-        torch.cuda.synchronize()
-        self.SV = self.SV.to(self.device)
-        self.U = self.U.to(self.device)
-        self.k_landmark = self.k_landmark.to(self.device)
-        self.k_landmark_idx = self.k_landmark_idx.to(self.device)
+        self.host_writer.flush()
+        self.layout_epoch += 1
+        # artifacts written straight to the GPU (plan_placement) leave nothing to free or move
+        moved = self.artifact_device == 'cpu' or self.u_quant is not None
+        if self.memory_cleanup and moved:
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+                torch.cuda.synchronize()
+        self.SV = [sv.to(self.device) for sv in self.SV]
+        if self.u_quant is not None and self.U_scale is None:
+            self.quantize_u()
+        else:
+            self.U = [u.to(self.device) for u in self.U]
+            if self.U_scale is not None:
+                self.U_scale = [scale.to(self.device) for scale in self.U_scale]
+        self.k_landmark = [k.to(self.device) for k in self.k_landmark]
+        self.k_landmark_idx = [idx.to(self.device) for idx in self.k_landmark_idx]
+        self.update_landmark_mask()
 
         self.gemm_o = self.gemm_o.to(self.device)
         self.softmax_o = self.softmax_o.to(self.device)
@@ -682,10 +1345,92 @@ class ShadowKVCache_CPU:
         self.temp = self.temp.to(self.device)
         self.output = self.output.to(self.device)
 
-        torch.cuda.synchronize()
-        gc.collect()
-        torch.cuda.empty_cache()
-        torch.cuda.synchronize()
+        if self.compact_every is not None:
+            # least-squares projection onto the key basis, see project_keys()
+            self.SV_pinv = [sv_pinv(sv) for sv in self.SV]
+
+        if torch.cuda.is_available() and self.memory_cleanup and moved:
+            torch.cuda.synchronize()
+            gc.collect()
+            torch.cuda.empty_cache()
+            torch.cuda.synchronize()
+
+    def quantize_u(self, sample_rows=4096):
+        # U [bsz, seq, rank] --> int8 / fp8 U and per-row scales [bsz, seq] on the device, one sequence at a time
+        self.U_scale = []
+        self.u_quant_errors = []
+        for layer_idx in range(self.num_layers):
+            u = self.U[layer_idx]
+            u_q = torch.empty(u.shape, device=self.device, dtype=torch.int8 if self.u_quant == 'int8' else torch.float8_e4m3fn)
+            u_scale = torch.empty(u.shape[:2], device=self.device, dtype=torch.float32)
+            err, ref = 0.0, 0.0
+            for b in range(u.shape[0]):
+                u_b = u[b].to(self.device)
+                u_q[b], u_scale[b] = quantize_rows(u_b, self.u_quant)
+
+                # key reconstruction error on a strided sample of rows, [rows, rank] @ [rank, 1024]
+                rows = torch.arange(0, self.prefill_lens[b], max(1, self.prefill_lens[b] // sample_rows), device=self.device)
+                sv = self.SV[layer_idx][b].permute(2, 0, 1).reshape(u.shape[-1], -1).float() # [rank, 8*128]
+                k = torch.matmul(u_b[rows].float(), sv)
+                k_hat = torch.matmul(dequantize_rows(u_q[b][rows], u_scale[b][rows], torch.float32), sv)
+                err += (k - k_hat).square().sum().item()
+                ref += k.square().sum().item()
+            self.U[layer_idx] = u_q
+            self.U_scale.append(u_scale)
+            self.u_quant_errors.append((err / max(ref, 1e-12)) ** 0.5)
+
+    def project_keys(self, key_states, layer_idx):
+        # U rows of new tokens from their pre-RoPE keys, [bsz, q_len, 1024] OR [bsz, 8, q_len, 128]
+        if key_states.dim() == 4:
+            key_states = key_states.transpose(1, 2)
+        q_len = key_states.shape[1]
+        key_states = key_states.reshape(self.batch_size, q_len, -1).float()
+        u = torch.matmul(key_states, self.SV_pinv[layer_idx])
+        rows = self.kv_lens.unsqueeze(-1) + torch.arange(q_len, device=self.kv_lens.device) # [bsz, q_len], per slot
+        if self.U_scale is not None:
+            u, self.U_scale[layer_idx][self.batch_idx, rows] = quantize_rows(u, self.u_quant)
+        self.U[layer_idx][self.batch_idx, rows] = u.to(self.U[layer_idx].dtype)
+
+    def compact(self):
+        # fold the oldest compact_every tokens of the local window (prefill local + generated) of every slot that generated
+        # at least compact_every tokens into its offloaded chunks: values go to v_cache_cpu, their landmarks join k_landmark,
+        # keys are rebuilt from U (see project_keys)
+        fold = self.compact_every
+        new_chunks = fold // self.chunk_size
+        slots = [slot for slot in range(self.batch_size) if self.gen_lens[slot] >= fold]
+        slot_idx = torch.tensor(slots, device=self.device)
+        for layer_idx in range(self.num_layers):
+            tail_start = self.sparse_end[layer_idx]
+            k_buffer, v_buffer = self.k_cache_buffer[layer_idx], self.v_cache_buffer[layer_idx]
+            # [slots, 8, tail capacity, 128], the local window of every slot starts at sparse_end
+            local_k = k_buffer[slot_idx, :, tail_start:]
+            local_v = v_buffer[slot_idx, :, tail_start:]
+
+            folded_v = local_v[:, :, :fold].reshape(len(slots), self.num_key_value_heads, new_chunks, self.chunk_size*self.head_dim)
+            for i, slot in enumerate(slots):
+                self.write_values(layer_idx, slot, self.ctx_chunks[slot], folded_v[i:i + 1])
+
+            # new landmarks go after the current ones of each slot, [slots, new_chunks]
+            landmarks = local_k[:, :, :fold].view(len(slots), self.num_key_value_heads, new_chunks, self.chunk_size, self.head_dim).mean(dim=-2)
+            num_landmarks = [self.ctx_chunks[slot] - self.outlier_chunks[layer_idx] for slot in slots]
+            self.reserve_landmarks(layer_idx, max(num_landmarks) + new_chunks)
+            landmark_device = self.k_landmark[layer_idx].device
+            steps = torch.arange(new_chunks, device=landmark_device)
+            landmark_pos = torch.tensor(num_landmarks, device=landmark_device).unsqueeze(-1) + steps
+            landmark_idx = torch.tensor([self.ctx_chunks[slot] for slot in slots], device=landmark_device).unsqueeze(-1) + steps
+            rows = slot_idx.unsqueeze(-1).to(landmark_device)
+            self.k_landmark[layer_idx][rows, :, landmark_pos] = landmarks.transpose(1, 2).to(landmark_device)
+            self.k_landmark_idx[layer_idx][rows, :, landmark_pos] = landmark_idx.unsqueeze(-1).expand(-1, -1, self.num_key_value_heads)
+
+            # shift the window of the folded slots
+            k_buffer[slot_idx, :, tail_start:tail_start + local_k.shape[2] - fold] = local_k[:, :, fold:]
+            v_buffer[slot_idx, :, tail_start:tail_start + local_v.shape[2] - fold] = local_v[:, :, fold:]
+        self.wait_host_copies()
+        for slot in slots:
+            self.ctx_chunks[slot] += new_chunks
+            self.gen_lens[slot] -= fold
+        self.sync_lens()
+        self.update_landmark_mask()
 
     def update_kv_cache(self, 
             new_k_cache :torch.Tensor,
@@ -694,27 +1439,137 @@ class ShadowKVCache_CPU:
             ):
 
         incoming = new_k_cache.shape[-2]
-        self.v_cache_buffer[layer_idx][:, :, self.sparse_end+self.gen_offset:self.sparse_end+self.gen_offset+incoming].copy_(new_v_cache, non_blocking=True)
-        self.k_cache_buffer[layer_idx][:, :, self.sparse_end+self.gen_offset:self.sparse_end+self.gen_offset+incoming].copy_(new_k_cache, non_blocking=True)
+        if layer_idx == 0 and incoming > self.append_room():
+            raise ValueError(f"Cannot append {incoming} tokens, the local window has room for {self.append_room()}")
+        # every slot appends after its own tail, [bsz, incoming] buffer positions
+        gen_pos = self.tail_lens.unsqueeze(-1) + torch.arange(self.sparse_end[layer_idx], self.sparse_end[layer_idx] + incoming, device=self.tail_lens.device)
+        self.v_cache_buffer[layer_idx][self.batch_idx, :, gen_pos] = new_v_cache.transpose(1, 2)
+        self.k_cache_buffer[layer_idx][self.batch_idx, :, gen_pos] = new_k_cache.transpose(1, 2)
 
         if layer_idx == self.num_layers - 1:
-            self.kv_offset += incoming
-            self.gen_offset += incoming
+            # retired slots keep their length, the tokens they are fed are overwritten by the next step
+            step = self.active_mask * incoming
+            self.kv_lens += step
+            self.tail_lens += step
+            if not self.capturing:
+                self.advance_lens(incoming)
+
+    def advance_lens(self, incoming):
+        # host side of update_kv_cache, called after every replay of a captured decode step
+        self.seq_lens = [n + incoming if a else n for n, a in zip(self.seq_lens, self.active)]
+        self.gen_lens = [n + incoming if a else n for n, a in zip(self.gen_lens, self.active)]
+        self.tail_max = max(l + g for l, g in zip(self.local_lens, self.gen_lens))
+
+        # a multi-token step may leave more than one fold in the window
+        while self.compact_every is not None and max(self.gen_lens) >= self.compact_every:
+            self.compact()
 
     def clear(self):
-        self.k_cache_buffer.zero_()
-        self.v_cache_buffer.zero_()
+        # O(1), nothing is zeroed: a slot is only read up to its own lengths (get_cache_seqlens), and prefill
+        # rewrites its outlier and sparse regions and its local window
         self.k_landmark = None
         self.k_landmark_idx = None
+        self.landmark_mask = [None] * self.num_layers
         self.U = None
         self.SV = None
 
-        self.kv_offset = 0
-        self.prefill = 0
-        self.gen_offset = 0
-        self.prefill_local = 0
-
         self.prefilled_batch = 0
+        self.slot_prefill = None
+        self.host_writer.discard()
+        self.artifact_device = 'cpu'
+        self.layout_epoch += 1
+        self.reset_lens()
+        self.svd_errors = []
+        self.SV_pinv = None
+        self.U_scale = None
+        self.u_quant_errors = []
+
+    def snapshot(self):
+        # host copy of a fully prefilled context, see models/prefix_cache.py
+        # per-layer tensors are lists since budget and rank can differ between layers
+        assert self.prefilled_batch == self.batch_size, f"snapshot needs a fully prefilled batch, got {self.prefilled_batch}/{self.batch_size}"
+        self.wait_host_copies(host=True)
+        self.host_writer.flush()
+        state = {
+            'seq_lens': list(self.seq_lens),
+            'prefill_lens': list(self.prefill_lens),
+            'ctx_chunks': list(self.ctx_chunks),
+            'local_lens': list(self.local_lens),
+            'gen_lens': list(self.gen_lens),
+            'active': list(self.active),
+            'sparse_start': list(self.sparse_start),
+            'sparse_end': list(self.sparse_end),
+            'kernel_offset': list(self.kernel_offset),
+            'kernel_stride': list(self.kernel_stride),
+            'U': [u.to('cpu', copy=True) for u in self.U],
+            'SV': [sv.to('cpu', copy=True) for sv in self.SV],
+            'k_landmark': [k.to('cpu', copy=True) for k in self.k_landmark],
+            'k_landmark_idx': [idx.to('cpu', copy=True) for idx in self.k_landmark_idx],
+            'position_ids': [p.to('cpu', copy=True) for p in self.position_ids],
+            'v_cache_cpu': self.v_cache_cpu[:, :, :, :max(self.ctx_chunks)].to('cpu', copy=True),
+            'k_cache_buffer': [k[:, :, :end + self.tail_max].to('cpu', copy=True) for k, end in zip(self.k_cache_buffer, self.sparse_end)],
+            'v_cache_buffer': [v[:, :, :end + self.tail_max].to('cpu', copy=True) for v, end in zip(self.v_cache_buffer, self.sparse_end)],
+        }
+        if self.U_scale is not None:
+            # U is already quantized after H2D()
+            state['U_scale'] = [scale.to('cpu', copy=True) for scale in self.U_scale]
+        return state
+
+    def restore(self, state):
+        # leaves the cache in the same state as right after prefill, call H2D() before decoding
+        self.clear()
+        for name in ['seq_lens', 'prefill_lens', 'ctx_chunks', 'local_lens', 'gen_lens', 'sparse_start', 'sparse_end', 'kernel_offset', 'kernel_stride']:
+            setattr(self, name, list(state[name]))
+        self.active = list(state['active'])
+        self.U = [u.clone() for u in state['U']]
+        self.U_scale = [scale.clone() for scale in state['U_scale']] if 'U_scale' in state else None
+        self.SV = [sv.clone() for sv in state['SV']]
+        self.k_landmark = [k.clone() for k in state['k_landmark']]
+        self.k_landmark_idx = [idx.clone() for idx in state['k_landmark_idx']]
+        self.init_gemm_softmax_buffers(max(k.shape[-2] for k in self.k_landmark))
+
+        for layer_idx in range(self.num_layers):
+            cached = state['k_cache_buffer'][layer_idx].shape[-2]
+            host_chunks = state['v_cache_cpu'][layer_idx].shape[-2]
+            self.position_ids[layer_idx].copy_(state['position_ids'][layer_idx])
+            self.v_cache_cpu[layer_idx, :, :, :host_chunks].copy_(state['v_cache_cpu'][layer_idx])
+            self.k_cache_buffer[layer_idx][:, :, :cached].copy_(state['k_cache_buffer'][layer_idx])
+            self.v_cache_buffer[layer_idx][:, :, :cached].copy_(state['v_cache_buffer'][layer_idx])
+        self.prefilled_batch = self.batch_size
+        self.sync_lens()
+
+    def meta(self):
+        return {
+            'num_layers': self.num_layers,
+            'batch_size': self.batch_size,
+            'num_key_value_heads': self.num_key_value_heads,
+            'head_dim': self.head_dim,
+            'sparse_budget': self.sparse_budget,
+            'chunk_size': self.chunk_size,
+            'rank': self.rank,
+            'local_chunk': self.local_chunk,
+            'outlier_chunk': self.outlier_chunk,
+            'dtype': str(self.dtype).replace('torch.', ''),
+            'sparse_budgets': self.sparse_budgets,
+            'ranks': self.ranks,
+            'value_quant': self.value_quant,
+            'u_quant': self.u_quant,
+        }
+
+    def save(self, path, compression=None):
+        """Write the prefilled context to `path`, optionally zstd compressed."""
+        save_snapshot(path, self.snapshot(), self.meta(), compression=compression)
+
+    def load(self, path):
+        """Restore a context written by save(), skipping the prefill forward and SVD."""
+        meta, state = load_snapshot(path)
+        for k, v in self.meta().items():
+            if meta[k] != v:
+                raise ValueError(f"Context {path} was saved with {k}={meta[k]}, but this cache has {k}={v}")
+        prefill = max(state['prefill_lens'])
+        if prefill > self.max_length:
+            raise ValueError(f"Context {path} holds {prefill} tokens, more than max_length {self.max_length}")
+        self.restore(state)
 
     def get_kv_len(self):
         return self.kv_offset
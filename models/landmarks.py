@@ -0,0 +1,154 @@
+################################################################################
+#
+# Copyright 2024 ByteDance Ltd. and/or its affiliates. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+
+# Landmark and outlier construction of the ShadowKV prefill
+#
+# For every chunk of chunk_size post-RoPE keys the landmark is the mean key, and the chunks whose keys are
+# least similar to their mean (min cosine similarity) are kept exactly as outliers. The remaining landmarks
+# are registered for retrieval and the last prompt query selects the first sparse set from them.
+#
+# build_landmarks does this in one pass over the keys without prompt-sized temporaries: the mean and the min
+# cosine similarity are taken over blocks of block_chunks chunks, comparing the keys with the broadcast mean
+# instead of an expanded copy of the landmarks. The complement of the outliers comes from a stable sort of
+# the outlier mask (no masked_select and no host sync), and the first selection scores the gathered
+# landmarks on the device instead of reading them back from the registered landmark cache.
+# build_landmarks_reference is the original implementation, landmark_report compares both.
+
+import math
+import time
+
+import torch
+import torch.nn as nn
+
+
+def chunk_landmarks(key_states_roped_ctx, block_chunks :int = 1024):
+    # [bsz, kv_heads, chunks, chunk_size, head_dim] --> landmarks [bsz, kv_heads, chunks, head_dim], min cos sim [bsz, kv_heads, chunks]
+    bsz, heads, chunks, _, head_dim = key_states_roped_ctx.shape
+    landmarks = torch.empty(bsz, heads, chunks, head_dim, device=key_states_roped_ctx.device, dtype=key_states_roped_ctx.dtype)
+    min_sim = torch.empty(bsz, heads, chunks, device=key_states_roped_ctx.device, dtype=key_states_roped_ctx.dtype)
+    for start in range(0, chunks, block_chunks):
+        block = key_states_roped_ctx[:, :, start:start + block_chunks]
+        mean = block.mean(dim=-2) # [bsz, kv_heads, block, head_dim]
+        landmarks[:, :, start:start + block_chunks] = mean
+        # same steps as torch.nn.functional.cosine_similarity, the mean is broadcast instead of expanded
+        k = block / torch.linalg.vector_norm(block, dim=-1, keepdim=True).clamp_min(1e-8)
+        m = mean / torch.linalg.vector_norm(mean, dim=-1, keepdim=True).clamp_min(1e-8)
+        min_sim[:, :, start:start + block_chunks] = (k * m.unsqueeze(-2)).sum(dim=-1).amin(dim=-1) # [bsz, kv_heads, block, chunk_size] --> [bsz, kv_heads, block]
+    return landmarks, min_sim
+
+
+def split_outliers(chunk_min_sim, outlier_chunk :int):
+    # [bsz, kv_heads, chunks] --> outlier chunk ids [bsz, kv_heads, outlier_chunk], the rest in ascending order [bsz, kv_heads, chunks - outlier_chunk]
+    chunks = chunk_min_sim.shape[-1]
+    outlier_chunk_idx = chunk_min_sim.topk(outlier_chunk, largest=False).indices
+    is_outlier = torch.zeros_like(chunk_min_sim, dtype=torch.uint8).scatter_(dim=-1, index=outlier_chunk_idx, value=1)
+    rest_idx = torch.sort(is_outlier, dim=-1, stable=True).indices[..., :chunks - outlier_chunk]
+    return outlier_chunk_idx, rest_idx
+
+
+def initial_selection(last_query_states, landmarks, landmark_idx, select_sets :int):
+    # last_query_states [bsz, heads, 1, head_dim], landmarks [bsz, kv_heads, n, head_dim]
+    # --> landmark softmax [bsz, kv_heads, groups, n], selected chunk ids [bsz, kv_heads, select_sets]
+    bsz, kv_heads, _, head_dim = landmarks.shape
+    chunk_attn = torch.einsum('bhgd,bhcd->bhgc', last_query_states.reshape(bsz, kv_heads, -1, head_dim), landmarks) / math.sqrt(128) # [bsz, 8, 4, chunks]
+    chunk_attn = nn.functional.softmax(chunk_attn, dim=-1, dtype=torch.float32).to(landmarks.dtype)
+    merged_results = torch.topk(chunk_attn.max(dim=-2).values, k=select_sets, dim=-1).indices # [bsz, 8, select_sets]
+    return chunk_attn, landmark_idx.gather(dim=-1, index=merged_results)
+
+
+def build_landmarks(key_states_roped_ctx, outlier_chunk :int, last_query_states, select_sets :int, landmark_candidates=None, chunk_min_sim=None, block_chunks :int = 1024):
+    """Landmarks, outliers and the first selection of one layer.
+
+    Takes the chunked post-RoPE keys [bsz, kv_heads, chunks, chunk_size, head_dim], or the landmark_candidates
+    and chunk_min_sim already built window by window (streaming prefill). Returns the outlier chunk ids, the
+    landmarks of the remaining chunks and their chunk ids, the landmark softmax of the last query and the
+    selected chunk ids.
+    """
+    if landmark_candidates is None:
+        landmark_candidates, chunk_min_sim = chunk_landmarks(key_states_roped_ctx, block_chunks)
+    outlier_chunk_idx, rest_idx = split_outliers(chunk_min_sim, outlier_chunk)
+    landmarks = landmark_candidates.gather(dim=2, index=rest_idx.unsqueeze(-1).expand(-1, -1, -1, landmark_candidates.shape[-1])) # [bsz, kv_heads, chunks - outlier_chunk, head_dim]
+    chunk_attn, selected_chunks = initial_selection(last_query_states, landmarks, rest_idx, select_sets)
+    return outlier_chunk_idx, landmarks, rest_idx, chunk_attn, selected_chunks
+
+
+def build_landmarks_reference(key_states_roped_ctx, outlier_chunk :int, last_query_states, select_sets :int):
+    # the original prefill_kv_cache path, full-size cosine similarity against expanded landmarks and masked_select
+    bsz, kv_heads, chunks, chunk_size, head_dim = key_states_roped_ctx.shape
+    landmark_candidates = key_states_roped_ctx.mean(dim=-2) # [bsz, kv_heads, chunks, head_dim]
+    cos_sim = torch.nn.functional.cosine_similarity(landmark_candidates.unsqueeze(3).expand(-1, -1, -1, chunk_size, -1), key_states_roped_ctx, dim=-1) # [bsz, kv_heads, chunks, chunk_size]
+    outlier_chunk_idx = cos_sim.min(dim=-1).values.topk(outlier_chunk, largest=False).indices
+
+    all_idx = torch.arange(chunks, device=key_states_roped_ctx.device).unsqueeze(0).unsqueeze(0).expand(bsz, kv_heads, -1) # [bsz, kv_heads, chunks]
+    mask = torch.ones_like(all_idx, dtype=torch.bool)
+    mask.scatter_(dim=-1, index=outlier_chunk_idx, value=False)
+    rest_idx = all_idx.masked_select(mask).view(bsz, kv_heads, -1)
+    landmarks = landmark_candidates.gather(dim=2, index=rest_idx.unsqueeze(-1).expand(-1, -1, -1, head_dim)).view(bsz, kv_heads, -1, head_dim)
+
+    chunk_attn = torch.einsum('bhgd,bhcd->bhgc', last_query_states.view(-1, kv_heads, last_query_states.shape[1] // kv_heads, head_dim), landmarks) / math.sqrt(128)
+    chunk_attn = nn.functional.softmax(chunk_attn, dim=-1, dtype=torch.float32).to(landmarks.dtype)
+    merged_results = torch.topk(torch.max(chunk_attn, dim=-2).values, k=select_sets, dim=-1).indices
+    return outlier_chunk_idx, landmarks, rest_idx, chunk_attn, rest_idx.gather(dim=-1, index=merged_results)
+
+
+def _overlap(a, b):
+    # mean fraction of the ids in a that are also in b, per row of the last dim
+    return (a.unsqueeze(-1) == b.unsqueeze(-2)).any(dim=-1).float().mean().item()
+
+
+def landmark_report(key_states_roped, outlier_chunk :int, select_sets :int, chunk_size :int = 8, last_query_states=None, block_chunks :int = 1024, verbose=True):
+    """Compare build_landmarks against build_landmarks_reference on one layer of post-RoPE keys [bsz, kv_heads, seq, head_dim].
+
+    For each builder returns the wall time and (on CUDA) the peak memory added on top of the keys, plus the
+    agreement of the fused builder with the reference: max landmark difference, outlier and selection overlap.
+    """
+    bsz, kv_heads, seq_len, head_dim = key_states_roped.shape
+    chunks = seq_len // chunk_size
+    ctx = key_states_roped[:, :, :chunks * chunk_size].view(bsz, kv_heads, chunks, chunk_size, head_dim)
+    if last_query_states is None:
+        last_query_states = torch.randn(bsz, kv_heads * 4, 1, head_dim, device=key_states_roped.device, dtype=key_states_roped.dtype)
+
+    builders = {
+        'reference': lambda: build_landmarks_reference(ctx, outlier_chunk, last_query_states, select_sets),
+        'fused': lambda: build_landmarks(ctx, outlier_chunk, last_query_states, select_sets, block_chunks=block_chunks),
+    }
+    report, outputs = {}, {}
+    for name, build in builders.items():
+        if key_states_roped.is_cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats(key_states_roped.device)
+            base = torch.cuda.memory_allocated(key_states_roped.device)
+        start = time.time()
+        outputs[name] = build()
+        if key_states_roped.is_cuda:
+            torch.cuda.synchronize()
+        elapsed = time.time() - start
+        peak = torch.cuda.max_memory_allocated(key_states_roped.device) - base if key_states_roped.is_cuda else 0
+        report[name] = {'time': elapsed, 'peak_memory': peak}
+
+    ref_outliers, ref_landmarks, ref_rest, _, ref_selected = outputs['reference']
+    outliers, landmarks, rest, _, selected = outputs['fused']
+    report['fused']['outlier_overlap'] = _overlap(outliers, ref_outliers)
+    report['fused']['selection_overlap'] = _overlap(selected, ref_selected)
+    if torch.equal(rest, ref_rest):
+        report['fused']['landmark_max_diff'] = (landmarks.float() - ref_landmarks.float()).abs().max().item()
+
+    if verbose:
+        for name, r in report.items():
+            agreement = f" | outliers {r['outlier_overlap']:.4f} | selection {r['selection_overlap']:.4f}" if 'outlier_overlap' in r else ""
+            print(f"Landmarks {name:>9} | seq {seq_len} | {r['time']:.3f}s | peak {r['peak_memory'] / 1024**3:.2f} GB{agreement}")
+    return report
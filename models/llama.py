@@ -25,10 +25,12 @@ from transformers import LlamaForCausalLM, LlamaConfig, AutoTokenizer
 from transformers.models.llama.modeling_llama import LlamaDecoderLayer
 transformers.logging.set_verbosity_error()
 
-import vllm
-from minference.configs.model2path import MODEL2PATH
+try:
+    from minference.configs.model2path import MODEL2PATH
+except ImportError:
+    MODEL2PATH = None
 
-from .tensor_op import layer_norm, apply_rotary_pos_emb, apply_rotary_pos_emb_single, apply_rotary_pos_emb_cuda
+from .tensor_op import layer_norm, apply_rotary_pos_emb, apply_rotary_pos_emb_single, apply_rotary_pos_emb_cuda, rotary_embedding, silu_and_mul
 from .prompt_template import Templates, Chat_Templates, Prefix_Templates
 from .base import LLM
 
@@ -85,7 +87,8 @@ class Llama(LLM):
         sparse_budget: int = 2048,
         rank=160,
         chunk_size=8,
-        minference=False) -> None:
+        minference=False,
+        **kv_cache_kwargs) -> None:
         
         # assert batch_size == 1, "Batch size must be 1"
         self.batch_size = batch_size
@@ -119,9 +122,11 @@ class Llama(LLM):
         else:
             raise ValueError(f"Invalid model name {model_name}")
 
-        self.init_kv_cache(sparse_budget, rank, chunk_size, self.config)
+        self.init_kv_cache(sparse_budget, rank, chunk_size, self.config, **kv_cache_kwargs)
 
         if self.minference:
+            if MODEL2PATH is None:
+                raise ValueError("minference=True needs the minference package")
             import json
             self.minference_parttern = []
             for layer_idx in range(self.num_layers):
@@ -140,7 +145,7 @@ class Llama(LLM):
 
     @torch.inference_mode()
     def apply_rotary_pos_emb(self, q: torch.Tensor, k: torch.Tensor, position_ids: torch.Tensor) -> torch.Tensor:
-        vllm._custom_ops.rotary_embedding(position_ids, q, k, 128, self.cos_sin_cache, True)
+        rotary_embedding(position_ids, q, k, 128, self.cos_sin_cache, True)
         bsz = q.shape[0]
         q = q.view(bsz, -1, self.num_heads, self.head_dim).transpose(1, 2)
         k = k.view(bsz, -1, self.num_key_value_heads, self.head_dim).transpose(1, 2)
@@ -202,7 +207,7 @@ class Llama(LLM):
         d = hidden_states.shape[-1] // 2
         output_shape = (hidden_states.shape[:-1] + (d, ))
         out = torch.empty(output_shape, dtype=hidden_states.dtype, device=hidden_states.device)
-        vllm._custom_ops.silu_and_mul(out, hidden_states)
+        silu_and_mul(out, hidden_states)
         
         hidden_states = F.linear(out, buffer.down_proj)
         hidden_states = residual + hidden_states
@@ -220,7 +225,8 @@ class Llama_with_H2O(LLM):
         sparse_budget: int = 2048,
         rank=160,
         chunk_size=8,
-        minference=False) -> None:
+        minference=False,
+        **kv_cache_kwargs) -> None:
         
         # assert batch_size == 1, "Batch size must be 1"
         self.batch_size = batch_size
@@ -254,9 +260,11 @@ class Llama_with_H2O(LLM):
         else:
             raise ValueError(f"Invalid model name {model_name}")
 
-        self.init_kv_cache(sparse_budget, rank, chunk_size, self.config)
+        self.init_kv_cache(sparse_budget, rank, chunk_size, self.config, **kv_cache_kwargs)
 
         if self.minference:
+            if MODEL2PATH is None:
+                raise ValueError("minference=True needs the minference package")
             import json
             self.minference_parttern = []
             for layer_idx in range(self.num_layers):
@@ -275,7 +283,7 @@ class Llama_with_H2O(LLM):
 
     @torch.inference_mode()
     def apply_rotary_pos_emb(self, q: torch.Tensor, k: torch.Tensor, position_ids: torch.Tensor) -> torch.Tensor:
-        vllm._custom_ops.rotary_embedding(position_ids, q, k, 128, self.cos_sin_cache, True)
+        rotary_embedding(position_ids, q, k, 128, self.cos_sin_cache, True)
         bsz = q.shape[0]
         q = q.view(bsz, -1, self.num_heads, self.head_dim).transpose(1, 2)
         k = k.view(bsz, -1, self.num_key_value_heads, self.head_dim).transpose(1, 2)
@@ -337,7 +345,7 @@ class Llama_with_H2O(LLM):
         d = hidden_states.shape[-1] // 2
         output_shape = (hidden_states.shape[:-1] + (d, ))
         out = torch.empty(output_shape, dtype=hidden_states.dtype, device=hidden_states.device)
-        vllm._custom_ops.silu_and_mul(out, hidden_states)
+        silu_and_mul(out, hidden_states)
         
         hidden_states = F.linear(out, buffer.down_proj)
         hidden_states = residual + hidden_states
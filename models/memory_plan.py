@@ -0,0 +1,269 @@
+################################################################################
+#
+# Copyright 2024 ByteDance Ltd. and/or its affiliates. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+
+# Analytic GPU memory plan of a batch
+#
+# Computes, from a model config alone, the bytes every allocation of a run takes: the weights the LLM classes
+# keep on the GPU, the KV_Cache of full attention, and the buffers of ShadowKVCache_CPU (k_cache_buffer /
+# v_cache_buffer, the kernel scratch, U, SV, the landmarks and the gemm softmax scratch) with the same shapes
+# kv_cache.py allocates them with, plus the transient memory of prefilling one prompt (prefill_planner.py).
+#
+# The GPU peak of a run is the weights and the resident buffers plus the larger of the prefill transient and
+# what H2D() moves to the GPU for decoding (the whole KV_Cache, or the ShadowKV prefill artifacts). plan_memory
+# searches the largest batch of each attention mode whose peak fits in a fraction of the device memory (and
+# of the host memory, which holds the offloaded values), and recommends a sparse budget for the context length.
+
+import math
+
+import torch
+
+from .budget import check_budget_map, load_budget_map
+from .prefill_planner import prefill_bytes_per_token, config_intermediate_size
+from .quant import RowQuantizer
+
+LOCAL_CHUNKS = 4 # chunks of the prompt tail kept exactly, ShadowKVCache_CPU.local_chunk
+TAIL_TOKENS = 128 # room for generated tokens in k_cache_buffer / v_cache_buffer
+
+
+def outlier_chunks(sparse_budget :int):
+    # chunks kept exactly besides the sparse budget, 24 per 1024 tokens of budget
+    return int((sparse_budget // 1024) * 24)
+
+
+def model_dims(config):
+    # sizes of HF Llama / Yi / Qwen2 / GLM-4 configs and of the GLMConfig wrapper the caches are built from
+    num_heads = config.num_attention_heads
+    return {
+        'num_layers': getattr(config, 'num_hidden_layers', None) or config.num_layers,
+        'hidden_size': config.hidden_size,
+        'num_heads': num_heads,
+        'num_kv_heads': getattr(config, 'num_key_value_heads', None) or getattr(config, 'multi_query_group_num', None) or num_heads,
+        'head_dim': config.hidden_size // num_heads,
+        'intermediate_size': config_intermediate_size(config),
+        'vocab_size': getattr(config, 'padded_vocab_size', None) or getattr(config, 'vocab_size', None) or 0,
+        'qkv_bias': bool(getattr(config, 'add_qkv_bias', False)) or getattr(config, 'model_type', None) == 'qwen2',
+    }
+
+
+def layer_budgets(num_layers :int, sparse_budget :int = 2048, rank :int = 160, budget_map=None, chunk_size :int = 8):
+    # per-layer sparse budgets and ranks, uniform unless a budget map from models/budget.py (or its path) is given
+    if budget_map is None:
+        return [int(sparse_budget)] * num_layers, [int(rank)] * num_layers
+    if isinstance(budget_map, str):
+        budget_map = load_budget_map(budget_map)
+    check_budget_map(budget_map, num_layers, chunk_size)
+    return [int(b) for b in budget_map['sparse_budget']], [int(r) for r in budget_map['rank']]
+
+
+def weight_bytes(config, max_length :int, dtype=torch.bfloat16):
+    """Bytes of the weights on the GPU: the fused per-layer matrices, the embeddings and the RoPE cache.
+
+    embed_tokens and lm_head are counted separately as the LLM classes copy both, the RoPE cache holds
+    max_length + 1024 positions.
+    """
+    d = model_dims(config)
+    elem = torch.finfo(dtype).bits // 8
+    h, kv_dim, inter = d['hidden_size'], d['num_kv_heads'] * d['head_dim'], d['intermediate_size']
+    qkv = h + 2 * kv_dim
+    layer = qkv * h + h * h + 2 * inter * h + inter * h + 2 * h # wqkv, wo, gate_up_proj, down_proj, layernorms
+    if d['qkv_bias']:
+        layer += qkv
+    return elem * (d['num_layers'] * layer + 2 * d['vocab_size'] * h + h + (max_length + 1024) * d['head_dim'])
+
+
+def kv_cache_bytes(config, batch_size :int, max_length :int, dtype=torch.bfloat16):
+    # KV_Cache: keys and values of every layer, on the host during prefill and on the GPU after H2D()
+    d = model_dims(config)
+    size = d['num_layers'] * batch_size * d['num_kv_heads'] * max_length * d['head_dim'] * (torch.finfo(dtype).bits // 8)
+    return {'k_cache': size, 'v_cache': size}
+
+
+def shadowkv_buffer_bytes(config, batch_size :int, sparse_budgets :list, chunk_size :int = 8, dtype=torch.bfloat16):
+    # the GPU buffers ShadowKVCache_CPU allocates in __init__
+    d = model_dims(config)
+    elem = torch.finfo(dtype).bits // 8
+    heads, head_dim = d['num_kv_heads'], d['head_dim']
+    block_num = batch_size * heads
+    select_sets = [b // chunk_size for b in sparse_budgets]
+    buffer = sum(batch_size * heads * (b + TAIL_TOKENS + (outlier_chunks(b) + LOCAL_CHUNKS) * chunk_size) * head_dim * elem for b in sparse_budgets)
+    return {
+        'k_cache_buffer': buffer,
+        'v_cache_buffer': buffer,
+        'offsets': block_num * max(select_sets) * 4,
+        'cnts_signals': 2 * block_num * 4,
+        'position_ids': sum(block_num * s * 8 for s in select_sets),
+        'lens': 4 * batch_size * 8, # batch_idx, kv_lens, tail_lens, active_mask
+    }
+
+
+def shadowkv_host_bytes(config, batch_size :int, max_length :int, chunk_size :int = 8, dtype=torch.bfloat16, value_quant :str = None):
+    # the offloaded values, v_cache_cpu or the rows of the quantized value store
+    d = model_dims(config)
+    rows = d['num_layers'] * batch_size * d['num_kv_heads'] * (max_length // chunk_size)
+    if value_quant is not None:
+        return {'v_cache_cpu': rows * RowQuantizer(value_quant, d['head_dim'] * chunk_size, d['head_dim']).row_bytes}
+    return {'v_cache_cpu': rows * d['head_dim'] * chunk_size * (torch.finfo(dtype).bits // 8)}
+
+
+def shadowkv_artifact_bytes(config, batch_size :int, prefill_len :int, max_length :int, sparse_budgets :list, ranks :list, chunk_size :int = 8,
+        dtype=torch.bfloat16, max_q_len :int = 1, max_landmarks :int = 0, compact_every :int = None, u_quant :str = None):
+    """Bytes of the ShadowKV prefill artifacts on the GPU once decoding starts, for prompts of prefill_len tokens.
+
+    U and SV (U kept in full precision until H2D() quantizes it, SV_pinv with compaction), the landmarks
+    and their chunk ids, the gemm softmax scratch and the key / value kernel scratch (temp, output).
+    """
+    d = model_dims(config)
+    elem = torch.finfo(dtype).bits // 8
+    bsz, heads, head_dim = batch_size, d['num_kv_heads'], d['head_dim']
+    u_len = max(prefill_len, max_length) if compact_every is not None else prefill_len
+    chunks = prefill_len // chunk_size - LOCAL_CHUNKS
+    chunks = chunks - chunks % 8
+    num_landmarks = [chunks - outlier_chunks(b) for b in sparse_budgets]
+    rows = d['num_heads'] // heads * max_q_len
+    max_landmarks = max(max(num_landmarks), max_landmarks)
+    footprint = {
+        'U': sum(bsz * u_len * rank * elem for rank in ranks),
+        'SV': sum(bsz * heads * head_dim * rank * elem for rank in ranks),
+        'k_landmark': sum(bsz * heads * n * head_dim * elem for n in num_landmarks),
+        'k_landmark_idx': sum(bsz * heads * n * 8 for n in num_landmarks),
+        'gemm_softmax': 2 * bsz * heads * rows * max_landmarks * 2 + 2 * bsz * heads * rows * ((max_landmarks + 255) // 256) * 4,
+        'temp': bsz * heads * (max(sparse_budgets) // chunk_size) * chunk_size * head_dim * elem,
+        'output': bsz * heads * max(sparse_budgets) * head_dim * elem,
+    }
+    if u_quant is not None:
+        # int8 / fp8 U and its float32 row scales next to the full-precision U while quantize_u() runs
+        footprint['U_quant'] = sum(bsz * u_len * (rank + 4) for rank in ranks)
+    if compact_every is not None:
+        footprint['SV_pinv'] = sum(bsz * heads * head_dim * rank * 4 for rank in ranks) # float32
+    return footprint
+
+
+def prefill_peak_bytes(config, seq_len :int, rank :int = 160, svd_method :str = 'exact', dtype=torch.bfloat16):
+    # transient GPU memory of prefilling one prompt, svd_method None for full attention, whose update_kv_cache
+    # moves the keys and values of the prompt to the GPU instead of factorizing them
+    d = model_dims(config)
+    elem = torch.finfo(dtype).bits // 8
+    kv_dim = d['num_kv_heads'] * d['head_dim']
+    per_token = prefill_bytes_per_token(d['hidden_size'], kv_dim, d['intermediate_size'], rank, svd_method, elem)
+    if svd_method is None:
+        per_token += elem * kv_dim
+    return seq_len * per_token
+
+
+def full_footprint(config, batch_size :int, context_len :int, max_length :int = None, dtype=torch.bfloat16):
+    # attn_mode full: the whole KV_Cache lives on the GPU for decoding
+    max_length = context_len if max_length is None else max_length
+    weights = weight_bytes(config, max_length, dtype)
+    kv = kv_cache_bytes(config, batch_size, max_length, dtype)
+    prefill = prefill_peak_bytes(config, context_len, svd_method=None, dtype=dtype)
+    return {
+        'weights': weights,
+        'kv_cache': kv,
+        'prefill': prefill,
+        'gpu_peak': weights + max(prefill, sum(kv.values())),
+        'host': sum(kv.values()),
+    }
+
+
+def shadowkv_footprint(config, batch_size :int, context_len :int, max_length :int = None, sparse_budget :int = 2048, rank :int = 160, chunk_size :int = 8,
+        dtype=torch.bfloat16, budget_map=None, svd_method :str = 'exact', compact_every :int = None, u_quant :str = None, value_quant :str = None):
+    """GPU and host bytes of attn_mode shadowkv_cpu for batch_size prompts of context_len tokens.
+
+    The buffers stay on the GPU for the whole run, the prefill of one prompt (the smallest sub-batch of
+    batch_prefill) comes before the artifacts are needed on the GPU. The host holds the offloaded values and,
+    in the worst case of artifact_placement 'cpu', the artifacts until H2D().
+    """
+    max_length = context_len if max_length is None else max_length
+    sparse_budgets, ranks = layer_budgets(model_dims(config)['num_layers'], sparse_budget, rank, budget_map, chunk_size)
+    weights = weight_bytes(config, max_length, dtype)
+    buffers = shadowkv_buffer_bytes(config, batch_size, sparse_budgets, chunk_size, dtype)
+    artifacts = shadowkv_artifact_bytes(config, batch_size, context_len, max_length, sparse_budgets, ranks, chunk_size, dtype, compact_every=compact_every, u_quant=u_quant)
+    prefill = prefill_peak_bytes(config, context_len, max(ranks), svd_method, dtype)
+    host = shadowkv_host_bytes(config, batch_size, max_length, chunk_size, dtype, value_quant)
+    return {
+        'weights': weights,
+        'buffers': buffers,
+        'artifacts': artifacts,
+        'prefill': prefill,
+        'gpu_peak': weights + sum(buffers.values()) + max(prefill, sum(artifacts.values())),
+        'host': sum(host.values()) + sum(artifacts.values()),
+    }
+
+
+def max_batch_size(footprint, device_memory :int, host_memory :int = None, memory_fraction :float = 0.9, max_batch :int = 1024):
+    # largest batch whose footprint(batch_size) fits, 0 if a single prompt does not, the footprint grows with the batch
+    def fits(batch_size):
+        f = footprint(batch_size)
+        return f['gpu_peak'] <= memory_fraction * device_memory and (host_memory is None or f['host'] <= memory_fraction * host_memory)
+    lo, hi = 0, max_batch
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if fits(mid):
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def recommended_sparse_budget(context_len :int, chunk_size :int = 8):
+    # about 1/64 of the context (1.56%, the budget ShadowKV is evaluated with), rounded to a power of two, at least 1024
+    budget = 2 ** round(math.log2(max(context_len / 64, 1)))
+    return max(1024, budget - budget % chunk_size)
+
+
+def plan_memory(config, context_len :int, device_memory :int, host_memory :int = None, dtype=torch.bfloat16, sparse_budget :int = None, rank :int = 160,
+        chunk_size :int = 8, memory_fraction :float = 0.9, max_batch :int = 1024, verbose=True, **shadowkv_kwargs):
+    """Largest feasible batch of full attention and of shadowkv_cpu for prompts of context_len tokens.
+
+    device_memory and host_memory are in bytes, a batch fits when its peak stays within memory_fraction of
+    them. sparse_budget defaults to recommended_sparse_budget(context_len), shadowkv_kwargs are passed to
+    shadowkv_footprint (max_length, budget_map, svd_method, compact_every, u_quant, value_quant). Returns the
+    budget, rank, both batch sizes and the footprints at those batch sizes.
+    """
+    if not 0 < memory_fraction <= 1:
+        raise ValueError(f"memory_fraction must be in (0, 1], got {memory_fraction}")
+    if sparse_budget is None:
+        sparse_budget = recommended_sparse_budget(context_len, chunk_size)
+    if sparse_budget % chunk_size != 0:
+        raise ValueError(f"sparse_budget {sparse_budget} must be a multiple of chunk_size {chunk_size}")
+    max_length = shadowkv_kwargs.get('max_length')
+
+    full = lambda bsz: full_footprint(config, bsz, context_len, max_length, dtype)
+    shadowkv = lambda bsz: shadowkv_footprint(config, bsz, context_len, sparse_budget=sparse_budget, rank=rank, chunk_size=chunk_size, dtype=dtype, **shadowkv_kwargs)
+    baseline_bsz = max_batch_size(full, device_memory, host_memory, memory_fraction, max_batch)
+    shadowkv_bsz = max_batch_size(shadowkv, device_memory, host_memory, memory_fraction, max_batch)
+    plan = {
+        'context_len': context_len,
+        'sparse_budget': sparse_budget,
+        'rank': rank,
+        'baseline_bsz': baseline_bsz,
+        'shadowkv_bsz': shadowkv_bsz,
+        'baseline': full(max(baseline_bsz, 1)),
+        'shadowkv': shadowkv(max(shadowkv_bsz, 1)),
+    }
+    if verbose:
+        print_plan(plan, device_memory)
+    return plan
+
+
+def print_plan(plan, device_memory :int):
+    gb = lambda b: b / 1024**3
+    print(f"MemoryPlan | context {plan['context_len']} | device {gb(device_memory):.2f} GB | sparse budget {plan['sparse_budget']} | rank {plan['rank']} | baseline bsz {plan['baseline_bsz']} | shadowkv bsz {plan['shadowkv_bsz']}")
+    full, shadowkv = plan['baseline'], plan['shadowkv']
+    print(f"Full bsz {max(plan['baseline_bsz'], 1)} | weights {gb(full['weights']):.2f} GB | kv_cache {gb(sum(full['kv_cache'].values())):.2f} GB | prefill {gb(full['prefill']):.2f} GB | peak {gb(full['gpu_peak']):.2f} GB | host {gb(full['host']):.2f} GB")
+    parts = ' | '.join(f"{name} {gb(size):.2f} GB" for name, size in {**shadowkv['buffers'], **shadowkv['artifacts']}.items() if size >= 1024**2)
+    print(f"ShadowKV bsz {max(plan['shadowkv_bsz'], 1)} | weights {gb(shadowkv['weights']):.2f} GB | {parts} | prefill {gb(shadowkv['prefill']):.2f} GB | peak {gb(shadowkv['gpu_peak']):.2f} GB | host {gb(shadowkv['host']):.2f} GB")
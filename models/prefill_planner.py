@@ -0,0 +1,122 @@
+################################################################################
+#
+# Copyright 2024 ByteDance Ltd. and/or its affiliates. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+
+# Sub-batch planning for LLM.batch_prefill
+#
+# A batch is prefilled in sub-batches of whole prompts. PrefillPlanner sizes each sub-batch from the GPU
+# memory that is free right now and the transient memory of one prompt: an analytic bytes-per-token estimate
+# of the activations of one layer and the key SVD (prefill_bytes_per_token) until the first sub-batch has
+# run, then the measured peak per prompt of the sub-batches so far. Without a GPU the sub-batch size falls
+# back to the fixed rule batch_prefill used before. Every sub-batch is recorded with its size, wall time
+# and peak memory for print_stats().
+
+import time
+
+import torch
+
+
+def prefill_bytes_per_token(hidden_size :int, kv_dim :int, intermediate_size :int, rank :int, svd_method :str = 'exact', dtype_bytes :int = 2):
+    """Upper bound of the transient GPU memory per prompt token while one layer is prefilled.
+
+    Activations: hidden states and residual, qkv and the RoPEd query / key, attention output, gate_up and
+    the MLP product. Key SVD: 'exact' factorizes a float copy of the whole key matrix (with its left
+    factors and workspace), 'gram' / 'randomized' only keep float rows of the kept rank, None for no SVD.
+    """
+    activations = dtype_bytes * (2 * hidden_size + (hidden_size + 2 * kv_dim) + (hidden_size + kv_dim) + hidden_size + 3 * intermediate_size)
+    if svd_method is None:
+        svd = 0
+    else:
+        svd = 4 * 3 * kv_dim if svd_method == 'exact' else 4 * (kv_dim + rank)
+    values = dtype_bytes * kv_dim # values of the offloaded chunks, in flight to the host store
+    return activations + svd + values
+
+
+def config_intermediate_size(config):
+    # MLP width, GLM names it ffn_hidden_size
+    return getattr(config, 'intermediate_size', None) or getattr(config, 'ffn_hidden_size', None) or 4 * config.hidden_size
+
+
+def default_sub_batch(seq_len :int):
+    # the fixed rule of batch_prefill before the planner
+    return 8 if 120*1024 < seq_len < 200*1024 else 4
+
+
+class PrefillPlanner:
+    def __init__(self, llm, max_sub_batch :int = 8, memory_fraction :float = 0.9) -> None:
+        if max_sub_batch < 1:
+            raise ValueError(f"max_sub_batch must be at least 1, got {max_sub_batch}")
+        if not 0 < memory_fraction <= 1:
+            raise ValueError(f"memory_fraction must be in (0, 1], got {memory_fraction}")
+        self.llm = llm
+        self.max_sub_batch = max_sub_batch
+        self.memory_fraction = memory_fraction
+        intermediate_size = config_intermediate_size(llm.config)
+        kv_cache = llm.kv_cache
+        rank = max(getattr(kv_cache, 'ranks', [getattr(kv_cache, 'rank', 160)]))
+        svd_method = getattr(kv_cache, 'svd_method', 'exact')
+        self.estimated_bytes_per_token = prefill_bytes_per_token(llm.hidden_size, llm.num_key_value_heads * llm.head_dim, intermediate_size, rank, svd_method, torch.finfo(llm.dtype).bits // 8)
+        self.measured_bytes_per_token = None
+        self.records = []
+
+    def reset(self):
+        # per-batch records, the measured bytes per token carry over to the next batch
+        self.records = []
+
+    def bytes_per_token(self):
+        return self.measured_bytes_per_token if self.measured_bytes_per_token is not None else self.estimated_bytes_per_token
+
+    def available_memory(self):
+        # free device memory plus what the caching allocator holds but does not use, None without a GPU
+        if not torch.cuda.is_available() or not str(self.llm.device).startswith('cuda'):
+            return None
+        free, _ = torch.cuda.mem_get_info(self.llm.device)
+        return free + torch.cuda.memory_reserved(self.llm.device) - torch.cuda.memory_allocated(self.llm.device)
+
+    def sub_batch_size(self, remaining :int, seq_len :int):
+        available = self.available_memory()
+        if available is None:
+            size = default_sub_batch(seq_len)
+        else:
+            size = int(available * self.memory_fraction) // max(self.bytes_per_token() * seq_len, 1)
+        return max(1, min(size, self.max_sub_batch, remaining))
+
+    def begin(self):
+        if torch.cuda.is_available() and str(self.llm.device).startswith('cuda'):
+            torch.cuda.current_stream(self.llm.device).synchronize()
+            torch.cuda.reset_peak_memory_stats(self.llm.device)
+            self.base_memory = torch.cuda.memory_allocated(self.llm.device)
+        self.start = time.time()
+
+    def end(self, start :int, size :int, seq_len :int):
+        # host copies of the sub-batch may still run on the copy stream, only the compute is timed
+        peak = None
+        if torch.cuda.is_available() and str(self.llm.device).startswith('cuda'):
+            torch.cuda.current_stream(self.llm.device).synchronize()
+            peak = torch.cuda.max_memory_allocated(self.llm.device) - self.base_memory
+            measured = peak / (size * seq_len)
+            self.measured_bytes_per_token = measured if self.measured_bytes_per_token is None else max(self.measured_bytes_per_token, measured)
+        self.records.append({'start': start, 'size': size, 'seq_len': seq_len, 'time': time.time() - self.start, 'peak_memory': peak})
+
+    def print_stats(self):
+        if len(self.records) == 0:
+            return
+        total = sum(r['time'] for r in self.records)
+        tokens = sum(r['size'] * r['seq_len'] for r in self.records)
+        print(f"Prefill | {len(self.records)} sub-batches | {tokens} tokens in {total:.2f}s, {tokens / max(total, 1e-9):.2f} tokens/s | {self.bytes_per_token() / 1024:.1f} KB/token ({'measured' if self.measured_bytes_per_token is not None else 'estimated'})")
+        for r in self.records:
+            peak = f" | peak {r['peak_memory'] / 1024**3:.2f} GB" if r['peak_memory'] is not None else ""
+            print(f"Sub-batch {r['start']}:{r['start'] + r['size']} | seq {r['seq_len']} | {r['time']:.2f}s | {r['size'] * r['seq_len'] / max(r['time'], 1e-9):.2f} tokens/s{peak}")
@@ -0,0 +1,136 @@
+################################################################################
+#
+# Copyright 2024 ByteDance Ltd. and/or its affiliates. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+
+import hashlib
+from collections import OrderedDict
+import torch
+
+
+def snapshot_nbytes(state):
+    # tensors or per-layer lists of tensors
+    nbytes = 0
+    for v in state.values():
+        for t in (v if isinstance(v, list) else [v]):
+            if isinstance(t, torch.Tensor):
+                nbytes += t.numel() * t.element_size()
+    return nbytes
+
+
+class PrefixEntry:
+    def __init__(self, length, state, logits) -> None:
+        self.length = length
+        self.state = state
+        self.logits = logits
+        self.nbytes = snapshot_nbytes(state) + logits.numel() * logits.element_size()
+
+
+class PrefixCache:
+    """Content-addressed store of prefilled KV cache snapshots.
+
+    A prefix of length L is keyed by a rolling hash over token-id blocks of `block_size`
+    (each block hash chains the previous one, the tail shorter than a block is hashed last),
+    so a lookup only needs the block hashes of the incoming prompt. Entries are evicted
+    least-recently-used first once the total snapshot size exceeds `capacity_bytes`.
+    """
+    def __init__(self, capacity_bytes :int = 64 * 1024**3, block_size :int = 256) -> None:
+        self.capacity_bytes = int(capacity_bytes)
+        self.block_size = block_size
+        self.entries = OrderedDict() # key -> PrefixEntry, least recently used first
+        self.lengths = {} # length -> number of entries with that length
+        self.used_bytes = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reused_tokens = 0
+
+    def _block_hashes(self, input_ids):
+        # [bsz, seq] --> chained digest after every full block
+        tokens = input_ids.to('cpu', torch.int64).contiguous()
+        hashes = [b'']
+        for start in range(0, tokens.shape[-1] - self.block_size + 1, self.block_size):
+            block = tokens[:, start:start + self.block_size].numpy().tobytes()
+            hashes.append(hashlib.sha1(hashes[-1] + block).digest())
+        return tokens, hashes
+
+    def _key(self, tokens, hashes, length):
+        full = length // self.block_size
+        digest = hashes[full]
+        if length % self.block_size != 0:
+            digest = hashlib.sha1(digest + tokens[:, full * self.block_size:length].numpy().tobytes()).digest()
+        return (tuple(tokens.shape[:-1]), length, digest)
+
+    def lookup(self, input_ids, max_suffix_len=None):
+        """Return the longest cached prefix of `input_ids`, or None.
+
+        `max_suffix_len` bounds the tokens left after the prefix, an int or a function of the prefix length.
+        """
+        seq_len = input_ids.shape[-1]
+        tokens, hashes = self._block_hashes(input_ids)
+        for length in sorted(self.lengths, reverse=True):
+            if length > seq_len:
+                continue
+            limit = max_suffix_len(length) if callable(max_suffix_len) else max_suffix_len
+            if limit is not None and seq_len - length > limit:
+                continue
+            key = self._key(tokens, hashes, length)
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                self.reused_tokens += length
+                return self.entries[key]
+        self.misses += 1
+        return None
+
+    def insert(self, input_ids, state, logits):
+        tokens, hashes = self._block_hashes(input_ids)
+        key = self._key(tokens, hashes, input_ids.shape[-1])
+        entry = PrefixEntry(input_ids.shape[-1], state, logits.to('cpu'))
+        if entry.nbytes > self.capacity_bytes:
+            return None
+        if key in self.entries:
+            self._remove(key)
+        while self.used_bytes + entry.nbytes > self.capacity_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+        self.entries[key] = entry
+        self.lengths[entry.length] = self.lengths.get(entry.length, 0) + 1
+        self.used_bytes += entry.nbytes
+        return entry
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.used_bytes -= entry.nbytes
+        self.lengths[entry.length] -= 1
+        if self.lengths[entry.length] == 0:
+            del self.lengths[entry.length]
+
+    def clear(self):
+        self.entries.clear()
+        self.lengths.clear()
+        self.used_bytes = 0
+        self.reset_stats()
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def print_stats(self):
+        print(f"PrefixCache | entries {len(self.entries)} | used {self.used_bytes / 1024**3:.2f} GB / {self.capacity_bytes / 1024**3:.2f} GB | hits {self.hits} | misses {self.misses} | hit rate {self.hit_rate():.4f} | evictions {self.evictions} | reused tokens {self.reused_tokens}")
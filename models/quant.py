@@ -0,0 +1,103 @@
+################################################################################
+#
+# Copyright 2024 ByteDance Ltd. and/or its affiliates. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+
+# Group quantization of fixed-size rows, e.g. one chunk of values [chunk_size * head_dim]
+#
+# A quantized row is a uint8 vector: the packed payload followed by a float32 (scale, offset)
+# pair per group of `group_size` elements, so a row can be moved around as a single unit.
+#   int8: asymmetric, 255 levels per group
+#   int4: asymmetric, 15 levels per group, two elements per byte
+#   fp8:  e4m3 with a per-group scale (offset unused)
+#
+# quantize_rows / dequantize_rows keep a separate per-row scale instead, for tensors that are
+# consumed by a GEMM (the U factor): the scale of a row commutes with the product and is
+# applied to the output rows.
+
+import torch
+
+QUANT_METHODS = ('int8', 'int4', 'fp8')
+ROW_QUANT_METHODS = ('int8', 'fp8')
+FP8_MAX = 448.0
+
+
+class RowQuantizer:
+    def __init__(self, method :str, unit :int, group_size :int) -> None:
+        if method not in QUANT_METHODS:
+            raise ValueError(f"Invalid quantization {method}, choose from {QUANT_METHODS}")
+        if unit % group_size != 0 or (method == 'int4' and group_size % 2 != 0):
+            raise ValueError(f"group_size {group_size} does not divide the row of {unit} elements")
+        self.method = method
+        self.unit = unit
+        self.group_size = group_size
+        self.groups = unit // group_size
+        self.payload_bytes = unit // 2 if method == 'int4' else unit
+        self.row_bytes = self.payload_bytes + self.groups * 2 * 4
+
+    def quantize(self, x):
+        # [..., unit] --> uint8 [..., row_bytes]
+        lead = x.shape[:-1]
+        g = x.float().reshape(*lead, self.groups, self.group_size)
+        if self.method == 'fp8':
+            scale = (g.abs().amax(dim=-1) / FP8_MAX).clamp(min=1e-12)
+            offset = torch.zeros_like(scale)
+            payload = (g / scale.unsqueeze(-1)).to(torch.float8_e4m3fn).view(torch.uint8)
+        else:
+            levels = 255 if self.method == 'int8' else 15
+            offset = g.amin(dim=-1)
+            scale = ((g.amax(dim=-1) - offset) / levels).clamp(min=1e-12)
+            payload = ((g - offset.unsqueeze(-1)) / scale.unsqueeze(-1)).round_().clamp_(0, levels).to(torch.uint8)
+            if self.method == 'int4':
+                payload = payload.view(*lead, self.unit // 2, 2)
+                payload = payload[..., 0] | (payload[..., 1] << 4)
+        meta = torch.stack([scale, offset], dim=-1).reshape(*lead, self.groups * 2).view(torch.uint8)
+        return torch.cat([payload.reshape(*lead, self.payload_bytes), meta], dim=-1)
+
+    def dequantize(self, rows, dtype=torch.bfloat16):
+        # uint8 [..., row_bytes] --> [..., unit]
+        lead = rows.shape[:-1]
+        meta = rows[..., self.payload_bytes:].contiguous().view(torch.float32).view(*lead, self.groups, 2)
+        payload = rows[..., :self.payload_bytes]
+        if self.method == 'fp8':
+            q = payload.contiguous().view(torch.float8_e4m3fn).float()
+        elif self.method == 'int4':
+            q = torch.stack([payload & 0xF, payload >> 4], dim=-1).float()
+        else:
+            q = payload.float()
+        x = q.reshape(*lead, self.groups, self.group_size) * meta[..., :1] + meta[..., 1:]
+        return x.reshape(*lead, self.unit).to(dtype)
+
+
+def quantization_error(x, method, group_size):
+    # relative Frobenius error of a round trip, x: [..., unit]
+    quantizer = RowQuantizer(method, x.shape[-1], group_size)
+    x_hat = quantizer.dequantize(quantizer.quantize(x), torch.float32)
+    return ((x_hat - x.float()).norm() / x.float().norm().clamp(min=1e-12)).item()
+
+
+def quantize_rows(x, method):
+    # [..., n] --> symmetric int8 or fp8 e4m3 [..., n], float32 scale [...]
+    if method not in ROW_QUANT_METHODS:
+        raise ValueError(f"Invalid row quantization {method}, choose from {ROW_QUANT_METHODS}")
+    qmax = 127.0 if method == 'int8' else FP8_MAX
+    scale = (x.float().abs().amax(dim=-1, keepdim=True) / qmax).clamp(min=1e-12)
+    y = x.float() / scale
+    q = y.round_().clamp_(-qmax, qmax).to(torch.int8) if method == 'int8' else y.to(torch.float8_e4m3fn)
+    return q, scale.squeeze(-1)
+
+
+def dequantize_rows(q, scale, dtype=torch.bfloat16):
+    return (q.float() * scale.unsqueeze(-1)).to(dtype)
@@ -0,0 +1,203 @@
+################################################################################
+#
+# Copyright 2024 ByteDance Ltd. and/or its affiliates. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+
+# Continuous batching for attn_mode shadowkv_cpu
+#
+# batch_generate decodes a fixed batch for gen_len steps, so a sequence that ends early holds its slot
+# until the slowest one is done. ContinuousBatcher keeps a queue instead: between two decode steps it
+# retires the sequences that produced EOS or reached their gen_len (ShadowKVCache_CPU.reset_slot) and
+# prefills waiting requests into the freed slots (LLM.prefill_slot). At most max_prefills_per_step
+# prompts are prefilled between two steps, so a long queue does not stall the running sequences.
+
+import time
+from collections import deque
+
+import torch
+
+from .tensor_op import sample_token
+from .kv_cache import ShadowKVCache_CPU
+
+
+class Request:
+    def __init__(self, request_id, input_ids :torch.Tensor, gen_len :int) -> None:
+        self.request_id = request_id
+        self.input_ids = input_ids # [1, seq]
+        self.gen_len = gen_len
+        self.output_ids = []
+        self.text = None
+        self.slot = None
+        self.arrival = time.time()
+        self.admitted = None
+        self.first_token = None
+        self.finished = None
+
+    def to_dict(self):
+        generated = len(self.output_ids)
+        return {
+            'request_id': self.request_id,
+            'prompt_len': self.input_ids.shape[-1],
+            'generated': generated,
+            'queue_time': self.admitted - self.arrival,
+            'ttft': self.first_token - self.arrival,
+            'latency': self.finished - self.arrival,
+            'tpot': (self.finished - self.first_token) / max(generated - 1, 1),
+        }
+
+
+def default_eos_token_ids(llm):
+    # the stop tokens of LLM.generate
+    tokenizer = llm.tokenizer
+    eos_token_ids = {tokenizer.eos_token_id}
+    for token in ["<|eot_id|>", "<|im_end|>", "<|endoftext|>", "<|end|>"]:
+        token_id = tokenizer.convert_tokens_to_ids(token)
+        if token_id is not None and token_id != tokenizer.unk_token_id:
+            eos_token_ids.add(token_id)
+    if 'glm' in llm.model_name.lower():
+        eos_token_ids.update([151329, 151336, 151338])
+    eos_token_ids.discard(None)
+    return eos_token_ids
+
+
+class ContinuousBatcher:
+    def __init__(self, llm, temperature :float = 0.0, top_p :float = -1, top_k :int = 50, max_prefills_per_step :int = 1, eos_token_ids=None) -> None:
+        if not isinstance(llm.kv_cache, ShadowKVCache_CPU):
+            raise ValueError(f"Continuous batching is only supported with attn_mode shadowkv_cpu, got {llm.attn_mode}")
+        if max_prefills_per_step < 1:
+            raise ValueError(f"max_prefills_per_step must be at least 1, got {max_prefills_per_step}")
+        self.llm = llm
+        self.kv_cache = llm.kv_cache
+        self.batch_size = llm.batch_size
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.max_prefills_per_step = max_prefills_per_step
+        self.eos_token_ids = set(eos_token_ids) if eos_token_ids is not None else default_eos_token_ids(llm)
+
+        self.slots = [None] * self.batch_size
+        self.waiting = deque()
+        self.done = []
+        self.next_token = torch.zeros(self.batch_size, 1, device=llm.device, dtype=torch.long)
+        self.started = False
+        self.steps = 0
+        self.start_time = None
+        self.num_requests = 0
+
+    def submit(self, input_ids :torch.Tensor, gen_len :int = 256, request_id=None):
+        """queue a [1, seq] prompt, gen_len counts every generated token including the first one"""
+        # validated when queued, a request admitted later must not fail the running batch
+        self.llm.check_slot_prompt(input_ids)
+        if gen_len > self.max_gen_len(input_ids):
+            raise ValueError(f"gen_len {gen_len} does not fit the local window, which has room for {self.max_gen_len(input_ids)} tokens after this prompt, enable compact_every to fold it")
+        request = Request(self.num_requests if request_id is None else request_id, input_ids, gen_len)
+        self.num_requests += 1
+        self.waiting.append(request)
+        return request
+
+    def max_gen_len(self, input_ids :torch.Tensor):
+        # generated tokens a slot can hold next to the prompt, unbounded when compact_every folds the local window
+        if self.kv_cache.compact_every is not None:
+            return float('inf')
+        return self.kv_cache.tail_capacity() - self.kv_cache.prefill_local_len(input_ids.size(1))
+
+    def active(self):
+        return sum(request is not None for request in self.slots)
+
+    def start(self):
+        # the first requests fill an empty batch in order, slots left free are parked by finish_prefill()
+        num_first = min(len(self.waiting), self.batch_size)
+        self.kv_cache.clear()
+        self.start_time = time.time()
+        prefilled = []
+        for slot in range(num_first):
+            request = self.waiting.popleft()
+            request.admitted = time.time()
+            input_ids = request.input_ids.to(self.llm.device)
+            prefilled.append((slot, request, self.llm.inference(input_ids=input_ids, position_ids=self.llm.get_ctx(input_ids))))
+        self.kv_cache.finish_prefill()
+        self.kv_cache.H2D()
+        self.started = True
+        for slot, request, logits in prefilled:
+            self.admit(slot, request, logits)
+
+    def admit(self, slot, request, logits):
+        token = sample_token(logits[:, -1, :], temperature=self.temperature, top_p=self.top_p, top_k=self.top_k)
+        request.slot = slot
+        request.first_token = time.time()
+        self.slots[slot] = request
+        self.next_token[slot].copy_(token[0])
+        self.append_token(slot, token[0, 0].item())
+
+    def append_token(self, slot, token):
+        request = self.slots[slot]
+        request.output_ids.append(token)
+        if token in self.eos_token_ids or len(request.output_ids) >= request.gen_len:
+            self.retire(slot)
+
+    def retire(self, slot):
+        request = self.slots[slot]
+        request.finished = time.time()
+        request.text = self.llm.tokenizer.decode(request.output_ids, skip_special_tokens=True)
+        self.slots[slot] = None
+        self.kv_cache.reset_slot(slot)
+        self.done.append(request)
+
+    @torch.inference_mode()
+    def step(self):
+        """admit waiting requests into free slots, then run one decode step over the batch"""
+        if not self.started:
+            self.start()
+        else:
+            free = [slot for slot, request in enumerate(self.slots) if request is None]
+            for slot in free[:self.max_prefills_per_step]:
+                if len(self.waiting) == 0:
+                    break
+                request = self.waiting.popleft()
+                request.admitted = time.time()
+                logits = self.llm.prefill_slot(slot, request.input_ids.to(self.llm.device))
+                self.admit(slot, request, logits)
+
+        if self.active() == 0:
+            return
+
+        # free slots are fed their last token, the cache keeps them at a fixed length
+        logits = self.llm.decode_step(self.next_token)
+        tokens = sample_token(logits[:, -1, :], temperature=self.temperature, top_p=self.top_p, top_k=self.top_k)
+        self.next_token.copy_(tokens)
+        self.steps += 1
+        for slot, token in enumerate(tokens[:, 0].tolist()):
+            if self.slots[slot] is not None:
+                self.append_token(slot, token)
+
+    def run(self):
+        """serve until the queue is empty and every sequence has finished, returns the finished requests"""
+        while len(self.waiting) > 0 or self.active() > 0:
+            self.step()
+        return self.done
+
+    def print_stats(self):
+        if len(self.done) == 0:
+            return
+        elapsed = max(r.finished for r in self.done) - self.start_time
+        generated = sum(len(r.output_ids) for r in self.done)
+        latency = sorted(r.finished - r.arrival for r in self.done)
+        ttft = sorted(r.first_token - r.arrival for r in self.done)
+        pct = lambda values, p: values[min(len(values) - 1, int(p * len(values)))]
+        print(f"ContinuousBatcher | requests {len(self.done)} | steps {self.steps} | generated {generated} tokens in {elapsed:.2f}s, {generated / elapsed:.2f} tokens/s | slot occupancy {generated / max(self.steps * self.batch_size, 1):.4f}")
+        print(f"Latency p50 {pct(latency, 0.5):.2f}s p90 {pct(latency, 0.9):.2f}s max {latency[-1]:.2f}s | TTFT p50 {pct(ttft, 0.5):.2f}s p90 {pct(ttft, 0.9):.2f}s max {ttft[-1]:.2f}s")
+        for request in self.done:
+            r = request.to_dict()
+            print(f"Request {r['request_id']} | prompt {r['prompt_len']} | generated {r['generated']} | queue {r['queue_time']:.2f}s | TTFT {r['ttft']:.2f}s | latency {r['latency']:.2f}s | {r['tpot'] * 1000:.2f} ms/token")
@@ -0,0 +1,276 @@
+################################################################################
+#
+# Copyright 2024 ByteDance Ltd. and/or its affiliates. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+
+# Op registry for the ShadowKV kernels.
+#
+# `shadowkv` below is a drop-in replacement for `from kernels import shadowkv`: every
+# attribute lookup is forwarded to the active backend. Two backends are registered:
+#   - "cuda":  the compiled extension in kernels/ (python setup.py build_ext --inplace)
+#   - "torch": vectorized torch implementations with the same signatures and the same
+#              in-place semantics, usable on CPU-only hosts and as an oracle for the kernels
+# The default is "cuda" when the extension imports and a GPU is visible, "torch" otherwise.
+# SHADOWKV_OPS_BACKEND=torch|cuda overrides the default.
+
+import os
+import torch
+
+try:
+    from kernels import shadowkv as _shadowkv_cuda
+except (ImportError, OSError):
+    _shadowkv_cuda = None
+
+OP_NAMES = (
+    "gather_copy",
+    "gather_copy_d2d_with_offsets",
+    "reorder_keys_and_compute_offsets",
+    "gather_copy_with_offsets",
+    "apply_rotary_pos_emb",
+    "apply_rotary_pos_emb_new",
+    "apply_rotary_pos_emb_new_v2",
+    "apply_rotary_pos_emb_push_cache",
+    "apply_rotary_pos_emb_push_cache_opt",
+    "apply_rotary_pos_emb_push_cache_opt_glm",
+    "batch_gather_gemm",
+    "batch_gemm_softmax",
+)
+
+
+def _rope_half(x, cos, sin, half_dim):
+    # same op order as the kernels: out1 = x1*cos + (-x2)*sin, out2 = x2*cos + x1*sin (bf16 each step)
+    x1, x2 = x[..., :half_dim], x[..., half_dim:2*half_dim]
+    return torch.cat((x1 * cos[..., :half_dim] + (-x2) * sin[..., :half_dim], x2 * cos[..., half_dim:] + x1 * sin[..., half_dim:]), dim=-1)
+
+
+def _rope_glm(x, cos_sin):
+    # GLM rotates interleaved pairs of the first 64 dims, cos_sin is [cos(32) | sin(32)]
+    cos, sin = cos_sin[..., :32], cos_sin[..., 32:64]
+    x_even, x_odd = x[..., 0:64:2], x[..., 1:64:2]
+    x_rot = torch.stack((x_even * cos + (-x_odd) * sin, x_odd * cos + x_even * sin), dim=-1).flatten(-2)
+    return torch.cat((x_rot, x[..., 64:]), dim=-1)
+
+
+def _chunk_positions(position_ids, chunk_size):
+    # [bsz, heads, chunks] chunk ids --> [bsz, heads, chunks * chunk_size] token positions
+    arange = torch.arange(chunk_size, device=position_ids.device)
+    return (position_ids.long().unsqueeze(-1) * chunk_size + arange).flatten(-2)
+
+
+def _push_cache(x, cos_sin, position_ids, cache, cnts, heads, sparse_start, sparse_end, chunk_size, rope):
+    bsz, _, seq_len, _ = x.shape
+    pos = _chunk_positions(position_ids, chunk_size)[:, :, :seq_len]
+    out = rope(x, cos_sin[pos])
+
+    # chunks below cnts were reused from the previous step, slots past sparse_end are not written
+    seq_len = min(seq_len, sparse_end - sparse_start)
+    s_idx = torch.arange(seq_len, device=x.device)
+    valid = (s_idx // chunk_size).view(1, 1, -1) >= cnts.view(bsz, heads, 1).long()
+    region = cache[:, :, sparse_start:sparse_start + seq_len]
+    region.copy_(torch.where(valid.unsqueeze(-1), out[:, :, :seq_len], region))
+    return cache
+
+
+class TorchOps:
+    """Reference implementations of the kernels/shadowkv ops.
+
+    Stride arguments are implied by the tensors and only kept for signature compatibility.
+    Offsets are counted in units of `gpu_v_length // map_size` elements (one chunk of
+    chunk_size * head_dim values), which is what the copy kernels assume.
+    """
+
+    @staticmethod
+    def batch_gemm_softmax(A, B, D, Norm, Sum, Softmax, batch_count, m, n, k, alpha, beta):
+        a = A.reshape(batch_count, m, k)
+        b = B.reshape(batch_count, n, k)
+        d = torch.matmul(a.float(), b.float().transpose(-1, -2)) * alpha
+        d_out = D.view(-1)[:batch_count * m * n].view(batch_count, m, n)
+        if beta != 0:
+            d = d + beta * d_out.float()
+        d_out.copy_(d)
+
+        # softmax is computed from the stored (rounded) logits, partial max/sum per 256-column block
+        logits = d_out.float()
+        block_num = (n + 256 - 1) // 256
+        padded = torch.nn.functional.pad(logits, (0, block_num * 256 - n), value=float('-inf')).view(batch_count, m, block_num, 256)
+        block_max = padded.max(dim=-1).values
+        block_sum = torch.exp(padded - block_max.unsqueeze(-1)).sum(dim=-1)
+        Norm.view(-1)[:batch_count * m * block_num].view(batch_count, m, block_num).copy_(block_max)
+        Sum.view(-1)[:batch_count * m * block_num].view(batch_count, m, block_num).copy_(block_sum)
+
+        row_max = block_max.max(dim=-1, keepdim=True).values
+        row_sum = (block_sum * torch.exp(block_max - row_max)).sum(dim=-1, keepdim=True)
+        Softmax.view(-1)[:batch_count * m * n].view(batch_count, m, n).copy_(torch.exp(logits - row_max) / row_sum)
+
+    @staticmethod
+    def reorder_keys_and_compute_offsets(cached_pos_ids, cur_pos_ids, offsets, cnts, batch_size, heads, map_size=256):
+        block_num = batch_size * heads
+        cached = cached_pos_ids.view(block_num, map_size)
+        cur = cur_pos_ids.reshape(block_num, map_size).to(cached.device)
+
+        # hit: the incoming chunk is already resident in slot `slot` of the previous selection
+        match = cur.unsqueeze(-1) == cached.unsqueeze(-2) # [blocks, map_size, map_size]
+        hit = match.any(dim=-1)
+        slot = match.int().argmax(dim=-1).long()
+
+        # hits first (ordered by source slot), then misses (ordered by chunk id), like block_sort2
+        sort_key = torch.where(hit, slot, map_size + cur)
+        order = torch.argsort(sort_key, dim=-1, stable=True)
+        new_offsets = torch.where(hit, slot, cur).gather(-1, order)
+        new_keys = cur.gather(-1, order)
+
+        cached.copy_(new_keys)
+        offsets.view(block_num, map_size).copy_(new_offsets)
+        cnts.view(block_num).copy_(hit.sum(dim=-1))
+
+    @staticmethod
+    def gather_copy_with_offsets(values, v_cache_buffer, temp, offsets, cnts, signals, batch_size, heads, cpu_v_length, gpu_v_length, gpu_v_offset, gpu_v_stride, map_size=256):
+        block_num = batch_size * heads
+        unit = gpu_v_length // map_size
+        src = values.view(-1)[:block_num * cpu_v_length].view(block_num, cpu_v_length // unit, unit)
+        dst = v_cache_buffer.view(-1)[:block_num * gpu_v_stride].view(block_num, gpu_v_stride)
+        region = dst[:, gpu_v_offset:gpu_v_offset + gpu_v_length].view(block_num, map_size, unit)
+
+        off = offsets.view(block_num, map_size).long()
+        is_hit = torch.arange(map_size, device=off.device).unsqueeze(0) < cnts.view(block_num, 1).long()
+
+        # d2d: reused chunks move from their old slot to [0, cnt), read before anything is written
+        hit_b, hit_i = is_hit.nonzero(as_tuple=True)
+        hit_rows = region[hit_b, off[hit_b, hit_i]]
+
+        # h2d: missed chunks come from host memory into [cnt, map_size), staged through temp
+        miss_b, miss_i = (~is_hit).nonzero(as_tuple=True)
+        miss_rows = src[miss_b.to(src.device), off[miss_b, miss_i].to(src.device)].to(region.device)
+        temp.view(block_num, map_size, unit)[miss_b.to(temp.device), miss_i.to(temp.device)] = miss_rows.to(temp.device)
+
+        region[hit_b, hit_i] = hit_rows
+        region[miss_b, miss_i] = miss_rows
+
+    @staticmethod
+    def gather_copy_d2d_with_offsets(keys, offsets, cnts, batch_size, heads, gpu_v_length, gpu_v_offset, gpu_v_stride, map_size=256):
+        block_num = batch_size * heads
+        unit = gpu_v_length // map_size
+        dst = keys.view(-1)[:block_num * gpu_v_stride].view(block_num, gpu_v_stride)
+        region = dst[:, gpu_v_offset:gpu_v_offset + gpu_v_length].view(block_num, map_size, unit)
+
+        off = offsets.view(block_num, map_size).long()
+        is_hit = torch.arange(map_size, device=off.device).unsqueeze(0) < cnts.view(block_num, 1).long()
+        hit_b, hit_i = is_hit.nonzero(as_tuple=True)
+        region[hit_b, hit_i] = region[hit_b, off[hit_b, hit_i]]
+
+    @staticmethod
+    def gather_copy(values, v_cache_buffer, position_ids, batch_size, heads, cpu_v_length, gpu_v_length, map_size=256):
+        block_num = batch_size * heads
+        unit = gpu_v_length // map_size
+        src = values.view(-1)[:block_num * cpu_v_length].view(block_num, cpu_v_length // unit, unit)
+        dst = v_cache_buffer.view(-1)[:block_num * gpu_v_length].view(block_num, map_size, unit)
+        idx = position_ids.reshape(block_num, map_size).long().to(src.device)
+        dst.copy_(src[torch.arange(block_num, device=src.device).unsqueeze(-1), idx])
+
+    @staticmethod
+    def apply_rotary_pos_emb(x, cos, sin, position_ids, output, batch_size, heads, seq_len, embed_dim, stride_xb, stride_xh, stride_xs, stride_xe, stride_cos, stride_sin, stride_pid_b, stride_pid_h, stride_pid_s, half_dim):
+        pos = position_ids.long()
+        output.copy_(_rope_half(x, cos[pos], sin[pos], half_dim))
+
+    @staticmethod
+    def apply_rotary_pos_emb_new(x, cos_sin, position_ids, output, batch_size, heads, seq_len, embed_dim, stride_xb, stride_xh, stride_xs, stride_xe, stride_cos_sin, stride_pid_b, stride_pid_h, stride_pid_s, half_dim):
+        cs = cos_sin[position_ids.long()]
+        cos = torch.cat((cs[..., :half_dim], cs[..., :half_dim]), dim=-1)
+        sin = torch.cat((cs[..., half_dim:], cs[..., half_dim:]), dim=-1)
+        output.copy_(_rope_half(x, cos, sin, half_dim))
+
+    @staticmethod
+    def apply_rotary_pos_emb_new_v2(x, cos_sin, position_ids, output, batch_size, heads, seq_len, embed_dim, stride_xb, stride_xh, stride_xs, stride_xe, stride_cos_sin, stride_pid_b, stride_pid_h, stride_pid_s, half_dim, chunk_size):
+        pos = _chunk_positions(position_ids, chunk_size)[:, :, :seq_len]
+        TorchOps.apply_rotary_pos_emb_new(x, cos_sin, pos, output, batch_size, heads, seq_len, embed_dim, stride_xb, stride_xh, stride_xs, stride_xe, stride_cos_sin, stride_pid_b, stride_pid_h, stride_pid_s, half_dim)
+
+    @staticmethod
+    def apply_rotary_pos_emb_push_cache_opt(x, cos_sin, position_ids, cache, cnts, batch_size, heads, seq_len, embed_dim, stride_xb, stride_xh, stride_xs, stride_xe, stride_cos_sin, stride_pid_b, stride_pid_h, stride_pid_s, stride_output_b, stride_output_h, stride_output_s, offset_output_s_start, offset_output_s_end, half_dim, chunk_size):
+        def rope(x, cs):
+            cos = torch.cat((cs[..., :half_dim], cs[..., :half_dim]), dim=-1)
+            sin = torch.cat((cs[..., half_dim:], cs[..., half_dim:]), dim=-1)
+            return _rope_half(x, cos, sin, half_dim)
+        _push_cache(x, cos_sin, position_ids, cache, cnts, heads, offset_output_s_start, offset_output_s_end, chunk_size, rope)
+
+    apply_rotary_pos_emb_push_cache = apply_rotary_pos_emb_push_cache_opt
+
+    @staticmethod
+    def apply_rotary_pos_emb_push_cache_opt_glm(x, cos_sin, position_ids, cache, cnts, batch_size, heads, seq_len, embed_dim, stride_xb, stride_xh, stride_xs, stride_xe, stride_cos_sin, stride_pid_b, stride_pid_h, stride_pid_s, stride_output_b, stride_output_h, stride_output_s, offset_output_s_start, offset_output_s_end, half_dim, chunk_size):
+        _push_cache(x, cos_sin, position_ids, cache, cnts, heads, offset_output_s_start, offset_output_s_end, chunk_size, _rope_glm)
+
+    @staticmethod
+    def batch_gather_gemm(a, b, cos, sin, position_ids, output, batch_size, heads, seq_len, embed_dim, rank, sparse_budget, max_seq_len, chunk_size, offset_array):
+        # output[b, h, s] = U[b, position(s)] @ SV[b, h]^T for chunks not reused from the previous step
+        rows = _chunk_positions(position_ids, chunk_size)[:, :, :sparse_budget] # [bsz, heads, sparse_budget]
+        u = a[torch.arange(batch_size, device=a.device).view(-1, 1, 1), rows] # [bsz, heads, sparse_budget, rank]
+        out = torch.matmul(u.float(), b.float().transpose(-1, -2)).to(output.dtype) # [bsz, heads, sparse_budget, head_dim]
+
+        s_idx = torch.arange(sparse_budget, device=a.device)
+        valid = (s_idx // chunk_size).view(1, 1, -1) >= offset_array.view(batch_size, heads, 1).long()
+        output.copy_(torch.where(valid.unsqueeze(-1), out, output))
+
+
+_BACKENDS = {"torch": TorchOps}
+if _shadowkv_cuda is not None:
+    _BACKENDS["cuda"] = _shadowkv_cuda
+
+
+def register_backend(name: str, ops):
+    """Register an object exposing the ops in OP_NAMES under `name`."""
+    missing = [op for op in OP_NAMES if not hasattr(ops, op)]
+    if len(missing) > 0:
+        raise ValueError(f"Backend {name} is missing ops {missing}")
+    _BACKENDS[name] = ops
+
+
+def available_backends():
+    return list(_BACKENDS.keys())
+
+
+def _default_backend():
+    requested = os.environ.get("SHADOWKV_OPS_BACKEND")
+    if requested is not None:
+        return requested
+    if "cuda" in _BACKENDS and torch.cuda.is_available():
+        return "cuda"
+    return "torch"
+
+
+_active = _default_backend()
+
+
+def set_backend(name: str):
+    global _active
+    if name not in _BACKENDS:
+        raise ValueError(f"Invalid ShadowKV ops backend {name}, available: {available_backends()}")
+    _active = name
+
+
+def get_backend() -> str:
+    return _active
+
+
+class _OpDispatcher:
+    """Forwards `shadowkv.<op>(...)` to the active backend."""
+
+    def __getattr__(self, name):
+        if name not in OP_NAMES:
+            raise AttributeError(f"Unknown ShadowKV op {name}")
+        if _active not in _BACKENDS:
+            raise ValueError(f"Invalid ShadowKV ops backend {_active}, available: {available_backends()}")
+        return getattr(_BACKENDS[_active], name)
+
+
+shadowkv = _OpDispatcher()
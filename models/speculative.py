@@ -0,0 +1,157 @@
+################################################################################
+#
+# Copyright 2024 ByteDance Ltd. and/or its affiliates. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+
+# Speculative decoding for attn_mode shadowkv_cpu
+#
+# Every round a draft proposes num_draft_tokens tokens one by one, then the target runs a single multi-token
+# decode step over [next_token, d_1, ..., d_k] and samples its own token at every position. A slot keeps the
+# drafted tokens up to the first one the target disagrees with, plus the target token at that position, so the
+# output follows the target distribution. Both caches drop the rejected tokens with ShadowKVCache_CPU.rollback().
+#
+# The default draft is the target itself decoding from a ShadowKVCache_CPU.draft_view() with a much smaller
+# sparse budget: it shares the weights, U / SV, landmarks and host values of the target, only its GPU buffers
+# are smaller, so the draft steps move far less data. A separate draft model with its own shadowkv_cpu cache
+# and the same tokenizer can be passed instead.
+
+import copy
+import time
+
+import torch
+
+from .tensor_op import sample_token
+from .kv_cache import ShadowKVCache_CPU
+
+
+class SpeculativeDecoder:
+    def __init__(self, llm, draft=None, draft_budget :int = 256, num_draft_tokens :int = 4) -> None:
+        if not isinstance(llm.kv_cache, ShadowKVCache_CPU):
+            raise ValueError(f"Speculative decoding is only supported with attn_mode shadowkv_cpu, got {llm.attn_mode}")
+        if llm.kv_cache.compact_every is not None:
+            raise ValueError("Speculative decoding does not support compact_every, rejected tokens may already be folded")
+        # the verification step returns the logits of every position up to 16 tokens, see LLM.inference
+        if not 1 <= num_draft_tokens <= 15:
+            raise ValueError(f"num_draft_tokens must be in [1, 15], got {num_draft_tokens}")
+        if draft is not None:
+            if not isinstance(draft.kv_cache, ShadowKVCache_CPU) or draft.kv_cache.compact_every is not None:
+                raise ValueError("The draft model needs attn_mode shadowkv_cpu without compact_every")
+            if draft.batch_size != llm.batch_size:
+                raise ValueError(f"Draft batch_size {draft.batch_size} does not match {llm.batch_size}")
+        self.llm = llm
+        self.draft = draft
+        self.draft_budget = draft_budget
+        self.num_draft_tokens = num_draft_tokens
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.rounds = 0
+        self.drafted = 0
+        self.accepted = 0
+        self.accepted_hist = [0] * (self.num_draft_tokens + 1) # slots accepting i drafted tokens in a round
+        self.elapsed = 0.0
+
+    def draft_llm(self):
+        # the target decoding from a small-budget view of its own cache, built after H2D
+        if self.draft is not None:
+            return self.draft
+        draft = copy.copy(self.llm)
+        draft.kv_cache = self.llm.kv_cache.draft_view(self.draft_budget)
+        draft.graph_decoder = None
+        return draft
+
+    def step(self, draft, next_token, temperature, top_p, top_k):
+        # next_token [bsz, 1] --> tokens emitted by every slot, the next input [bsz, 1]
+        llm, k = self.llm, self.num_draft_tokens
+        bsz = next_token.shape[0]
+
+        # the last draft step only feeds d_k, so that both caches hold [next_token, d_1, ..., d_k]
+        tokens = [next_token]
+        for i in range(k + 1):
+            logits = draft.inference(input_ids=tokens[-1], position_ids=draft.get_ctx(tokens[-1]))
+            if i < k:
+                tokens.append(sample_token(logits[:, -1, :], temperature=temperature, top_p=top_p, top_k=top_k))
+        candidates = torch.cat(tokens, dim=-1) # [bsz, k + 1]
+
+        # verify: the logits at position i are the target's prediction for candidate i + 1
+        logits = llm.inference(input_ids=candidates, position_ids=llm.get_ctx(candidates)) # [bsz, k + 1, vocab]
+        target = sample_token(logits.view(bsz * (k + 1), -1), temperature=temperature, top_p=top_p, top_k=top_k).view(bsz, k + 1)
+        accepted = (target[:, :k] == candidates[:, 1:]).int().cumprod(dim=-1).sum(dim=-1) # [bsz]
+
+        accepted = accepted.tolist()
+        target = target.tolist()
+        drafted = candidates[:, 1:].tolist()
+        rejected = [k - a if active else 0 for a, active in zip(accepted, llm.kv_cache.active)]
+        llm.kv_cache.rollback(rejected)
+        draft.kv_cache.rollback(rejected)
+
+        self.rounds += 1
+        self.drafted += k * sum(llm.kv_cache.active)
+        self.accepted += sum(a for a, active in zip(accepted, llm.kv_cache.active) if active)
+        for a, active in zip(accepted, llm.kv_cache.active):
+            if active:
+                self.accepted_hist[a] += 1
+        emitted = [drafted[slot][:a] + [target[slot][a]] for slot, a in enumerate(accepted)]
+        next_token = torch.tensor([[target[slot][a]] for slot, a in enumerate(accepted)], device=next_token.device, dtype=next_token.dtype)
+        return emitted, next_token
+
+    @torch.inference_mode()
+    def generate(self, input_ids :torch.Tensor, gen_len :int = 256, temperature :float = 0.0, top_p :float = -1, top_k :int = 50, benchmark :bool = False):
+        llm = self.llm
+        cache = llm.kv_cache
+        logits = llm.batch_prefill(input_ids)
+        if self.draft is not None:
+            self.draft.batch_prefill(input_ids)
+            self.draft.kv_cache.H2D()
+        next_token = sample_token(logits[:, -1, :], temperature=temperature, top_p=top_p, top_k=top_k)
+        cache.H2D()
+        draft = self.draft_llm()
+        for c in (cache, draft.kv_cache):
+            # a round appends num_draft_tokens + 1 tokens before the rejected ones are rolled back
+            if c.tail_max + gen_len + self.num_draft_tokens + 1 > c.tail_capacity():
+                raise ValueError(f"gen_len {gen_len} with {self.num_draft_tokens} draft tokens does not fit in the local window, {c.tail_capacity() - c.tail_max} tokens left")
+
+        generated_ids = [[token] for token in next_token[:, 0].tolist()]
+        start = time.time()
+        while min(len(ids) for ids in generated_ids) < gen_len + 1:
+            emitted, next_token = self.step(draft, next_token, temperature, top_p, top_k)
+            for slot, (ids, tokens) in enumerate(zip(generated_ids, emitted)):
+                if not cache.active[slot]:
+                    continue
+                ids.extend(tokens)
+                if len(ids) >= gen_len + 1:
+                    # done, the slot is still fed tokens until the whole batch is but no longer grows
+                    cache.finish_slot(slot)
+                    draft.kv_cache.finish_slot(slot)
+        self.elapsed += time.time() - start
+
+        if benchmark:
+            self.print_stats()
+        llm.release_memory()
+        return llm.decode([ids[:gen_len + 1] for ids in generated_ids], skip_special_tokens=True)
+
+    def acceptance_rate(self):
+        return self.accepted / self.drafted if self.drafted > 0 else 0.0
+
+    def accepted_tokens(self):
+        # emitted tokens, every slot round adds its accepted draft tokens and one target token
+        return self.accepted + sum(self.accepted_hist)
+
+    def print_stats(self):
+        slot_rounds = max(sum(self.accepted_hist), 1)
+        tokens = self.accepted_tokens()
+        print(f"Speculative | draft {'model' if self.draft is not None else f'budget {self.draft_budget}'} | {self.num_draft_tokens} draft tokens | rounds {self.rounds} | acceptance rate {self.acceptance_rate():.4f} | {tokens / slot_rounds:.2f} tokens per target step | accepted histogram {self.accepted_hist}")
+        if self.elapsed > 0:
+            print(f"Generate {tokens} tokens in {self.elapsed:.2f}s | Throughput: {tokens / self.elapsed:.2f} tokens/s, Latency: {self.elapsed * 1000 / max(self.rounds, 1):.2f} ms/round")
@@ -0,0 +1,153 @@
+################################################################################
+#
+# Copyright 2024 ByteDance Ltd. and/or its affiliates. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+
+# Truncated SVD engines for the pre-RoPE key cache
+#
+# All engines take k_cache [bsz, seq, d] (d = kv_heads * head_dim) and return the top
+# `rank` factors u [bsz, seq, rank], s [bsz, rank], v [bsz, rank, d] with k ~= u @ diag(s) @ v.
+# 'exact' is the full torch.svd the cache used so far. 'gram' and 'randomized' never
+# materialize a float copy of the whole key matrix: products with k are taken over row
+# chunks of `row_chunk` tokens, so the extra memory is O(seq * rank) instead of O(seq * d).
+
+import time
+import torch
+
+SVD_METHODS = ('exact', 'gram', 'randomized')
+
+
+def _k_matmul(k_cache, m, row_chunk):
+    # [bsz, seq, d] @ [bsz, d, r] --> [bsz, seq, r] in float32
+    out = torch.empty(k_cache.shape[0], k_cache.shape[1], m.shape[-1], device=k_cache.device, dtype=torch.float32)
+    for start in range(0, k_cache.shape[1], row_chunk):
+        out[:, start:start + row_chunk] = torch.matmul(k_cache[:, start:start + row_chunk].float(), m)
+    return out
+
+
+def _kt_matmul(k_cache, m, row_chunk):
+    # [bsz, seq, d]^T @ [bsz, seq, r] --> [bsz, d, r] in float32
+    out = torch.zeros(k_cache.shape[0], k_cache.shape[2], m.shape[-1], device=k_cache.device, dtype=torch.float32)
+    for start in range(0, k_cache.shape[1], row_chunk):
+        out += torch.matmul(k_cache[:, start:start + row_chunk].float().transpose(1, 2), m[:, start:start + row_chunk])
+    return out
+
+
+def gram_matrix(k_cache, row_chunk=16*1024):
+    # [bsz, seq, d] --> [bsz, d, d] = k^T k in float32
+    gram = torch.zeros(k_cache.shape[0], k_cache.shape[2], k_cache.shape[2], device=k_cache.device, dtype=torch.float32)
+    for start in range(0, k_cache.shape[1], row_chunk):
+        chunk = k_cache[:, start:start + row_chunk].float()
+        gram.baddbmm_(chunk.transpose(1, 2), chunk)
+    return gram
+
+
+def gram_factors(gram, rank):
+    # top-rank eigenpairs of k^T k give s and v of k, [bsz, rank] and [bsz, rank, d]
+    eigvals, eigvecs = torch.linalg.eigh(gram.double())
+    eigvals = eigvals.flip(-1)[:, :rank].clamp(min=0)
+    v = eigvecs.flip(-1)[:, :, :rank].transpose(1, 2)
+    return eigvals.sqrt().float(), v.float().contiguous()
+
+
+def exact_svd(k_cache, rank, **kwargs):
+    u, s, v = torch.svd(k_cache.float())
+    return u[:, :, :rank], s[:, :rank], v.transpose(1, 2)[:, :rank]
+
+
+def gram_svd(k_cache, rank, row_chunk=16*1024, gram=None, **kwargs):
+    # `gram` can be accumulated beforehand, e.g. window by window during a streaming prefill
+    s, v = gram_factors(gram_matrix(k_cache, row_chunk) if gram is None else gram, rank)
+    # u = k v^T / s, columns with a vanishing singular value are left at zero
+    u = _k_matmul(k_cache, v.transpose(1, 2), row_chunk) / s.clamp(min=1e-6).unsqueeze(1)
+    return u, s, v
+
+
+def randomized_svd(k_cache, rank, oversample=16, n_iter=2, row_chunk=16*1024, **kwargs):
+    bsz, _, d = k_cache.shape
+    sketch = min(rank + oversample, d)
+    omega = torch.randn(bsz, d, sketch, device=k_cache.device, dtype=torch.float32)
+
+    # range finder with power iterations, re-orthonormalized every half step
+    q, _ = torch.linalg.qr(_k_matmul(k_cache, omega, row_chunk))
+    for _ in range(n_iter):
+        z, _ = torch.linalg.qr(_kt_matmul(k_cache, q, row_chunk))
+        q, _ = torch.linalg.qr(_k_matmul(k_cache, z, row_chunk))
+
+    # k ~= q (q^T k), svd of the small [bsz, sketch, d] projection
+    b = _kt_matmul(k_cache, q, row_chunk).transpose(1, 2)
+    ub, s, vb = torch.linalg.svd(b, full_matrices=False)
+    u = torch.matmul(q, ub[:, :, :rank])
+    return u, s[:, :rank], vb[:, :rank]
+
+
+_ENGINES = {
+    'exact': exact_svd,
+    'gram': gram_svd,
+    'randomized': randomized_svd,
+}
+
+
+def low_rank_svd(k_cache, rank, method='exact', **kwargs):
+    if method not in _ENGINES:
+        raise ValueError(f"Invalid svd method {method}, choose from {SVD_METHODS}")
+    return _ENGINES[method](k_cache, rank, **kwargs)
+
+
+def reconstruction_error(k_cache, u, s, v, row_chunk=16*1024):
+    # ||k - u diag(s) v||_F / ||k||_F, accumulated over row chunks
+    err, ref = 0.0, 0.0
+    sv = s.unsqueeze(-1) * v
+    for start in range(0, k_cache.shape[1], row_chunk):
+        chunk = k_cache[:, start:start + row_chunk].float()
+        err += (chunk - torch.matmul(u[:, start:start + row_chunk].float(), sv)).square().sum().item()
+        ref += chunk.square().sum().item()
+    return (err / ref) ** 0.5
+
+
+def svd_accuracy_report(k_cache, rank, methods=SVD_METHODS, verbose=True, **kwargs):
+    """Compare truncated SVD engines on one key matrix.
+
+    For each method returns the relative Frobenius reconstruction error, its ratio to the
+    exact truncated SVD, wall time and (on CUDA) the peak memory added by the factorization.
+    """
+    report = {}
+    for method in methods:
+        if k_cache.is_cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats(k_cache.device)
+            base = torch.cuda.memory_allocated(k_cache.device)
+        start = time.time()
+        u, s, v = low_rank_svd(k_cache, rank, method=method, **kwargs)
+        if k_cache.is_cuda:
+            torch.cuda.synchronize()
+        elapsed = time.time() - start
+        peak = torch.cuda.max_memory_allocated(k_cache.device) - base if k_cache.is_cuda else 0
+        report[method] = {
+            'rel_error': reconstruction_error(k_cache, u, s, v),
+            'time': elapsed,
+            'peak_memory': peak,
+        }
+        del u, s, v
+
+    if 'exact' in report:
+        for method in report:
+            report[method]['error_ratio'] = report[method]['rel_error'] / max(report['exact']['rel_error'], 1e-12)
+
+    if verbose:
+        for method, r in report.items():
+            ratio = f" | vs exact {r['error_ratio']:.4f}x" if 'error_ratio' in r else ""
+            print(f"SVD {method:>10} | rank {rank} | rel error {r['rel_error']:.6f}{ratio} | {r['time']:.3f}s | peak {r['peak_memory'] / 1024**3:.2f} GB")
+    return report
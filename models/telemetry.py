@@ -0,0 +1,107 @@
+################################################################################
+#
+# Copyright 2024 ByteDance Ltd. and/or its affiliates. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+
+import json
+import torch
+
+
+class CacheStats:
+    """Hit telemetry of the ShadowKV value offload path.
+
+    After `reorder_keys_and_compute_offsets`, `cnts` holds per (batch, head) the number of
+    selected chunks reused from the previous step. Hits are moved inside the GPU buffers
+    (keys and values, D2D), misses are copied from host memory (values, H2D) and their keys
+    are rebuilt from the low-rank factors. Counters stay on device so recording never syncs.
+    """
+    def __init__(self, num_layers :int, device :str = 'cuda:0', bins :int = 10) -> None:
+        self.num_layers = num_layers
+        self.device = device
+        self.bins = bins
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.lookups = torch.zeros(self.num_layers, device=self.device, dtype=torch.float64)
+        self.hits = torch.zeros(self.num_layers, device=self.device, dtype=torch.float64)
+        self.h2d_bytes = torch.zeros(self.num_layers, device=self.device, dtype=torch.float64)
+        self.d2d_bytes = torch.zeros(self.num_layers, device=self.device, dtype=torch.float64)
+        # hit rate histograms, per (batch, head) and layer, and of whole decode steps
+        self.head_hist = torch.zeros(self.num_layers, self.bins, device=self.device, dtype=torch.int64)
+        self.step_hist = torch.zeros(self.bins, device=self.device, dtype=torch.int64)
+        self.step_lookups = torch.zeros((), device=self.device, dtype=torch.float64)
+        self.step_hits = torch.zeros((), device=self.device, dtype=torch.float64)
+        self.steps = 0
+
+    def _bucket(self, rate):
+        return (rate * self.bins).long().clamp(max=self.bins - 1)
+
+    def record(self, layer_idx, cnts, select_sets, chunk_bytes, host_chunk_bytes=None):
+        # cnts: [bsz * kv_heads] hits, chunk_bytes: bytes of one chunk of keys or values on the GPU,
+        # host_chunk_bytes: bytes of one chunk in the host store if it differs (quantized values)
+        host_chunk_bytes = chunk_bytes if host_chunk_bytes is None else host_chunk_bytes
+        hits = cnts.to(torch.float64)
+        lookups = cnts.numel() * select_sets
+        self.lookups[layer_idx] += lookups
+        self.hits[layer_idx] += hits.sum()
+        self.h2d_bytes[layer_idx] += (lookups - hits.sum()) * host_chunk_bytes
+        self.d2d_bytes[layer_idx] += 2 * hits.sum() * chunk_bytes
+        self.head_hist[layer_idx] += torch.bincount(self._bucket(hits / select_sets), minlength=self.bins)
+
+        self.step_lookups += lookups
+        self.step_hits += hits.sum()
+        if layer_idx == self.num_layers - 1:
+            self.step_hist[self._bucket(self.step_hits / self.step_lookups)] += 1
+            self.step_lookups.zero_()
+            self.step_hits.zero_()
+            self.steps += 1
+
+    def hit_rate(self):
+        lookups = self.lookups.sum().item()
+        return self.hits.sum().item() / lookups if lookups > 0 else 0.0
+
+    def to_dict(self):
+        lookups = self.lookups.cpu()
+        hit_rate = torch.where(lookups > 0, self.hits.cpu() / lookups.clamp(min=1), torch.zeros_like(lookups))
+        return {
+            'steps': self.steps,
+            'hit_rate': self.hit_rate(),
+            'h2d_bytes': int(self.h2d_bytes.sum().item()),
+            'd2d_bytes': int(self.d2d_bytes.sum().item()),
+            'bins': [i / self.bins for i in range(self.bins + 1)],
+            'step_histogram': self.step_hist.tolist(),
+            'layers': [{
+                'hit_rate': hit_rate[layer_idx].item(),
+                'lookups': int(lookups[layer_idx].item()),
+                'h2d_bytes': int(self.h2d_bytes[layer_idx].item()),
+                'd2d_bytes': int(self.d2d_bytes[layer_idx].item()),
+                'head_histogram': self.head_hist[layer_idx].tolist(),
+            } for layer_idx in range(self.num_layers)],
+        }
+
+    def to_json(self, path=None):
+        text = json.dumps(self.to_dict(), indent=2)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+    def print_stats(self, per_layer=False):
+        stats = self.to_dict()
+        steps = max(stats['steps'], 1)
+        print(f"CacheStats | steps {stats['steps']} | hit rate {stats['hit_rate']:.4f} | H2D {stats['h2d_bytes'] / 1024**3:.3f} GB ({stats['h2d_bytes'] / steps / 1024**2:.2f} MB/step) | D2D {stats['d2d_bytes'] / 1024**3:.3f} GB | step hit rate histogram {stats['step_histogram']}")
+        if per_layer:
+            for layer_idx, layer in enumerate(stats['layers']):
+                print(f"Layer {layer_idx:>2} | hit rate {layer['hit_rate']:.4f} | H2D {layer['h2d_bytes'] / 1024**2:.2f} MB | D2D {layer['d2d_bytes'] / 1024**2:.2f} MB | head hit rate histogram {layer['head_histogram']}")
@@ -24,18 +24,91 @@
 import torch
 from torch.nn import functional as F
 
-from flashinfer.norm import rmsnorm
-from minference import vertical_slash_sparse_attention, block_sparse_attention, streaming_forward
-
-from kernels import shadowkv
+try:
+    from flashinfer.norm import rmsnorm
+except ImportError:
+    rmsnorm = None
+try:
+    from minference import vertical_slash_sparse_attention, block_sparse_attention, streaming_forward
+except ImportError:
+    vertical_slash_sparse_attention, block_sparse_attention, streaming_forward = None, None, None
+try:
+    from flash_attn import flash_attn_with_kvcache as _flash_attn_with_kvcache
+except ImportError:
+    _flash_attn_with_kvcache = None
+try:
+    import vllm
+except ImportError:
+    vllm = None
+
+from models.shadowkv_ops import shadowkv, get_backend
 
 def layer_norm(
     hidden_states: torch.Tensor,
     eps: float,
     w: torch.Tensor,
 ):
+    if rmsnorm is None or not hidden_states.is_cuda:
+        input_dtype = hidden_states.dtype
+        variance = hidden_states.to(torch.float32).pow(2).mean(-1, keepdim=True)
+        hidden_states = hidden_states.to(torch.float32) * torch.rsqrt(variance + eps)
+        return w * hidden_states.to(input_dtype)
     return rmsnorm(hidden_states.view(-1, hidden_states.size(-1)), w, eps).view_as(hidden_states)
 
+def flash_attn_with_kvcache(q, k_cache, v_cache, cache_seqlens=None, causal=True):
+    """flash_attn_with_kvcache of flash-attn, with a torch SDPA fallback for CPU hosts and the torch ops backend.
+
+    q [bsz, q_len, heads, head_dim], k_cache / v_cache [bsz, k_len, kv_heads, head_dim]. Batch i attends to its
+    first cache_seqlens[i] keys (all k_len without cache_seqlens), causal aligns the queries to the end of them.
+    """
+    if _flash_attn_with_kvcache is not None and q.is_cuda and get_backend() != 'torch':
+        return _flash_attn_with_kvcache(q=q, k_cache=k_cache, v_cache=v_cache, cache_seqlens=cache_seqlens, causal=causal)
+
+    bsz, q_len, heads, _ = q.shape
+    k_len, kv_heads = k_cache.shape[1], k_cache.shape[2]
+    query = q.transpose(1, 2)
+    key = k_cache.transpose(1, 2).repeat_interleave(heads // kv_heads, dim=1)
+    value = v_cache.transpose(1, 2).repeat_interleave(heads // kv_heads, dim=1)
+    if cache_seqlens is None and (not causal or q_len == k_len):
+        out = F.scaled_dot_product_attention(query, key, value, is_causal=causal)
+    else:
+        lens = torch.full((bsz,), k_len, device=q.device) if cache_seqlens is None else cache_seqlens.to(q.device).long()
+        k_idx = torch.arange(k_len, device=q.device).view(1, 1, k_len)
+        mask = k_idx < lens.view(bsz, 1, 1) # [bsz, 1, k_len]
+        if causal:
+            q_pos = lens.view(bsz, 1) - q_len + torch.arange(q_len, device=q.device) # [bsz, q_len]
+            mask = mask & (k_idx <= q_pos.unsqueeze(-1)) # [bsz, q_len, k_len]
+        out = F.scaled_dot_product_attention(query, key, value, attn_mask=mask.unsqueeze(1))
+    return out.transpose(1, 2)
+
+
+def rotary_embedding(positions, query, key, head_size, cos_sin_cache, is_neox):
+    """vllm._custom_ops.rotary_embedding: RoPE in place on query / key [bsz, seq, heads * head_size].
+
+    cos_sin_cache is [max_len, rot_dim] as [cos | sin], the first rot_dim dims of every head are rotated, in
+    halves (is_neox) or in interleaved pairs. Without vllm or off the GPU it runs in torch.
+    """
+    if vllm is not None and query.is_cuda:
+        vllm._custom_ops.rotary_embedding(positions, query, key, head_size, cos_sin_cache, is_neox)
+        return
+    rot_dim = cos_sin_cache.shape[-1]
+    cos, sin = cos_sin_cache[positions].unsqueeze(-2).chunk(2, dim=-1) # [bsz, seq, 1, rot_dim // 2]
+    for x in (query, key):
+        x = x.view(*x.shape[:-1], -1, head_size)[..., :rot_dim]
+        x1, x2 = (x[..., :rot_dim // 2], x[..., rot_dim // 2:]) if is_neox else (x[..., 0::2], x[..., 1::2])
+        out1, out2 = x1 * cos - x2 * sin, x2 * cos + x1 * sin
+        x1.copy_(out1)
+        x2.copy_(out2)
+
+
+def silu_and_mul(out, x):
+    # vllm._custom_ops.silu_and_mul: out = silu(x[..., :d]) * x[..., d:]
+    if vllm is not None and x.is_cuda:
+        vllm._custom_ops.silu_and_mul(out, x)
+        return
+    d = x.shape[-1] // 2
+    out.copy_(F.silu(x[..., :d]) * x[..., d:])
+
 # def layer_norm(
 #     hidden_states: torch.Tensor,
 #     eps: float,
@@ -52,7 +125,7 @@ def layer_norm(
 # copy from https://github.com/microsoft/MInference/blob/main/minference/modules/minference_forward.py
 
 last_q = 64
-arange = torch.arange(last_q, device="cuda")
+arange = torch.arange(last_q, device="cuda" if torch.cuda.is_available() else "cpu")
 LAST_Q_MASK = arange[None, None, :, None] >= arange[None, None, None, :]
 
 def sum_all_diagonal_matrix(mat: torch.tensor):
@@ -236,6 +309,45 @@ def batch_gather_gemm_rotary_pos_emb_cuda(
     return apply_rotary_pos_emb_cuda_push_cache(output, cos_sin, position_ids, chunk_size, cache, sparse_start, sparse_end, cnts)
 
 
+def batch_gather_gemm_dequant_rotary_pos_emb(
+    a: torch.Tensor,
+    a_scale: torch.Tensor,
+    b: torch.Tensor,
+    cos_sin: torch.Tensor,
+    position_ids: torch.Tensor,
+    output: torch.Tensor,
+    chunk_size: int,
+    cache: torch.Tensor,
+    sparse_start: int,
+    sparse_end: int,
+    cnts: torch.Tensor,
+    max_misses: int = None
+):
+    """batch_gather_gemm_rotary_pos_emb_cuda for an int8 / fp8 U [bsz, seq, rank] with per-row scales a_scale [bsz, seq].
+
+    Not fused: the gathered rows are converted to b.dtype in a [bsz, heads, misses * chunk_size, rank] copy
+    of U, multiplied by SV with one batched matmul and the row scales applied to the output, before the push
+    kernel ropes and writes the keys. Only misses are computed: position_ids lists the cnts hits of each head
+    first, so the last max_misses chunks of every head cover all its misses (hits among them are discarded by
+    the push kernel). max_misses defaults to the largest miss count of the step, which reads cnts on the
+    host, pass the full number of chunks to stay sync-free (CUDA graph capture).
+    """
+    batch_size, _, rank = a.shape
+    _, heads, head_dim, _ = b.shape
+    num_chunks = position_ids.shape[-1]
+    if max_misses is None:
+        max_misses = num_chunks - int(cnts.min())
+    if max_misses > 0:
+        first = num_chunks - max_misses
+        rows = (position_ids[..., first:].long().unsqueeze(-1) * chunk_size + torch.arange(chunk_size, device=a.device)).view(batch_size, heads, -1) # [bsz, heads, misses * chunk_size]
+        batch_idx = torch.arange(batch_size, device=a.device).view(-1, 1, 1)
+        u = a[batch_idx, rows].to(b.dtype) # [bsz, heads, misses * chunk_size, rank]
+        output[:, :, first * chunk_size:].copy_(torch.matmul(u, b.transpose(-1, -2)) * a_scale[batch_idx, rows].unsqueeze(-1).to(b.dtype))
+    position_ids = position_ids.to(torch.int32).contiguous()
+
+    return apply_rotary_pos_emb_cuda_push_cache(output, cos_sin, position_ids, chunk_size, cache, sparse_start, sparse_end, cnts)
+
+
 # copy from https://github.com/LeeSinLiang/microGPT/blob/ed40cf9780dbeb180adfe94c227d4aa97e69250e/gpt.py
 def top_k_top_p_filter(logits: torch.Tensor, top_k: int = 0, top_p: float = 0.0):
     """
@@ -0,0 +1,221 @@
+################################################################################
+#
+# Copyright 2024 ByteDance Ltd. and/or its affiliates. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+
+import os
+import math
+import tempfile
+import weakref
+import torch
+from models.quant import RowQuantizer
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _mmap_tensor(owner, offload_dir, shape, dtype):
+    # tensor backed by a temporary file under offload_dir, removed with `owner`
+    os.makedirs(offload_dir, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix='shadowkv_v_', suffix='.bin', dir=offload_dir)
+    os.close(fd)
+    finalizer = weakref.finalize(owner, _remove_file, path)
+    return path, finalizer, torch.from_file(path, shared=True, size=math.prod(shape), dtype=dtype).view(shape)
+
+
+class MmapValueStore:
+    """Chunk-major value store backed by a file on local disk.
+
+    `values` has the same layout as the pinned `v_cache_cpu` of ShadowKVCache_CPU,
+    [layers, bsz, kv_heads, max_length // chunk_size, chunk_size * head_dim], but lives
+    in a memory-mapped file so only the pages touched by a lookup are resident.
+    `stage` copies the chunks that missed the GPU buffer into a small pinned staging
+    ring and rewrites their offsets, so the regular gather kernel reads from the ring.
+    """
+    def __init__(self,
+        shape :tuple,
+        dtype,
+        offload_dir :str,
+        select_sets :int,
+        num_staging :int = 2,
+        device :str = 'cuda:0',
+        ) -> None:
+
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self.path, self._finalizer, self.values = _mmap_tensor(self, offload_dir, self.shape, dtype)
+
+        num_layers, batch_size, num_heads, self.num_chunks, self.unit = self.shape
+        self.block_num = batch_size * num_heads
+        self.select_sets = select_sets
+
+        # [num_staging, bsz * kv_heads, select_sets, chunk_size * head_dim]
+        self.staging = torch.zeros(num_staging, self.block_num, select_sets, self.unit, device='cpu', dtype=dtype, pin_memory=torch.cuda.is_available())
+        self.staging_events = [None] * num_staging
+        self.staging_idx = 0
+        self.slot_ids = torch.arange(select_sets, device=device, dtype=torch.int32).unsqueeze(0) # [1, select_sets]
+
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.lookups = 0
+        self.misses = 0
+        self.bytes_read = 0
+
+    def stage(self, layer_idx, offsets, cnts, select_sets=None):
+        """Fill the next staging slot with the missed chunks of `layer_idx`.
+
+        Returns the staging slot, the offsets with misses remapped to slot rows and the
+        per-block host stride expected by `gather_copy_with_offsets`. `select_sets` can be
+        below the one the ring was sized for when layers have different sparse budgets.
+        """
+        select_sets = self.select_sets if select_sets is None else select_sets
+        slot = self.staging_idx
+        self.staging_idx = (slot + 1) % len(self.staging_events)
+        if self.staging_events[slot] is not None:
+            self.staging_events[slot].synchronize()
+
+        offsets = offsets.view(self.block_num, select_sets)
+        slot_ids = self.slot_ids[:, :select_sets]
+        is_miss = slot_ids >= cnts.view(self.block_num, 1) # [bsz * kv_heads, select_sets]
+
+        # misses are only known after the reorder kernel, this is the single sync point
+        miss_b, miss_i = is_miss.cpu().nonzero(as_tuple=True)
+        miss_chunks = offsets.cpu()[miss_b, miss_i].long()
+        src = self.values[layer_idx].view(self.block_num, self.num_chunks, self.unit)
+        staging = self.staging[slot].view(-1)[:self.block_num * select_sets * self.unit].view(self.block_num, select_sets, self.unit)
+        staging[miss_b, miss_i] = src[miss_b, miss_chunks]
+
+        self.lookups += is_miss.numel()
+        self.misses += miss_b.numel()
+        self.bytes_read += miss_b.numel() * self.unit * self.values.element_size()
+
+        staged_offsets = torch.where(is_miss, slot_ids, offsets).contiguous().view(-1)
+        return staging, staged_offsets, select_sets * self.unit, slot
+
+    def release(self, slot):
+        # the slot can be refilled once the kernel that reads it has finished
+        if torch.cuda.is_available():
+            event = torch.cuda.Event()
+            event.record()
+            self.staging_events[slot] = event
+
+    def hit_rate(self):
+        return 1.0 - self.misses / self.lookups if self.lookups > 0 else 0.0
+
+    def print_stats(self):
+        print(f"MmapValueStore | {self.path} | lookups {self.lookups} | hit rate {self.hit_rate():.4f} | read {self.bytes_read / 1024**3:.3f} GB")
+
+    def close(self):
+        self.values = None
+        self._finalizer()
+
+
+class QuantizedValueStore:
+    """Chunk-major value store holding group-quantized rows, see models/quant.py.
+
+    `values` is [layers, bsz, kv_heads, max_length // chunk_size, row_bytes] uint8 in pinned
+    host memory, or in a memory-mapped file under `offload_dir`. Only the chunks that missed
+    the GPU buffer are copied, as packed rows through a pinned staging ring, and are
+    dequantized on the device straight into their slots of the value buffer.
+    """
+    def __init__(self,
+        shape :tuple,
+        dtype,
+        method :str,
+        group_size :int,
+        select_sets :int,
+        offload_dir :str = None,
+        num_staging :int = 2,
+        device :str = 'cuda:0',
+        ) -> None:
+
+        num_layers, batch_size, num_heads, self.num_chunks, unit = shape
+        self.quantizer = RowQuantizer(method, unit, group_size)
+        self.method = method
+        self.dtype = dtype
+        self.row_bytes = self.quantizer.row_bytes
+        self.shape = (num_layers, batch_size, num_heads, self.num_chunks, self.row_bytes)
+        if offload_dir is not None:
+            self.path, self._finalizer, self.values = _mmap_tensor(self, offload_dir, self.shape, torch.uint8)
+        else:
+            self.path, self._finalizer = None, None
+            self.values = torch.zeros(*self.shape, device='cpu', dtype=torch.uint8, pin_memory=torch.cuda.is_available())
+
+        self.block_num = batch_size * num_heads
+        self.select_sets = select_sets
+        # [num_staging, bsz * kv_heads * select_sets, row_bytes]
+        self.staging = torch.zeros(num_staging, self.block_num * select_sets, self.row_bytes, device='cpu', dtype=torch.uint8, pin_memory=torch.cuda.is_available())
+        self.staging_events = [None] * num_staging
+        self.staging_idx = 0
+        self.slot_ids = torch.arange(select_sets, device=device, dtype=torch.int32).unsqueeze(0) # [1, select_sets]
+
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.lookups = 0
+        self.misses = 0
+        self.bytes_read = 0
+
+    def write(self, layer_idx, batch_start, chunk_start, values):
+        # values: [bsz, kv_heads, chunks, chunk_size * head_dim], quantized where they live
+        rows = self.quantizer.quantize(values)
+        self.values[layer_idx][batch_start:batch_start + values.shape[0], :, chunk_start:chunk_start + values.shape[2]].copy_(rows, non_blocking=True)
+
+    def gather(self, layer_idx, offsets, cnts, select_sets, region):
+        """Dequantize the missed chunks of `layer_idx` into `region` [bsz * kv_heads, select_sets, unit].
+
+        Hits in [0, cnts) are expected to be in place already, see gather_copy_d2d_with_offsets.
+        """
+        slot = self.staging_idx
+        self.staging_idx = (slot + 1) % len(self.staging_events)
+        if self.staging_events[slot] is not None:
+            self.staging_events[slot].synchronize()
+
+        offsets = offsets.view(self.block_num, select_sets)
+        is_miss = self.slot_ids[:, :select_sets] >= cnts.view(self.block_num, 1) # [bsz * kv_heads, select_sets]
+
+        # misses are only known after the reorder kernel, this is the single sync point
+        miss_b, miss_i = is_miss.cpu().nonzero(as_tuple=True)
+        num_miss = miss_b.numel()
+        src = self.values[layer_idx].view(self.block_num, self.num_chunks, self.row_bytes)
+        staging = self.staging[slot][:num_miss]
+        torch.index_select(src.view(-1, self.row_bytes), 0, miss_b * self.num_chunks + offsets.cpu()[miss_b, miss_i].long(), out=staging)
+        rows = staging.to(region.device, non_blocking=True)
+        region[miss_b.to(region.device), miss_i.to(region.device)] = self.quantizer.dequantize(rows, region.dtype)
+        if torch.cuda.is_available():
+            event = torch.cuda.Event()
+            event.record()
+            self.staging_events[slot] = event
+
+        self.lookups += is_miss.numel()
+        self.misses += num_miss
+        self.bytes_read += num_miss * self.row_bytes
+
+    def hit_rate(self):
+        return 1.0 - self.misses / self.lookups if self.lookups > 0 else 0.0
+
+    def print_stats(self):
+        unit_bytes = self.quantizer.unit * torch.empty(0, dtype=self.dtype).element_size()
+        print(f"QuantizedValueStore | {self.method} | {self.row_bytes} B/chunk vs {unit_bytes} B | {self.path or 'pinned'} | lookups {self.lookups} | hit rate {self.hit_rate():.4f} | read {self.bytes_read / 1024**3:.3f} GB")
+
+    def close(self):
+        self.values = None
+        if self._finalizer is not None:
+            self._finalizer()
@@ -29,6 +29,10 @@ from data.dataset import Dataset
 os.chdir(root_dir)
 
 from models import choose_model_class
+from models.scheduler import ContinuousBatcher
+from models.cuda_graph import benchmark_decode
+from models.landmarks import landmark_report
+from models.memory_plan import plan_memory, outlier_chunks
 
 dataset_name = "ruler/qa_2"
 
@@ -120,6 +124,25 @@ def parse_args() -> Namespace:
     p = ArgumentParser()
     p.add_argument("--model_name", type=str, default="meta-llama/Meta-Llama-3.1-8B-Instruct", choices=["gradientai/Llama-3-8B-Instruct-Gradient-1048k", "meta-llama/Meta-Llama-3.1-8B-Instruct", "01-ai/Yi-9B-200K","THUDM/glm-4-9b-chat-1m"])
     p.add_argument("--datalen", type=str, default="122k", choices=["60k", "122k", "244k"])
+    p.add_argument("--svd_method", type=str, default="exact", choices=["exact", "gram", "randomized"])
+    p.add_argument("--prefill_window", type=int, default=None, help="run the ShadowKV prefill in windows of this many tokens")
+    p.add_argument("--compact_every", type=int, default=None, help="fold generated tokens into the offloaded chunks every this many tokens")
+    p.add_argument("--offload_dir", type=str, default=None, help="keep the ShadowKV value cache in a memory-mapped file under this directory")
+    p.add_argument("--retrieval_top_p", type=float, default=None, help="keep the top chunks of each head up to this landmark attention mass")
+    p.add_argument("--kv_stats", type=str, default=None, help="collect ShadowKV cache-hit telemetry and write it to this JSON file")
+    p.add_argument("--value_quant", type=str, default=None, choices=["int8", "int4", "fp8"], help="quantize the ShadowKV host value store")
+    p.add_argument("--u_quant", type=str, default=None, choices=["int8", "fp8"], help="keep the ShadowKV U factor in int8 / fp8 on the GPU")
+    p.add_argument("--budget_map", type=str, default=None, help="per-layer sparse budget and rank map written by models/budget.py")
+    p.add_argument("--no_memory_cleanup", action="store_true", help="skip gc.collect / empty_cache / synchronize between requests")
+    p.add_argument("--layer_prefetch", action="store_true", help="start the ShadowKV value transfer of the next layer during the attention and MLP of the current one")
+    p.add_argument("--speculative", type=int, default=None, help="also decode the ShadowKV batch speculatively with this many draft tokens per round")
+    p.add_argument("--draft_budget", type=int, default=256, help="sparse budget of the cache view the speculative draft decodes from")
+    p.add_argument("--cuda_graph", action="store_true", help="benchmark eager vs CUDA graph decode steps, then decode the ShadowKV run from a CUDA graph")
+    p.add_argument("--artifact_placement", type=str, default="auto", choices=["auto", "cpu", "gpu"], help="where the ShadowKV prefill writes U, SV and landmarks, auto keeps them on the GPU when they fit")
+    p.add_argument("--landmark_report", action="store_true", help="compare the blocked landmark builder with the reference on keys of the prompt length, time and peak memory")
+    p.add_argument("--auto_config", action="store_true", help="size baseline_bsz, shadowkv_bsz and sparse_budget from the model config and the memory of this GPU instead of the table")
+    p.add_argument("--memory_fraction", type=float, default=0.9, help="share of the device and host memory --auto_config plans with")
+    p.add_argument("--continuous", type=int, default=None, help="also serve this many requests with mixed generation lengths through the continuous batching scheduler")
 
     return p.parse_args()
 
@@ -136,6 +159,23 @@ if __name__ == '__main__':
     shadowkv_bsz = configs[model_name][length]["shadowkv_bsz"]
     sparse_budget = configs[model_name][length]["sparse_budget"]
 
+    if args.auto_config:
+        from transformers import AutoConfig
+        plan = plan_memory(
+            AutoConfig.from_pretrained(model_name, trust_remote_code=True), min_prompt_len,
+            device_memory=torch.cuda.get_device_properties(0).total_memory,
+            host_memory=os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES'),
+            budget_map=args.budget_map, svd_method=args.svd_method, compact_every=args.compact_every, u_quant=args.u_quant, value_quant=args.value_quant,
+            memory_fraction=args.memory_fraction,
+        )
+        baseline_bsz, shadowkv_bsz, sparse_budget = plan['baseline_bsz'], plan['shadowkv_bsz'], plan['sparse_budget']
+        assert baseline_bsz > 0 and shadowkv_bsz > 0, f"{length} prompts do not fit on this GPU"
+
+    if args.landmark_report:
+        keys = torch.randn(1, 8, min_prompt_len, 128, device='cuda:0', dtype=torch.bfloat16)
+        landmark_report(keys, outlier_chunk=outlier_chunks(sparse_budget), select_sets=sparse_budget // 8)
+        del keys
+        torch.cuda.empty_cache()
 
     ##################### Baseline #####################
     LLM = choose_model_class(model_name)
@@ -158,11 +198,39 @@ if __name__ == '__main__':
 
     ##################### ShadowKV #####################
 
-    llm = LLM(model_name=model_name, device='cuda:0',  batch_size=shadowkv_bsz, max_length=min_prompt_len, attn_mode='shadowkv_cpu', sparse_budget=sparse_budget)
+    llm = LLM(model_name=model_name, device='cuda:0',  batch_size=shadowkv_bsz, max_length=min_prompt_len, attn_mode='shadowkv_cpu', sparse_budget=sparse_budget, offload_dir=args.offload_dir, svd_method=args.svd_method, compact_every=args.compact_every, budget_map=args.budget_map, retrieval_top_p=args.retrieval_top_p, collect_stats=args.kv_stats is not None, value_quant=args.value_quant, u_quant=args.u_quant, artifact_placement=args.artifact_placement)
+    if args.prefill_window is not None:
+        llm.enable_streaming_prefill(args.prefill_window)
+    if args.no_memory_cleanup:
+        llm.set_memory_cleanup(False)
+    if args.layer_prefetch:
+        llm.enable_layer_prefetch()
     dataset = Dataset(dataset_name, llm.tokenizer, 256*1024, 100)
 
     input_ids = torch.cat([dataset[i][0][:, :min_prompt_len] for i in range(llm.batch_size)], dim=0)
+    if args.cuda_graph:
+        benchmark_decode(llm, input_ids.to(llm.device))
+        llm.enable_cuda_graph()
     _, throughput_shadowkv = llm.batch_generate(input_ids.to(llm.device), gen_len=100, benchmark=True, temperature=temperature)
     print(colored(f"[ShadowKV] Throughput: {throughput_shadowkv} tokens/s", 'red'))
+    if llm.kv_cache.value_store is not None:
+        llm.kv_cache.value_store.print_stats()
+    if args.kv_stats is not None:
+        llm.kv_cache.stats.print_stats(per_layer=True)
+        llm.kv_cache.stats.to_json(args.kv_stats)
+    if llm.graph_decoder is not None:
+        llm.graph_decoder.print_stats()
+    if args.speculative is not None:
+        _, decoder = llm.speculative_generate(input_ids.to(llm.device), gen_len=100, num_draft_tokens=args.speculative, draft_budget=args.draft_budget, temperature=temperature, benchmark=True)
+        print(colored(f"[ShadowKV speculative] Throughput: {decoder.accepted_tokens() / decoder.elapsed:.2f} tokens/s, acceptance rate {decoder.acceptance_rate():.4f}", 'red'))
+
+    if args.continuous is not None:
+        batcher = ContinuousBatcher(llm, temperature=temperature)
+        for i in range(args.continuous):
+            prompt = dataset[i % 100][0][:, :min_prompt_len]
+            # without --compact_every the local window bounds the generation length
+            batcher.submit(prompt, gen_len=min([25, 50, 100, 200][i % 4], batcher.max_gen_len(prompt)))
+        batcher.run()
+        batcher.print_stats()
     
     print(colored(f"Speedup: {throughput_shadowkv / throughput_baseline:.2f}x", 'red'))
\ No newline at end of file